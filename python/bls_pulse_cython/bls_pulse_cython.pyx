@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import os
 import numpy as np
-from detrend import polyfit
-from numpy.polynomial import polynomial as poly
+from detrend import polyfit_windows
 cimport numpy as np
 cimport cython
 
@@ -16,6 +16,20 @@ cdef extern int do_bls_pulse_segment_compound(double *time, double *flux, double
     double *srsq_dip, double *duration_dip, double *depth_dip, double *midtime_dip,
     double *srsq_blip, double *duration_blip, double *depth_blip, double *midtime_blip)
 
+cdef extern int do_bls_pulse(double *time, double *flux, double *fluxerr, double *samples,
+    int nbins, int nsegments, int nbins_min_dur, int nbins_max_dur, int direction,
+    int kernel, int nthreads, double *srsq, double *duration, double *depth, double *midtime,
+    double *srsq_blip, double *duration_blip, double *depth_blip, double *midtime_blip) nogil
+
+cdef extern int do_bls_pulse_single(double *time, float *flux, float *fluxerr, float *samples,
+    int nbins, int nsegments, int nbins_min_dur, int nbins_max_dur, int direction,
+    int kernel, int nthreads, double *srsq, double *duration, double *depth, double *midtime,
+    double *srsq_blip, double *duration_blip, double *depth_blip, double *midtime_blip) nogil
+
+# Kernels for `bls_pulse`; these must match the KERNEL_* values in
+# bls_pulse_extern.c.
+KERNELS = {'scan': 0, 'prefix': 1}
+
 cdef extern int do_bin_segment(double *time, double *flux, double *fluxerr, int nbins,
     double segsize, int nsamples, int n, int *ndx, double *stime, double *sflux,
     double *sfluxerr, double *samples, double *start, double *end)
@@ -25,87 +39,312 @@ cdef extern int do_bin_segment(double *time, double *flux, double *fluxerr, int
 @cython.wraparound(False)
 @cython.profile(True)
 @cython.embedsignature(True)
-def bls_pulse(np.ndarray[double, ndim=1, mode='c'] time,
-np.ndarray[double, ndim=1, mode='c'] flux, np.ndarray[double, ndim=1, mode='c'] fluxerr,
-np.ndarray[double, ndim=1, mode='c'] samples, int nbins, double segsize, double mindur,
-double maxdur, direction=0):
-    cdef int i, nsamples, nsegments
-    cdef np.ndarray[double, ndim=1, mode='c'] stime, sflux, sfluxerr, ssamples
-    cdef np.ndarray[double, ndim=2, mode='c'] srsq, depth, duration, midtime
-    cdef np.ndarray[double, ndim=2, mode='c'] srsq_dip, depth_dip, duration_dip, midtime_dip
-    cdef np.ndarray[double, ndim=2, mode='c'] srsq_blip, depth_blip, duration_blip, midtime_blip
+def bls_pulse(np.ndarray[double, ndim=1, mode='c'] time, np.ndarray flux,
+np.ndarray fluxerr, np.ndarray samples, int nbins, double segsize, double mindur,
+double maxdur, direction=0, nthreads=None, kernel='prefix', segments=None,
+previous=None, nsegments=None):
+    '''
+    Run BLS pulse on every segment of a binned lightcurve, as returned by
+    ``bin_and_detrend``. All of the segments are handed to a single C call,
+    which runs without the GIL and splits them over `nthreads` threads; the
+    results are the same for any number of threads.
+
+    The "scan" kernel evaluates every pair of start and end bins. The
+    "prefix" kernel only visits the non-empty bins, uses cumulative sums to
+    bound the best SR^2 of each start bin, and skips the bins that cannot
+    beat the best event already found; the best event of each segment, which
+    is all that is returned, is bit-identical.
+
+    If `segments` is given, only those segments are searched, and the results
+    for all other segments are copied from `previous`, the output of an
+    earlier call with the same settings. Each segment is searched on its own,
+    so this gives the same results as searching all of them.
+
+    The number of segments is counted from the binned times unless
+    `nsegments` is given. Pass the number of segments ``bin_and_detrend``
+    returned (the length of `segstart`): it counts them from the raw times,
+    and the last segments can hold no binned points at all, for instance
+    once ``clean_signal`` has masked the points at the end of the light
+    curve. The output then has one value for every segment of
+    ``bin_and_detrend``, and the results of successive calls line up.
+
+    If `flux` is single precision (as returned by ``bin_and_detrend`` with
+    ``dtype='float32'``), the fluxes, errors, and sample counts are read in
+    single precision and widened one segment at a time, so the search itself,
+    and all of its sums, are still in double precision. The times are always
+    double precision.
+
+    :param nthreads: Number of threads to use; if None, the value of the
+        environment variable ``CLOUD_KEPLER_THREADS``, or 1 if it is not set
+    :type nthreads: int
+    :param kernel: BLS kernel, "scan" or "prefix"
+    :type kernel: str
+    :param segments: Indices of the segments to search; if None, all of them
+    :type segments: np.ndarray
+    :param previous: Output of an earlier call, for the other segments
+    :type previous: dict
+    :param nsegments: Number of segments; if None, counted from the binned
+        times
+    :type nsegments: int
+    '''
+    cdef int nsearch
+
+    cnthreads, ckernel = __check_threads_kernel(nthreads, kernel)
 
-    # Prepare the lightcurve so that it meets our assumptions.
+    # Prepare the lightcurve so that it meets our assumptions. The times are
+    # made zero-based on a copy, so the caller's array is left as it is.
     t = np.nanmin(time)
-    time -= t
+    time = time - t
+
+    if nsegments is None:
+        nsegments = np.floor(np.nanmax(time) / segsize) + 1
+    nsegments = int(nsegments)
+
+    if nsegments < 1:
+        raise ValueError('Number of segments must be >= 1.')
+    if time.shape[0] < nsegments * nbins or flux.shape[0] < nsegments * nbins or \
+    fluxerr.shape[0] < nsegments * nbins or samples.shape[0] < nsegments * nbins:
+        raise ValueError('Input arrays must hold nbins points for every segment.')
+
+    nsearch = nsegments
+
+    if segments is not None:
+        if previous is None:
+            raise ValueError('Need the previous output to search only some segments.')
+        if any(len(v) != nsegments for v in previous.itervalues()):
+            raise ValueError('Previous output must hold one value for every segment.')
+
+        # Gather the bins of the segments to search; the results go back
+        # into a copy of the previous output at the end.
+        segments = np.asarray(segments, dtype='int64')
+        if np.any(segments < 0) or np.any(segments >= nsegments):
+            raise ValueError('Segment indices out of range.')
+
+        ndx = (segments[:,None] * nbins + np.arange(nbins)[None,:]).ravel()
+        time = time[ndx]
+        flux = flux[ndx]
+        fluxerr = fluxerr[ndx]
+        samples = samples[ndx]
+        nsearch = len(segments)
+
+        if nsearch == 0:
+            return dict((k, v.copy()) for k, v in previous.iteritems())
+
+    out = __search_segments(time, flux, fluxerr, samples, nbins, nsearch,
+        segsize, mindur, maxdur, direction, ckernel, cnthreads,
+        __output_buffers(nsearch * nbins, direction, None))
+    for k in out:
+        if k.startswith('midtime'):
+            out[k] += t
+
+    if segments is not None:
+        result = dict((k, v.copy()) for k, v in previous.iteritems())
+        for k in out:
+            result[k][segments] = out[k]
+        out = result
+
+    return out
 
-    nsamples = np.size(time)
-    nsegments = np.floor(np.nanmax(time) / segsize) + 1
 
+@cython.profile(True)
+@cython.embedsignature(True)
+def bls_pulse_batch(np.ndarray[double, ndim=1, mode='c'] time, np.ndarray flux,
+np.ndarray fluxerr, np.ndarray samples, offsets, int nbins, double segsize,
+double mindur, double maxdur, direction=0, nthreads=None, kernel='prefix',
+workspace=None):
+    '''
+    Run BLS pulse on a batch of binned lightcurves with the same settings, in
+    a single C call. The lightcurves, each as returned by
+    ``bin_and_detrend``, are concatenated; lightcurve `i` is held in bins
+    ``offsets[i]`` to ``offsets[i+1]``, so `offsets` has one more entry than
+    there are lightcurves, starting at 0 and ending at the length of the
+    arrays. Every lightcurve must hold a whole number of segments.
+
+    Returns a list with the output of ``bls_pulse`` for each lightcurve, with
+    the same results. The C code writes the results for every start bin to
+    buffers as large as the whole batch; if a `workspace` dictionary is
+    given, these buffers are kept in it and reused by later calls with the
+    same `workspace`, as long as they are large enough.
+
+    :param time: Concatenated binned times
+    :type time: np.ndarray
+    :param flux: Concatenated binned fluxes
+    :type flux: np.ndarray
+    :param fluxerr: Concatenated binned flux errors
+    :type fluxerr: np.ndarray
+    :param samples: Concatenated sample counts
+    :type samples: np.ndarray
+    :param offsets: Index of the first bin of each lightcurve, and the total
+        number of bins
+    :type offsets: np.ndarray
+    :param nthreads: Number of threads to use; if None, the value of the
+        environment variable ``CLOUD_KEPLER_THREADS``, or 1 if it is not set
+    :type nthreads: int
+    :param kernel: BLS kernel, "scan" or "prefix"
+    :type kernel: str
+    :param workspace: Dictionary for the buffers kept between calls
+    :type workspace: dict
+
+    :rtype: list
+    '''
+    cdef int nsegments
+
+    cnthreads, ckernel = __check_threads_kernel(nthreads, kernel)
+
+    offsets = np.asarray(offsets, dtype='int64')
+    if offsets.ndim != 1 or len(offsets) < 2 or offsets[0] != 0 or \
+    offsets[-1] != time.shape[0]:
+        raise ValueError('Offsets must start at 0 and end at the length of the arrays.')
+    if flux.shape[0] != time.shape[0] or fluxerr.shape[0] != time.shape[0] or \
+    samples.shape[0] != time.shape[0]:
+        raise ValueError('Input arrays must have the same length.')
+
+    lengths = np.diff(offsets)
+    if np.any(lengths <= 0) or np.any(lengths % nbins != 0):
+        raise ValueError('Every lightcurve must hold a whole number of segments.')
+
+    # Make the times of each lightcurve zero-based, as ``bls_pulse`` does,
+    # and count its segments again on the binned times. Any segments past
+    # those are searched along with the rest, but left out of the output.
+    t = np.fmin.reduceat(time, offsets[:-1])
+    counts = np.floor((np.fmax.reduceat(time, offsets[:-1]) - t) / segsize) + 1
+    if np.any(counts * nbins > lengths):
+        raise ValueError('Input arrays must hold nbins points for every segment.')
+
+    time = time - np.repeat(t, lengths)
+    nsegments = time.shape[0] // nbins
+
+    out = __search_segments(time, flux, fluxerr, samples, nbins, nsegments,
+        segsize, mindur, maxdur, direction, ckernel, cnthreads,
+        __output_buffers(nsegments * nbins, direction, workspace))
+
+    results = []
+    for first, count, tstar in zip(offsets[:-1] // nbins, counts.astype('int64'), t):
+        result = dict((k, v[first:first+count].copy()) for k, v in out.iteritems())
+        for k in result:
+            if k.startswith('midtime'):
+                result[k] += tstar
+        results.append(result)
+
+    return results
+
+
+def __check_threads_kernel(nthreads, kernel):
+    '''
+    Check the `nthreads` and `kernel` arguments of ``bls_pulse`` and
+    ``bls_pulse_batch``, and return them as the number of threads and the
+    kernel code passed to the C code.
+    '''
+    if nthreads is None:
+        nthreads = os.environ.get('CLOUD_KEPLER_THREADS', 1)
+    if int(nthreads) < 1:
+        raise ValueError('Number of threads must be >= 1.')
+    if kernel not in KERNELS:
+        raise ValueError('Invalid kernel: %s' % kernel)
+
+    return int(nthreads), KERNELS[kernel]
+
+
+def __output_buffers(size, direction, workspace):
+    '''
+    Return the buffers the C code writes the SR^2, duration, depth, and
+    midtime of every start bin to; eight of them for compound searches and
+    four otherwise, each holding at least `size` values. If a `workspace`
+    dictionary is given, its buffers are reused if they are large enough,
+    and any new ones are kept in it.
+    '''
+    nout = 8 if direction == 2 else 4
+
+    if workspace is not None:
+        buffers = workspace.get('buffers')
+        if buffers is not None and len(buffers) >= nout and \
+        buffers[0].shape[0] >= size:
+            return buffers[:nout]
+
+    buffers = [np.empty((size,), dtype='float64') for i in xrange(nout)]
+    if workspace is not None:
+        workspace['buffers'] = buffers
+
+    return buffers
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def __search_segments(np.ndarray[double, ndim=1, mode='c'] time, np.ndarray flux,
+np.ndarray fluxerr, np.ndarray samples, int nbins, int nsegments, double segsize,
+double mindur, double maxdur, int direction, int kernel, int nthreads, buffers):
+    '''
+    Search the first `nsegments` segments of zero-based, binned data in a
+    single C call, writing the results for every start bin to `buffers`, and
+    return the best event of each segment, as ``bls_pulse`` does.
+    '''
+    cdef int nbins_min_dur, nbins_max_dur, status, i
+    cdef np.ndarray[double, ndim=1, mode='c'] flux64, fluxerr64, samples64
+    cdef np.ndarray[float, ndim=1, mode='c'] flux32, fluxerr32, samples32
+    cdef np.ndarray[double, ndim=1, mode='c'] b0, b1, b2, b3
+    cdef np.ndarray[double, ndim=1, mode='c'] b4 = None, b5 = None, b6 = None, b7 = None
+    cdef double *p_srsq_blip = NULL
+    cdef double *p_duration_blip = NULL
+    cdef double *p_depth_blip = NULL
+    cdef double *p_midtime_blip = NULL
+
+    # The range of event durations, in bins, is the same for every segment.
+    nbins_min_dur = max(np.floor(mindur / segsize * nbins), 1)
+    nbins_max_dur = np.ceil(maxdur / segsize * nbins)
+
+    b0, b1, b2, b3 = buffers[:4]
     if direction == 2:
-        srsq_dip = np.empty((nsegments,nbins), dtype='float64')
-        duration_dip = np.empty((nsegments,nbins), dtype='float64')
-        depth_dip = np.empty((nsegments,nbins), dtype='float64')
-        midtime_dip = np.empty((nsegments,nbins), dtype='float64')
-        srsq_blip = np.empty((nsegments,nbins), dtype='float64')
-        duration_blip = np.empty((nsegments,nbins), dtype='float64')
-        depth_blip = np.empty((nsegments,nbins), dtype='float64')
-        midtime_blip = np.empty((nsegments,nbins), dtype='float64')
+        b4, b5, b6, b7 = buffers[4:8]
+        p_srsq_blip = &b4[0]
+        p_duration_blip = &b5[0]
+        p_depth_blip = &b6[0]
+        p_midtime_blip = &b7[0]
+
+    # Call the algorithm on all of the segments at once. The outputs are
+    # initialized inside the external function.
+    if flux.dtype == np.float32:
+        flux32 = np.ascontiguousarray(flux, dtype='float32')
+        fluxerr32 = np.ascontiguousarray(fluxerr, dtype='float32')
+        samples32 = np.ascontiguousarray(samples, dtype='float32')
+
+        with nogil:
+            status = do_bls_pulse_single(&time[0], &flux32[0], &fluxerr32[0],
+                &samples32[0], nbins, nsegments, nbins_min_dur, nbins_max_dur,
+                direction, kernel, nthreads, &b0[0], &b1[0], &b2[0], &b3[0],
+                p_srsq_blip, p_duration_blip, p_depth_blip, p_midtime_blip)
     else:
-        srsq = np.empty((nsegments,nbins), dtype='float64')
-        duration = np.empty((nsegments,nbins), dtype='float64')
-        depth = np.empty((nsegments,nbins), dtype='float64')
-        midtime = np.empty((nsegments,nbins), dtype='float64')
-
-    for i in xrange(nsegments):
-        # Set up a view for each segment.
-        ndx = i * nbins
-        stime = time[ndx:ndx+nbins]
-        sflux = flux[ndx:ndx+nbins]
-        sfluxerr = fluxerr[ndx:ndx+nbins]
-        ssamples = samples[ndx:ndx+nbins]
-
-        # Call the algorithm.
-        if direction == 2:
-            __bls_pulse_binned_compound(stime, sflux, sfluxerr, ssamples, segsize, mindur,
-                maxdur, srsq_dip[i,:], duration_dip[i,:], depth_dip[i,:], midtime_dip[i,:],
-                srsq_blip[i,:], duration_blip[i,:], depth_blip[i,:], midtime_blip[i,:])
-        else:
-            __bls_pulse_binned(stime, sflux, sfluxerr, ssamples, segsize, mindur, maxdur,
-                direction, srsq[i,:], duration[i,:], depth[i,:], midtime[i,:])
+        flux64 = np.ascontiguousarray(flux, dtype='float64')
+        fluxerr64 = np.ascontiguousarray(fluxerr, dtype='float64')
+        samples64 = np.ascontiguousarray(samples, dtype='float64')
+
+        with nogil:
+            status = do_bls_pulse(&time[0], &flux64[0], &fluxerr64[0],
+                &samples64[0], nbins, nsegments, nbins_min_dur, nbins_max_dur,
+                direction, kernel, nthreads, &b0[0], &b1[0], &b2[0], &b3[0],
+                p_srsq_blip, p_duration_blip, p_depth_blip, p_midtime_blip)
 
-    # Fix the time offset (subtracted off earlier).
-    time += t
+    if status != 0:
+        raise MemoryError('Could not allocate the BLS pulse workspace.')
 
     if direction == 2:
-        midtime_dip += t
-        midtime_blip += t
-
-        # Maximize over the bin axis.
-        ndx1 = np.nanargmax(srsq_dip, axis=1)
-        ind1 = np.indices(ndx1.shape)
-        ndx2 = np.nanargmax(srsq_blip, axis=1)
-        ind2 = np.indices(ndx2.shape)
-
-        return dict(srsq_dip=srsq_dip[ind1,ndx1].ravel(),
-            duration_dip=duration_dip[ind1,ndx1].ravel(),
-            depth_dip=depth_dip[ind1,ndx1].ravel(),
-            midtime_dip=midtime_dip[ind1,ndx1].ravel(),
-            srsq_blip=srsq_blip[ind2,ndx2].ravel(),
-            duration_blip=duration_blip[ind2,ndx2].ravel(),
-            depth_blip=depth_blip[ind2,ndx2].ravel(),
-            midtime_blip=midtime_blip[ind2,ndx2].ravel())
+        groups = [('_dip', buffers[0:4]), ('_blip', buffers[4:8])]
     else:
-        midtime += t
+        groups = [('', buffers[0:4])]
 
-        # Maximize over the bin axis.
+    # Maximize over the bin axis.
+    out = dict()
+    for name, (srsq, duration, depth, midtime) in groups:
+        srsq = srsq[:nsegments*nbins].reshape((nsegments,nbins))
         ndx = np.nanargmax(srsq, axis=1)
-        ind = np.indices(ndx.shape)
+        ind = np.arange(nsegments)
 
-        return dict(srsq=srsq[ind,ndx].ravel(),
-            duration=duration[ind,ndx].ravel(),
-            depth=depth[ind,ndx].ravel(),
-            midtime=midtime[ind,ndx].ravel())
+        out['srsq' + name] = srsq[ind,ndx]
+        for key, values in (('duration', duration), ('depth', depth),
+        ('midtime', midtime)):
+            out[key + name] = values[:nsegments*nbins].reshape(
+                (nsegments,nbins))[ind,ndx]
+
+    return out
 
 
 @cython.boundscheck(False)
@@ -114,11 +353,27 @@ double maxdur, direction=0):
 @cython.embedsignature(True)
 def bin_and_detrend(np.ndarray[double, ndim=1, mode='c'] time,
 np.ndarray[double, ndim=1, mode='c'] flux, np.ndarray[double, ndim=1, mode='c'] fluxerr,
-int nbins, double segsize, int detrend_order=3, int maxgap=100):
+int nbins, double segsize, int detrend_order=3, int maxgap=100, state=None,
+dtype='float64'):
     '''
     Bin and detrend a full dataset (time, flux, and error). Binning takes place
     in O(N) time; time to detrend will scale with both N and `detrend_order`.
 
+    If a `state` dictionary is given, the binned data and the detrending fits
+    are kept in it. A later call with the same times and settings and the same
+    `state` only bins again the segments holding fluxes or errors that have
+    changed (such as the points masked by ``clean_signal``), and only refits
+    the detrending windows that reach those bins; the results are the same as
+    those of a full call. The indices of the segments whose output changed
+    since the previous call (all of them, on the first call) are stored in
+    ``state['changed']``.
+
+    With `dtype` set to ``'float32'``, the binned and detrended fluxes, errors,
+    and sample counts are returned in single precision, which halves the
+    memory they take and the data ``bls_pulse`` reads. The binning and
+    detrending are still done in double precision, and the times are always
+    returned in double precision.
+
     :param time: Array of observation times
     :type time: np.ndarray
     :param flux: Array of fluxes observed at `times`
@@ -131,53 +386,87 @@ int nbins, double segsize, int detrend_order=3, int maxgap=100):
     :type segsize: float
     :param detrend_order: Order of the polynomial to fit for detrending
     :type detrend_order: int
+    :param maxgap: Number of empty bins that ends a run of detrended data
+    :type maxgap: int
+    :param state: Dictionary for the intermediate results kept between calls
+    :type state: dict
+    :param dtype: Data type of the returned fluxes, errors, and sample counts,
+        ``'float64'`` or ``'float32'``
+    :type dtype: str
     '''
     cdef double start, end, t
     cdef int nsamples, nsegments, save, i, j
-    cdef int gapcount, ingap, dstart_, dend_, x, y, w, z
     cdef np.ndarray[double, ndim=1, mode='c'] btime, bflux, bfluxerr, bsamples
-    cdef np.ndarray[double, ndim=1, mode='c'] dflux, dfluxerr, trend
+    cdef np.ndarray[double, ndim=1, mode='c'] dflux, dfluxerr
     cdef np.ndarray[double, ndim=1, mode='c'] stime, sflux, sfluxerr, ssamples
-    cdef np.ndarray[double, ndim=1, mode='c'] stime_extend, sflux_extend, sfluxerr_extend
     cdef np.ndarray[double, ndim=1, mode='c'] segstart, segend
+    cdef np.ndarray[long, ndim=1, mode='c'] first
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float64, np.float32):
+        raise ValueError('Invalid data type: %s' % dtype)
 
+    # Work on zero-based times; the caller's array is left as it is.
     t = np.nanmin(time)
-    time -= t
+    time = time - t
 
     nsamples = np.size(time)
     nsegments = int(np.floor(np.nanmax(time) / segsize) + 1)
-    save = 0
-
-    # Arrays for the binned data and sample counts
-    btime = np.zeros((nsegments*nbins,), dtype='float64')
-    bflux = np.zeros((nsegments*nbins,), dtype='float64')
-    bfluxerr = np.zeros((nsegments*nbins,), dtype='float64')
-    bsamples = np.zeros((nsegments*nbins,), dtype='float64')
-
-    # Arrays for the detrended data. Note that we don't change the time
-    # axis when we detrend, so there is no need for a `dtime` array.
-    dflux = np.empty((nsegments*nbins,), dtype='float64')
-    dfluxerr = np.empty((nsegments*nbins,), dtype='float64')
-    dflux[:] = np.nan
-    dfluxerr[:] = np.nan
-
-    # Array to store detrending coefficients.
-    coeffs = np.empty((nsegments,detrend_order+1), dtype='float64')
+    settings = (nsamples, nbins, segsize, detrend_order, maxgap)
+
+    if state is not None and state.get('settings') == settings and \
+    np.array_equal(state['time'], time):
+        # Start from the binned data of the previous call, and bin again
+        # only the segments that hold changed points. `first` holds the
+        # index of the first point of each segment.
+        first = state['first']
+        changed = (flux.view('int64') != state['flux'].view('int64')) | \
+            (fluxerr.view('int64') != state['fluxerr'].view('int64'))
+        segments = np.unique(np.searchsorted(first, np.flatnonzero(changed),
+            side='right') - 1)
+
+        btime = state['btime'].copy()
+        bflux = state['bflux'].copy()
+        bfluxerr = state['bfluxerr'].copy()
+        bsamples = state['bsamples'].copy()
+        segstart = state['segstart'].copy()
+        segend = state['segend'].copy()
+        previous = state
+    else:
+        # Arrays for the binned data and sample counts
+        btime = np.zeros((nsegments*nbins,), dtype='float64')
+        bflux = np.zeros((nsegments*nbins,), dtype='float64')
+        bfluxerr = np.zeros((nsegments*nbins,), dtype='float64')
+        bsamples = np.zeros((nsegments*nbins,), dtype='float64')
+
+        # Other preallocated arrays; store segment start/end times and the
+        # index of the first point in each segment.
+        segstart = np.empty((nsegments,), dtype='float64')
+        segend = np.empty((nsegments,), dtype='float64')
+        first = np.empty((nsegments,), dtype='int64')
+        segments = xrange(nsegments)
+        previous = None
 
-    # Other preallocated arrays; store segment start/end times and a flag
-    # for segments that should not be used.
-    segstart = np.empty((nsegments,), dtype='float64')
-    segend = np.empty((nsegments,), dtype='float64')
+    save = 0
 
-    for i in xrange(nsegments):
+    for i in segments:
         j = nbins * i
 
+        if previous is None:
+            first[i] = save
+        else:
+            save = first[i]
+
         # Construct views onto the binned arrays. These will contain the binned
         # times, fluxes, errors, and sample counts for this segment alone.
         stime = btime[j:j+nbins]
         sflux = bflux[j:j+nbins]
         sfluxerr = bfluxerr[j:j+nbins]
         ssamples = bsamples[j:j+nbins]
+        stime[:] = 0.
+        sflux[:] = 0.
+        sfluxerr[:] = 0.
+        ssamples[:] = 0.
 
         # Perform the actual binning. This function writes directly to the
         # binned arrays in memory. The variable `save` keeps up with the index
@@ -193,73 +482,219 @@ int nbins, double segsize, int detrend_order=3, int maxgap=100):
         segstart[i] = start + t
         segend[i] = end + t
 
+    if previous is not None:
+        # The bins whose binned values have changed.
+        ndx = (np.asarray(segments, dtype='int64')[:,None] * nbins +
+            np.arange(nbins)[None,:]).ravel()
+        diff = (btime[ndx].view('int64') != previous['btime'][ndx].view('int64')) | \
+            (bflux[ndx].view('int64') != previous['bflux'][ndx].view('int64')) | \
+            (bfluxerr[ndx].view('int64') != previous['bfluxerr'][ndx].view('int64'))
+        changed = ndx[diff]
+    else:
+        changed = None
+
     if detrend_order == 0:
         # No detrending required; return the binned arrays instead.
-        return btime, bflux, bfluxerr, bsamples, segstart, segend
-
-    # Initialize these parameters reasonably; they will all be overwritten
-    # in the loop, but initializing `gapcount` to 0 is very important!
-    ingap = True
-    gapcount = 0
-    dstart_ = 0
-    dend_ = 0
-
-    for i in xrange(nsegments*nbins):
-        if np.isnan(bflux[i]):
-            gapcount += 1
-        else:
-            gapcount = 0
-
-            if ingap:
-                ingap = False
-                dstart_ = i
-            else:
-                dend_ = i
-
-        if gapcount > maxgap and not ingap and dstart_ < dend_:
-            # We have reached a gap, so the data between `dstart_` and `dend_`
-            # should be valid.
-            ingap = True
-
-            try:
-                ns = int(np.floor((np.nanmax(btime[dstart_:dend_]) -
-                    np.nanmin(btime[dstart_:dend_])) / segsize) + 1)
-            except ValueError:
-                raise ValueError(' '.join([str(btime[dstart_:dend_]), str(dstart_), str(dend_)]))
-
-            for j in xrange(ns):
-                x = max(dstart_, dstart_ + (j - 1) * nbins)
-                y = min(dend_, dstart_ + (j + 2) * nbins) + 1
-                stime_extend = btime[x:y]
-                sflux_extend = bflux[x:y]
-                sfluxerr_extend = bfluxerr[x:y]
-
-                w = dstart_ + j * nbins
-                z = min(dend_, dstart_ + (j + 1) * nbins) + 1
-
-                ndx = np.where(np.isfinite(bflux[w:z]))[0]
-
-                if len(ndx) <= detrend_order + 1 and detrend_order != 0:
-                    dflux[w:z] = np.nan
-                    dfluxerr[w:z] = np.nan
-                    continue
-
-                ndx = np.where(np.isfinite(sflux_extend))[0]
-
-                m = np.nanmean(btime[w:z])
-                c = polyfit(stime_extend[ndx] - m, sflux_extend[ndx],
-                    sfluxerr_extend[ndx], detrend_order)
-
-                trend = poly.polyval(btime[w:z] - m, c)
+        dtime = btime
+        dflux = bflux
+        dfluxerr = bfluxerr
+        fits = None
+        touched = changed
+    else:
+        dtime = btime + t
+        dflux, dfluxerr, fits, touched = __detrend(btime, bflux, bfluxerr,
+            nbins, segsize, detrend_order, maxgap, previous, changed)
+
+    if state is None:
+        return dtime, dflux.astype(dtype, copy=False), \
+            dfluxerr.astype(dtype, copy=False), \
+            bsamples.astype(dtype, copy=False), segstart, segend
+
+    # Find the segments whose output changed; only the segments that were
+    # binned again or that hold detrended bins again can have. Then save
+    # everything for the next call. The caller gets copies, so that it cannot
+    # change the state.
+    if previous is None:
+        state['changed'] = np.arange(nsegments)
+    else:
+        segments = np.union1d(segments, touched // nbins).astype('int64')
+        ndx = (segments[:,None] * nbins + np.arange(nbins)[None,:]).ravel()
+        diff = np.zeros((len(ndx),), dtype='bool')
+        for new, old in ((dtime, state['dtime']), (dflux, state['dflux']),
+        (dfluxerr, state['dfluxerr']), (bsamples, state['bsamples'])):
+            diff |= new[ndx].view('int64') != old[ndx].view('int64')
+        state['changed'] = segments[np.any(diff.reshape((len(segments),nbins)),
+            axis=1)]
+
+    state.update(settings=settings, time=time, flux=flux.copy(),
+        fluxerr=fluxerr.copy(), first=first, btime=btime, bflux=bflux,
+        bfluxerr=bfluxerr, bsamples=bsamples, segstart=segstart,
+        segend=segend, fits=fits, dtime=dtime, dflux=dflux,
+        dfluxerr=dfluxerr)
+
+    return dtime.copy(), dflux.astype(dtype), dfluxerr.astype(dtype), \
+        bsamples.astype(dtype), segstart.copy(), segend.copy()
+
+
+def __detrend_windows(btime, bflux, nbins, segsize, maxgap):
+    '''
+    Find the windows in which ``bin_and_detrend`` fits and removes the trend.
+    Returns the start and end (exclusive) bins of the detrended windows and of
+    the fitted windows.
+    '''
+    # Find the runs of valid data, which are separated by gaps of more than
+    # `maxgap` empty bins. A run ends at a non-empty bin followed by such a
+    # gap, as long as it holds at least two non-empty bins; a lone bin
+    # between two gaps starts a run that carries on past the second gap. A
+    # run that is not followed by such a gap is not detrended.
+    filled = np.flatnonzero(~np.isnan(bflux))
+    gaps = np.diff(np.append(filled, len(bflux))) - 1
+
+    runs = []
+    k = 0
+    for i in np.flatnonzero(gaps > maxgap):
+        if i > k:
+            runs.append((filled[k], filled[i]))
+            k = i + 1
+
+    # Each run is detrended one segment at a time, fitting the segment and
+    # its neighbors on either side. `w` to `z` is the detrended window (which
+    # overlaps the next one by a bin) and `x` to `y` the fitted one.
+    w = [np.empty((0,), dtype='int64')]
+    z = [np.empty((0,), dtype='int64')]
+    x = [np.empty((0,), dtype='int64')]
+    y = [np.empty((0,), dtype='int64')]
+    for dstart_, dend_ in runs:
+        try:
+            ns = int(np.floor((np.nanmax(btime[dstart_:dend_]) -
+                np.nanmin(btime[dstart_:dend_])) / segsize) + 1)
+        except ValueError:
+            raise ValueError(' '.join([str(btime[dstart_:dend_]), str(dstart_), str(dend_)]))
+
+        seg = np.arange(ns)
+        x.append(np.maximum(dstart_, dstart_ + (seg - 1) * nbins))
+        y.append(np.minimum(dend_, dstart_ + (seg + 2) * nbins) + 1)
+        w.append(dstart_ + seg * nbins)
+        z.append(np.minimum(dend_, dstart_ + (seg + 1) * nbins) + 1)
+
+    return np.concatenate(w), np.concatenate(z), np.concatenate(x), \
+        np.concatenate(y)
+
+
+def __window_ranges(w, z, keep):
+    '''
+    Returns the bins whose trend may come from the windows flagged in `keep`:
+    each window covers the bins up to the start of the next one, and the last
+    window the bins it reaches.
+    '''
+    if len(w) == 0:
+        return np.empty((0,), dtype='int64')
 
-                dflux[w:z] = bflux[w:z] / trend
-                dflux[w:z] -= 1.
-                dfluxerr[w:z] = bfluxerr[w:z] / trend
+    ends = np.append(w[1:], max(z[-1], w[-1] + 1))[keep]
+    starts = w[keep]
+    lengths = ends - starts
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])),
+        lengths)
+    return offsets + np.arange(np.sum(lengths), dtype='int64')
 
-    time += t
-    btime += t
 
-    return btime, dflux, dfluxerr, bsamples, segstart, segend
+def __detrend(btime, bflux, bfluxerr, nbins, segsize, detrend_order, maxgap,
+previous=None, changed=None):
+    '''
+    Detrend the binned data (with zero-based times) for ``bin_and_detrend``.
+    Returns the detrended flux and error, the windows and fits used, and the
+    bins that were detrended again. If the `previous` state of
+    ``bin_and_detrend`` is given, with the sorted indices of the bins that
+    have `changed` since, the fits of the windows that have not changed are
+    reused and only the bins that they do not cover are detrended again.
+    '''
+    w, z, x, y = __detrend_windows(btime, bflux, nbins, segsize, maxgap)
+
+    # Windows with too few finite fluxes to fit are left as NaN.
+    finite = np.flatnonzero(np.isfinite(bflux))
+    fit = np.searchsorted(finite, np.maximum(z, w)) - \
+        np.searchsorted(finite, w) > detrend_order + 1
+
+    # Each window is centered on the mean time of its detrended bins.
+    filled = np.flatnonzero(~np.isnan(btime))
+    a = np.searchsorted(filled, w)
+    b = np.searchsorted(filled, np.maximum(z, w))
+    if len(w) > 0:
+        sums = np.add.reduceat(np.append(btime[filled], 0.),
+            np.ravel(np.column_stack((a, b))))[::2]
+        sums[a == b] = np.nan
+        centers = sums / (b - a)
+    else:
+        centers = np.empty((0,), dtype='float64')
+
+    coeffs = np.empty((len(w),detrend_order+1), dtype='float64')
+    coeffs[:] = np.nan
+    same = np.zeros((len(w),), dtype='bool')
+
+    if previous is not None and len(w) > 0 and len(previous['fits']['w']) > 0:
+        # A window gets the same fit as before if it has the same bounds and
+        # center, and none of the bins it fits has changed.
+        old = previous['fits']
+        k = np.minimum(np.searchsorted(old['w'], w), len(old['w']) - 1)
+        same = (old['w'][k] == w) & (old['z'][k] == z) & (old['x'][k] == x) & \
+            (old['y'][k] == y) & (old['centers'][k].view('int64') ==
+            centers.view('int64')) & (np.searchsorted(changed, x) ==
+            np.searchsorted(changed, y))
+
+        coeffs[same] = old['coeffs'][k[same]]
+
+    # Fit the remaining windows at once, on the finite bins only.
+    todo = fit & ~same
+    coeffs[todo] = polyfit_windows(btime[finite], bflux[finite],
+        bfluxerr[finite], np.searchsorted(finite, x[todo]),
+        np.searchsorted(finite, y[todo]), centers[todo], detrend_order)
+
+    if previous is None:
+        dflux = np.empty_like(bflux)
+        dfluxerr = np.empty_like(bflux)
+        dflux[:] = np.nan
+        dfluxerr[:] = np.nan
+        ndx = np.flatnonzero(~np.isnan(bflux))
+        touched = None
+    else:
+        # Only the bins that have changed, or that take their trend from a
+        # window that is new or gone, can come out differently; start from
+        # the previous result and detrend those again.
+        dflux = previous['dflux'].copy()
+        dfluxerr = previous['dfluxerr'].copy()
+        old = previous['fits']
+        k = np.searchsorted(w, old['w'])
+        gone = np.ones((len(old['w']),), dtype='bool')
+        gone[k < len(w)] = ~same[k[k < len(w)]] | \
+            (w[k[k < len(w)]] != old['w'][k < len(w)])
+        touched = np.unique(np.concatenate((changed,
+            __window_ranges(w, z, ~same),
+            __window_ranges(old['w'], old['z'], gone))))
+        dflux[touched] = np.nan
+        dfluxerr[touched] = np.nan
+        ndx = touched[~np.isnan(bflux[touched])]
+
+    # The windows are in order and overlap only with their neighbors, so each
+    # bin takes the trend of the last window that starts at or before it, if
+    # that window reaches it.
+    owner = np.searchsorted(w, ndx, side='right') - 1
+    keep = (owner >= 0)
+    keep[keep] &= ndx[keep] < z[owner[keep]]
+    ndx = ndx[keep]
+    owner = owner[keep]
+
+    c = coeffs[owner]
+    s = btime[ndx] - centers[owner]
+    trend = c[:,detrend_order] + s * 0.
+    for k in xrange(detrend_order - 1, -1, -1):
+        trend = c[:,k] + trend * s
+
+    dflux[ndx] = bflux[ndx] / trend
+    dflux[ndx] -= 1.
+    dfluxerr[ndx] = bfluxerr[ndx] / trend
+
+    return dflux, dfluxerr, dict(w=w, z=z, x=x, y=y, centers=centers,
+        coeffs=coeffs), touched
 
 
 @cython.boundscheck(False)
@@ -324,7 +759,7 @@ np.ndarray[double, ndim=1, mode='c'] depth_blip, np.ndarray[double, ndim=1, mode
     midtime_dip[:] = np.nan
     srsq_blip[:] = 0.
     duration_blip[:] = np.nan
-    depth_dip[:] =  np.nan
+    depth_blip[:] =  np.nan
     midtime_blip[:] = np.nan
 
     # the total number of points that were binned
@@ -1,5 +1,8 @@
 #include <math.h>
+#include <float.h>
 #include <stdio.h>
+#include <stdlib.h>
+#include <pthread.h>
 
 #define false           (0)
 #define true            (1)
@@ -7,6 +10,13 @@
 #define min(a,b)        (a < b ? a : b)
 #define max(a,b)        (a > b ? a : b)
 
+/* Upper limit on the number of threads used by `do_bls_pulse`. */
+#define MAX_THREADS     256
+
+/* BLS kernels that `do_bls_pulse` can use. */
+#define KERNEL_SCAN     0
+#define KERNEL_PREFIX   1
+
 
 int do_bin_segment(double *time, double *flux, double *fluxerr, int nbins,
     double segsize, int nsamples, int n, int *ndx, double *stime, double *sflux,
@@ -71,80 +81,181 @@ int do_bin_segment(double *time, double *flux, double *fluxerr, int nbins,
 }
 
 
-int do_bls_pulse_segment(double *time, double *flux, double *fluxerr,
-    double *samples, int nbins, int n, int nbins_min_dur, int nbins_max_dur,
-    int direction, double *srsq, double *duration, double *depth,
-    double *midtime)
+static void bls_pulse_start_bin(double *time, double *flux, double *samples,
+    int nbins, double nn, int nbins_min_dur, int nbins_max_dur, int direction,
+    int i, double *srsq, double *duration, double *depth, double *midtime)
 {
     /**
-     * This function takes an array of time, flux, error, and weights (number of
-     * samples per bin), all of size `nbins`, and writes to the arrays `srsq`,
-     * `duration`, `depth`, and `midtime`, assumed to be pre-allocated and of
-     * the same size. There is no handling of NaN values; they should be
-     * filtered out before calling; this means that `nbins` is actually the
-     * number of non-NaN bins.
+     * Find the best event starting at bin `i` and save its parameters; the
+     * body of the loop over start bins in `do_bls_pulse_segment`.
      */
-
-    int i, j, k, bestdur;
+    int j, k, bestdur;
     double s, r, srsqmax, srsqnew, bestdepth;
-    double nn = (double) n;
 
-    for (i = 0; i < nbins - nbins_min_dur; i++)
+    /* minimum possible value is 0 */
+    srsqmax = 0.;
+    bestdur = i;
+    bestdepth = NAN;
+
+    if (samples[i] == 0.)
+        return;
+
+    s = 0.;
+    r = 0.;
+
+    /* Instead of looping from i to j inside the j loop, we can precompute
+     * this part of the sum, which is independent of j. So we avoid having
+     * three nested loops. */
+    for (k = i; k < i + nbins_min_dur; k++)
+    {
+        if (samples[k] == 0.)
+            continue;
+
+        s += flux[k];
+        r += samples[k];
+    }
+
+    for (j = min(i + nbins_min_dur, nbins);
+        j < min(i + nbins_max_dur + 1, nbins); j++)
     {
-        /* minimum possible value is 0 */
-        srsqmax = 0.;
-        bestdur = i;
-        bestdepth = NAN;
+        /* i and j will always be valid values for i1, i2 as defined in the
+         * algorithm of Kovacs, Zucker, & Mazeh (2002). */
 
-        if (samples[i] == 0.)
+        if (samples[j] == 0.)
             continue;
 
-        s = 0.;
-        r = 0.;
+        s += flux[j];
+        r += samples[j];
 
-        /* Instead of looping from i to j inside the j loop, we can precompute
-         * this part of the sum, which is independent of j. So we avoid having
-         * three nested loops. */
-        for (k = i; k < i + nbins_min_dur; k++)
-        {
-            if (samples[k] == 0.)
-                continue;
+        srsqnew = (s * s) / (r * (nn - r));
 
-            s += flux[k];
-            r += samples[k];
+        if ((srsqnew > srsqmax) &&  (direction * s >= 0) && (r != nn))
+        {
+            /* We found a better event than previously; overwrite the "best"
+             * parameters. */
+            srsqmax = srsqnew;
+            bestdur = j;       /* this is an index, not a time! */
+            bestdepth = (s / r) + (s / (nn - r));
         }
+    }
 
-        for (j = min(i + nbins_min_dur, nbins);
-            j < min(i + nbins_max_dur + 1, nbins); j++)
-        {
-            /* i and j will always be valid values for i1, i2 as defined in the
-             * algorithm of Kovacs, Zucker, & Mazeh (2002). */
+    /* Save the best parameters for events starting at each bin. */
+    srsq[i] = srsqmax;
+    duration[i] = time[bestdur] - time[i];
+    depth[i] = bestdepth;
+    midtime[i] = (time[bestdur] + time[i]) / 2.;
+}
 
-            if (samples[j] == 0.)
-                continue;
 
-            s += flux[j];
-            r += samples[j];
+static void bls_pulse_start_bin_compound(double *time, double *flux,
+    double *samples, int nbins, double nn, int nbins_min_dur,
+    int nbins_max_dur, int i, double *srsq_dip, double *duration_dip,
+    double *depth_dip, double *midtime_dip, double *srsq_blip,
+    double *duration_blip, double *depth_blip, double *midtime_blip)
+{
+    /**
+     * Find the best dip and blip events starting at bin `i` and save their
+     * parameters; the body of the loop over start bins in
+     * `do_bls_pulse_segment_compound`.
+     */
+    int j, k, bestdur_dip, bestdur_blip;
+    double s, r, srsqmax_dip, srsqmax_blip, srsqnew;
+    double bestdepth_dip, bestdepth_blip;
 
-            srsqnew = (s * s) / (r * (nn - r));
+    /* minimum possible value is 0 */
+    srsqmax_dip = 0.;
+    srsqmax_blip = 0.;
+    bestdur_dip = i;
+    bestdur_blip = i;
+    bestdepth_dip = NAN;
+    bestdepth_blip = NAN;
 
-            if ((srsqnew > srsqmax) &&  (direction * s >= 0) && (r != nn))
-            {
-                /* We found a better event than previously; overwrite the "best"
-                 * parameters. */
-                srsqmax = srsqnew;
-                bestdur = j;       /* this is an index, not a time! */
-                bestdepth = (s / r) + (s / (nn - r));
-            }
+    if (samples[i] == 0.)
+        return;
+
+    s = 0.;
+    r = 0.;
+
+    /* Instead of looping from i to j inside the j loop, we can precompute
+     * this part of the sum, which is independent of j. So we avoid having
+     * three nested loops. */
+    for (k = i; k < i + nbins_min_dur; k++)
+    {
+        if (samples[k] == 0.)
+            continue;
+
+        s += flux[k];
+        r += samples[k];
+    }
+
+    for (j = min(i + nbins_min_dur, nbins);
+        j < min(i + nbins_max_dur + 1, nbins); j++)
+    {
+        /* i and j will always be valid values for i1, i2 as defined in the
+         * algorithm of Kovacs, Zucker, & Mazeh (2002). */
+
+        if (samples[j] == 0.)
+            continue;
+
+        s += flux[j];
+        r += samples[j];
+
+        srsqnew = (s * s) / (r * (nn - r));
+
+        if ((srsqnew > srsqmax_dip) && (s < 0.) && (r != nn))
+        {
+            /* We found a better dip event than previously; overwrite the
+             * "best" parameters. */
+            srsqmax_dip = srsqnew;
+            bestdur_dip = j;         /* this is an index, not a time! */
+            bestdepth_dip = (s / r) + (s / (nn - r));
         }
 
-        /* Save the best parameters for events starting at each bin. */
-        srsq[i] = srsqmax;
-        duration[i] = time[bestdur] - time[i];
-        depth[i] = bestdepth;
-        midtime[i] = (time[bestdur] + time[i]) / 2.;
+        if ((srsqnew > srsqmax_blip) && (s > 0.) && (r != nn))
+        {
+            /* We found a better blip event than previously; overwrite the
+             * "best" parameters. */
+            srsqmax_blip = srsqnew;
+            bestdur_blip = j;           /* this is an index, not a time! */
+            bestdepth_blip = (s / r) + (s / (nn - r));
+        }
     }
 
+    /* Save the best parameters for dip events starting at each bin. */
+    srsq_dip[i] = srsqmax_dip;
+    duration_dip[i] = time[bestdur_dip] - time[i];
+    depth_dip[i] = bestdepth_dip;
+    midtime_dip[i] = (time[bestdur_dip] + time[i]) / 2.;
+
+    /* Save the best parameters for blip events starting at each bin. */
+    srsq_blip[i] = srsqmax_blip;
+    duration_blip[i] = time[bestdur_blip] - time[i];
+    depth_blip[i] = bestdepth_blip;
+    midtime_blip[i] = (time[bestdur_blip] + time[i]) / 2.;
+}
+
+
+int do_bls_pulse_segment(double *time, double *flux, double *fluxerr,
+    double *samples, int nbins, int n, int nbins_min_dur, int nbins_max_dur,
+    int direction, double *srsq, double *duration, double *depth,
+    double *midtime)
+{
+    /**
+     * This function takes an array of time, flux, error, and weights (number of
+     * samples per bin), all of size `nbins`, and writes to the arrays `srsq`,
+     * `duration`, `depth`, and `midtime`, assumed to be pre-allocated and of
+     * the same size. There is no handling of NaN values; they should be
+     * filtered out before calling; this means that `nbins` is actually the
+     * number of non-NaN bins.
+     */
+
+    int i;
+    double nn = (double) n;
+
+    for (i = 0; i < nbins - nbins_min_dur; i++)
+        bls_pulse_start_bin(time, flux, samples, nbins, nn, nbins_min_dur,
+            nbins_max_dur, direction, i, srsq, duration, depth, midtime);
+
     return 0;
 }
 
@@ -164,85 +275,615 @@ int do_bls_pulse_segment_compound(double *time, double *flux, double *fluxerr,
      * number of non-NaN bins.
      */
 
-    int i, j, k, bestdur_dip, bestdur_blip;
-    double s, r, srsqmax_dip, srsqmax_blip, srsqnew;
-    double bestdepth_dip, bestdepth_blip;
+    int i;
     double nn = (double) n;
 
     for (i = 0; i < nbins - nbins_min_dur; i++)
+        bls_pulse_start_bin_compound(time, flux, samples, nbins, nn,
+            nbins_min_dur, nbins_max_dur, i, srsq_dip, duration_dip,
+            depth_dip, midtime_dip, srsq_blip, duration_blip, depth_blip,
+            midtime_blip);
+
+    return 0;
+}
+
+
+static void bls_pulse_start_bin_sparse(double *time, double *flux,
+    double *samples, int *idx, int nf, int nbins, double nn,
+    int nbins_min_dur, int nbins_max_dur, int direction, int p, double *srsq,
+    double *duration, double *depth, double *midtime)
+{
+    /**
+     * Same as `bls_pulse_start_bin` for start bin `idx[p]`, but only visits
+     * the `nf` non-empty bins, whose indices are listed in `idx`. The empty
+     * bins add nothing to the sums, so the results are bit-identical.
+     */
+    int i = idx[p], q, bestdur;
+    double s, r, srsqmax, srsqnew, bestdepth;
+
+    srsqmax = 0.;
+    bestdur = i;
+    bestdepth = NAN;
+
+    s = 0.;
+    r = 0.;
+
+    for (q = p; q < nf && idx[q] < i + nbins_min_dur; q++)
+    {
+        s += flux[idx[q]];
+        r += samples[idx[q]];
+    }
+
+    for (; q < nf && idx[q] < min(i + nbins_max_dur + 1, nbins); q++)
+    {
+        s += flux[idx[q]];
+        r += samples[idx[q]];
+
+        srsqnew = (s * s) / (r * (nn - r));
+
+        if ((srsqnew > srsqmax) &&  (direction * s >= 0) && (r != nn))
+        {
+            srsqmax = srsqnew;
+            bestdur = idx[q];
+            bestdepth = (s / r) + (s / (nn - r));
+        }
+    }
+
+    srsq[i] = srsqmax;
+    duration[i] = time[bestdur] - time[i];
+    depth[i] = bestdepth;
+    midtime[i] = (time[bestdur] + time[i]) / 2.;
+}
+
+
+static void bls_pulse_start_bin_sparse_compound(double *time, double *flux,
+    double *samples, int *idx, int nf, int nbins, double nn,
+    int nbins_min_dur, int nbins_max_dur, int p, double *srsq_dip,
+    double *duration_dip, double *depth_dip, double *midtime_dip,
+    double *srsq_blip, double *duration_blip, double *depth_blip,
+    double *midtime_blip)
+{
+    /**
+     * Same as `bls_pulse_start_bin_compound` for start bin `idx[p]`, but only
+     * visits the `nf` non-empty bins, whose indices are listed in `idx`.
+     */
+    int i = idx[p], q, bestdur_dip, bestdur_blip;
+    double s, r, srsqmax_dip, srsqmax_blip, srsqnew;
+    double bestdepth_dip, bestdepth_blip;
+
+    srsqmax_dip = 0.;
+    srsqmax_blip = 0.;
+    bestdur_dip = i;
+    bestdur_blip = i;
+    bestdepth_dip = NAN;
+    bestdepth_blip = NAN;
+
+    s = 0.;
+    r = 0.;
+
+    for (q = p; q < nf && idx[q] < i + nbins_min_dur; q++)
+    {
+        s += flux[idx[q]];
+        r += samples[idx[q]];
+    }
+
+    for (; q < nf && idx[q] < min(i + nbins_max_dur + 1, nbins); q++)
+    {
+        s += flux[idx[q]];
+        r += samples[idx[q]];
+
+        srsqnew = (s * s) / (r * (nn - r));
+
+        if ((srsqnew > srsqmax_dip) && (s < 0.) && (r != nn))
+        {
+            srsqmax_dip = srsqnew;
+            bestdur_dip = idx[q];
+            bestdepth_dip = (s / r) + (s / (nn - r));
+        }
+
+        if ((srsqnew > srsqmax_blip) && (s > 0.) && (r != nn))
+        {
+            srsqmax_blip = srsqnew;
+            bestdur_blip = idx[q];
+            bestdepth_blip = (s / r) + (s / (nn - r));
+        }
+    }
+
+    srsq_dip[i] = srsqmax_dip;
+    duration_dip[i] = time[bestdur_dip] - time[i];
+    depth_dip[i] = bestdepth_dip;
+    midtime_dip[i] = (time[bestdur_dip] + time[i]) / 2.;
+
+    srsq_blip[i] = srsqmax_blip;
+    duration_blip[i] = time[bestdur_blip] - time[i];
+    depth_blip[i] = bestdepth_blip;
+    midtime_blip[i] = (time[bestdur_blip] + time[i]) / 2.;
+}
+
+
+int prefix_work_size(int nbins)
+{
+    /**
+     * Number of doubles of workspace needed by `do_bls_pulse_segment_prefix`
+     * for segments of `nbins` bins.
+     */
+    int levels = 1;
+
+    while ((1 << levels) <= nbins + 1)
+        levels++;
+
+    /* Cumulative sums, bounds, three integer arrays (which fit in 2 * nbins
+     * + 4 doubles), and the sparse tables. */
+    return 2 * (nbins + 1) + 2 * nbins + (2 * nbins + 4) +
+        2 * levels * (nbins + 1);
+}
+
+
+int do_bls_pulse_segment_prefix(double *time, double *flux, double *fluxerr,
+    double *samples, int nbins, int n, int nbins_min_dur, int nbins_max_dur,
+    int direction, double *srsq, double *duration, double *depth,
+    double *midtime, double *srsq_blip, double *duration_blip,
+    double *depth_blip, double *midtime_blip, double *work)
+{
+    /**
+     * Same as `do_bls_pulse_segment` (or, if `direction` is 2,
+     * `do_bls_pulse_segment_compound`, with the dip results in `srsq` etc.),
+     * but skips the start bins that cannot hold the best event of the
+     * segment. The outputs must be initialized by the caller; skipped bins
+     * keep their initial values. Every bin that is not skipped goes through
+     * the same additions as in the full scan, so the best event of the
+     * segment, which is all `bls_pulse` keeps, is bit-identical.
+     *
+     * Only the non-empty bins are visited. Cumulative sums of their flux and
+     * sample counts give, for any range of end bins, the range of the event
+     * sum s and the smallest value of r * (n - r); together these bound SR^2
+     * for every event starting at a bin. The end bins are split into blocks
+     * whose length grows with the duration, so the bound stays tight for
+     * short events, where r changes quickly. The bounds carry a margin for
+     * the difference between the cumulative and running sums, so a bin is
+     * only skipped if its best event is certainly worse than one already
+     * found. `work` must hold `prefix_work_size(nbins)` doubles.
+     */
+
+    int i, j, k, m, p, q, d, len, levels, nf, nstart, npstart, qa, qb;
+    int seed[2], *idx, *cnt, *lg;
+    int has_dip = (direction == 2 || direction == -1 || direction == 0);
+    int has_blip = (direction == 2 || direction == 1 || direction == 0);
+    double nn = (double) n;
+    double total, margin, udip, ublip, best_dip, best_blip, x, y;
+    double rs, re, rr, sdip, sblip, *tmax, *tmin;
+    double *psum = work;
+    double *rsum = psum + (nbins + 1);
+    double *bound_dip = rsum + (nbins + 1);
+    double *bound_blip = bound_dip + nbins;
+    double *table = bound_blip + nbins + (2 * nbins + 4);
+
+    idx = (int *) (bound_blip + nbins);
+    cnt = idx + nbins;
+    lg = cnt + (nbins + 1);
+
+    nstart = nbins - nbins_min_dur;
+    if (nstart <= 0)
+        return 0;
+
+    /* List the non-empty bins, and take the cumulative sums over them;
+     * cnt[j] is the number of non-empty bins before bin j. */
+    nf = 0;
+    psum[0] = 0.;
+    rsum[0] = 0.;
+    total = 0.;
+    for (j = 0; j < nbins; j++)
     {
-        /* minimum possible value is 0 */
-        srsqmax_dip = 0.;
-        srsqmax_blip = 0.;
-        bestdur_dip = i;
-        bestdur_blip = i;
-        bestdepth_dip = NAN;
-        bestdepth_blip = NAN;
+        cnt[j] = nf;
 
-        if (samples[i] == 0.)
+        if (samples[j] == 0.)
             continue;
 
-        s = 0.;
-        r = 0.;
+        idx[nf] = j;
+        psum[nf+1] = psum[nf] + flux[j];
+        rsum[nf+1] = rsum[nf] + samples[j];
+        total += fabs(flux[j]);
+        nf++;
+    }
+    cnt[nbins] = nf;
+
+    if (!isfinite(total))
+    {
+        /* NaN or infinite fluxes poison the running sums in ways that the
+         * bounds cannot follow; just scan the whole segment. */
+        if (direction == 2)
+            return do_bls_pulse_segment_compound(time, flux, fluxerr,
+                samples, nbins, n, nbins_min_dur, nbins_max_dur, srsq,
+                duration, depth, midtime, srsq_blip, duration_blip,
+                depth_blip, midtime_blip);
+        else
+            return do_bls_pulse_segment(time, flux, fluxerr, samples, nbins,
+                n, nbins_min_dur, nbins_max_dur, direction, srsq, duration,
+                depth, midtime);
+    }
+
+    /* Rounding error of a running or cumulative sum of at most `nf` terms
+     * is below nf * eps * sum(|flux|); allow for both, twice. */
+    margin = 4. * (nf + 2) * DBL_EPSILON * total;
+
+    /* Sparse tables of the maximum (first `levels` rows) and minimum (next
+     * `levels` rows) of the nf + 1 cumulative flux sums; row m holds the
+     * extremum of each run of 2^m sums, and lg[l] is the row for a run of
+     * length l. */
+    levels = 1;
+    while ((1 << levels) <= nf + 1)
+        levels++;
+
+    tmax = table;
+    tmin = table + levels * (nf + 1);
+
+    for (q = 0; q <= nf; q++)
+        tmax[q] = tmin[q] = psum[q];
 
-        /* Instead of looping from i to j inside the j loop, we can precompute
-         * this part of the sum, which is independent of j. So we avoid having
-         * three nested loops. */
-        for (k = i; k < i + nbins_min_dur; k++)
+    lg[0] = lg[1] = 0;
+    for (q = 2; q <= nf + 1; q++)
+        lg[q] = lg[q/2] + 1;
+
+    for (m = 1; m < levels; m++)
+    {
+        for (q = 0; q + (1 << m) <= nf + 1; q++)
         {
-            if (samples[k] == 0.)
-                continue;
+            x = tmax[(m - 1) * (nf + 1) + q];
+            y = tmax[(m - 1) * (nf + 1) + q + (1 << (m - 1))];
+            tmax[m * (nf + 1) + q] = max(x, y);
 
-            s += flux[k];
-            r += samples[k];
+            x = tmin[(m - 1) * (nf + 1) + q];
+            y = tmin[(m - 1) * (nf + 1) + q + (1 << (m - 1))];
+            tmin[m * (nf + 1) + q] = min(x, y);
         }
+    }
+
+    /* Bound SR^2 for each non-empty start bin, one block of end bins at a
+     * time. The events ending in bins a to b, inclusive, end at non-empty
+     * bins qa to qb, and their sums s are psum[q+1] - psum[p]. */
+    npstart = cnt[nstart];
+
+    for (p = 0; p < npstart; p++)
+    {
+        bound_dip[p] = 0.;
+        bound_blip[p] = 0.;
+    }
 
-        for (j = min(i + nbins_min_dur, nbins);
-            j < min(i + nbins_max_dur + 1, nbins); j++)
+    for (d = nbins_min_dur; d <= nbins_max_dur && d < nbins; d += len)
+    {
+        len = min(max(1, d >> 2), nbins_max_dur - d + 1);
+
+        for (p = 0; p < npstart && idx[p] + d < nbins; p++)
         {
-            /* i and j will always be valid values for i1, i2 as defined in the
-             * algorithm of Kovacs, Zucker, & Mazeh (2002). */
+            i = idx[p];
+            qa = cnt[i + d];
+            qb = cnt[min(i + d + len, nbins)] - 1;
 
-            if (samples[j] == 0.)
+            if (qa > qb)
                 continue;
 
-            s += flux[j];
-            r += samples[j];
+            m = lg[qb - qa + 1];
+            k = qb + 2 - (1 << m);
+            x = max(tmax[m * (nf + 1) + qa + 1], tmax[m * (nf + 1) + k]);
+            y = min(tmin[m * (nf + 1) + qa + 1], tmin[m * (nf + 1) + k]);
+            x -= psum[p];
+            y -= psum[p];
+
+            /* r only grows with the end bin and r * (n - r) is concave, so
+             * its smallest value is at one end of the block. r >= 1, since
+             * the start bin is not empty. */
+            rs = rsum[qa+1] - rsum[p];
+            re = rsum[qb+1] - rsum[p];
+            rr = min(rs * (nn - rs), re * (nn - re));
+
+            /* An event covering every sample is never accepted, but don't
+             * try to bound it. */
+            sdip = max(-y, 0.) + margin;
+            sblip = max(x, 0.) + margin;
+            x = (rr > 0.) ? sdip * sdip * ((1. + 1e-9) / rr) : INFINITY;
+            y = (rr > 0.) ? sblip * sblip * ((1. + 1e-9) / rr) : INFINITY;
+            bound_dip[p] = max(bound_dip[p], x);
+            bound_blip[p] = max(bound_blip[p], y);
+        }
+    }
+
+    seed[0] = seed[1] = -1;
+    udip = ublip = -1.;
+
+    for (p = 0; p < npstart; p++)
+    {
+        if (direction == 0)
+            bound_dip[p] = bound_blip[p] = max(bound_dip[p], bound_blip[p]);
+        else if (direction == 1)
+            bound_dip[p] = -1.;
+        else if (direction == -1)
+            bound_blip[p] = -1.;
+
+        if (bound_dip[p] > udip)
+        {
+            udip = bound_dip[p];
+            seed[0] = p;
+        }
+
+        if (bound_blip[p] > ublip)
+        {
+            ublip = bound_blip[p];
+            seed[1] = p;
+        }
+    }
+
+    /* Evaluate the most promising start bins first to get good thresholds,
+     * then every bin whose bound is not below the best event so far. A bin's
+     * bounds are set to -1 once it has been evaluated. */
+    best_dip = 0.;
+    best_blip = 0.;
+
+    for (k = -2; k < npstart; k++)
+    {
+        p = (k < 0) ? seed[k+2] : k;
+
+        if (p < 0 || ((!has_dip || bound_dip[p] < best_dip) &&
+            (!has_blip || bound_blip[p] < best_blip)))
+            continue;
+
+        i = idx[p];
+
+        if (direction == 2)
+        {
+            bls_pulse_start_bin_sparse_compound(time, flux, samples, idx, nf,
+                nbins, nn, nbins_min_dur, nbins_max_dur, p, srsq, duration,
+                depth, midtime, srsq_blip, duration_blip, depth_blip,
+                midtime_blip);
+
+            best_dip = max(best_dip, srsq[i]);
+            best_blip = max(best_blip, srsq_blip[i]);
+        }
+        else
+        {
+            bls_pulse_start_bin_sparse(time, flux, samples, idx, nf, nbins,
+                nn, nbins_min_dur, nbins_max_dur, direction, p, srsq,
+                duration, depth, midtime);
+
+            best_dip = best_blip = max(best_dip, srsq[i]);
+        }
+
+        bound_dip[p] = bound_blip[p] = -1.;
+    }
+
+    return 0;
+}
 
-            srsqnew = (s * s) / (r * (nn - r));
 
-            if ((srsqnew > srsqmax_dip) && (s < 0.) && (r != nn))
+
+
+/* Arguments shared by the threads of `do_bls_pulse`; see that function. The
+ * single-precision inputs of `do_bls_pulse_single` are used instead of
+ * `flux`, `fluxerr`, and `samples` if they are not NULL. */
+typedef struct
+{
+    double *time, *flux, *fluxerr, *samples;
+    float *flux32, *fluxerr32, *samples32;
+    int nbins, nsegments, nbins_min_dur, nbins_max_dur, direction, nthreads;
+    int kernel;
+    double *srsq, *duration, *depth, *midtime;
+    double *srsq_blip, *duration_blip, *depth_blip, *midtime_blip;
+} bls_pulse_args;
+
+typedef struct
+{
+    bls_pulse_args *args;
+    int thread;
+} bls_pulse_task;
+
+
+static void *bls_pulse_worker(void *ptr)
+{
+    /**
+     * Run BLS pulse on every `nthreads`-th segment, starting with segment
+     * `thread`. Interleaving the segments (rather than giving each thread a
+     * contiguous block) spreads the data gaps, which are cheap, evenly over
+     * the threads.
+     */
+    bls_pulse_task *task = (bls_pulse_task *) ptr;
+    bls_pulse_args *a = task->args;
+    int i, k, m, n;
+    double nn;
+    double *work = NULL, *stage = NULL;
+    double *flux, *fluxerr, *samples;
+
+    /* Each thread has its own workspace for the prefix kernel. If it cannot
+     * be allocated, the full scan gives the same results. */
+    if (a->kernel == KERNEL_PREFIX)
+        work = (double *) malloc(sizeof(double) * prefix_work_size(a->nbins));
+
+    /* Single-precision segments are widened into a workspace of their own,
+     * so that the kernels (and their sums) work in double precision. */
+    if (a->flux32 != NULL)
+    {
+        stage = (double *) malloc(sizeof(double) * 3 * a->nbins);
+        if (stage == NULL)
+        {
+            free(work);
+            return (void *) task;
+        }
+    }
+
+    for (i = task->thread; i < a->nsegments; i += a->nthreads)
+    {
+        m = i * a->nbins;
+
+        if (stage != NULL)
+        {
+            flux = stage;
+            fluxerr = stage + a->nbins;
+            samples = stage + 2 * a->nbins;
+
+            for (k = 0; k < a->nbins; k++)
             {
-                /* We found a better dip event than previously; overwrite the
-                 * "best" parameters. */
-                srsqmax_dip = srsqnew;
-                bestdur_dip = j;         /* this is an index, not a time! */
-                bestdepth_dip = (s / r) + (s / (nn - r));
+                flux[k] = (double) a->flux32[m+k];
+                fluxerr[k] = (double) a->fluxerr32[m+k];
+                samples[k] = (double) a->samples32[m+k];
             }
+        }
+        else
+        {
+            flux = a->flux + m;
+            fluxerr = a->fluxerr + m;
+            samples = a->samples + m;
+        }
+
+        /* Initialize the outputs; bins that cannot start an event keep these
+         * values. */
+        for (k = m; k < m + a->nbins; k++)
+        {
+            a->srsq[k] = 0.;
+            a->duration[k] = NAN;
+            a->depth[k] = NAN;
+            a->midtime[k] = NAN;
 
-            if ((srsqnew > srsqmax_blip) && (s > 0.) && (r != nn))
+            if (a->direction == 2)
             {
-                /* We found a better blip event than previously; overwrite the
-                 * "best" parameters. */
-                srsqmax_blip = srsqnew;
-                bestdur_blip = j;           /* this is an index, not a time! */
-                bestdepth_blip = (s / r) + (s / (nn - r));
+                a->srsq_blip[k] = 0.;
+                a->duration_blip[k] = NAN;
+                a->depth_blip[k] = NAN;
+                a->midtime_blip[k] = NAN;
             }
         }
 
-        /* Save the best parameters for dip events starting at each bin. */
-        srsq_dip[i] = srsqmax_dip;
-        duration_dip[i] = time[bestdur_dip] - time[i];
-        depth_dip[i] = bestdepth_dip;
-        midtime_dip[i] = (time[bestdur_dip] + time[i]) / 2.;
+        /* The total number of points that were binned in this segment. */
+        nn = 0.;
+        for (k = 0; k < a->nbins; k++)
+            nn += samples[k];
+        n = (int) nn;
 
-        /* Save the best parameters for blip events starting at each bin. */
-        srsq_blip[i] = srsqmax_blip;
-        duration_blip[i] = time[bestdur_blip] - time[i];
-        depth_blip[i] = bestdepth_blip;
-        midtime_blip[i] = (time[bestdur_blip] + time[i]) / 2.;
+        if (work != NULL)
+        {
+            do_bls_pulse_segment_prefix(a->time + m, flux, fluxerr, samples,
+                a->nbins, n, a->nbins_min_dur, a->nbins_max_dur, a->direction,
+                a->srsq + m, a->duration + m, a->depth + m, a->midtime + m,
+                a->direction == 2 ? a->srsq_blip + m : NULL,
+                a->direction == 2 ? a->duration_blip + m : NULL,
+                a->direction == 2 ? a->depth_blip + m : NULL,
+                a->direction == 2 ? a->midtime_blip + m : NULL, work);
+        }
+        else if (a->direction == 2)
+        {
+            do_bls_pulse_segment_compound(a->time + m, flux, fluxerr, samples,
+                a->nbins, n, a->nbins_min_dur, a->nbins_max_dur, a->srsq + m,
+                a->duration + m, a->depth + m, a->midtime + m,
+                a->srsq_blip + m, a->duration_blip + m, a->depth_blip + m,
+                a->midtime_blip + m);
+        }
+        else
+        {
+            do_bls_pulse_segment(a->time + m, flux, fluxerr, samples,
+                a->nbins, n, a->nbins_min_dur, a->nbins_max_dur, a->direction,
+                a->srsq + m, a->duration + m, a->depth + m, a->midtime + m);
+        }
     }
 
-    return 0;
+    free(work);
+    free(stage);
+
+    return NULL;
 }
 
+
+static int run_bls_pulse(bls_pulse_args *args, int nthreads)
+{
+    /**
+     * Split the segments of `args` over up to `nthreads` threads and wait
+     * for all of them. Returns 0, or -1 if a workspace could not be
+     * allocated.
+     */
+    bls_pulse_task tasks[MAX_THREADS];
+    pthread_t threads[MAX_THREADS];
+    int started[MAX_THREADS];
+    int i, status = 0;
+
+    nthreads = max(1, min(min(nthreads, args->nsegments), MAX_THREADS));
+    args->nthreads = nthreads;
+
+    for (i = 0; i < nthreads; i++)
+    {
+        tasks[i].args = args;
+        tasks[i].thread = i;
+        started[i] = false;
+    }
+
+    /* The calling thread takes the first share of the segments itself. */
+    for (i = 1; i < nthreads; i++)
+        started[i] = (pthread_create(&threads[i], NULL, bls_pulse_worker,
+            &tasks[i]) == 0);
+
+    if (bls_pulse_worker(&tasks[0]) != NULL)
+        status = -1;
+
+    for (i = 1; i < nthreads; i++)
+    {
+        void *result = NULL;
+
+        if (started[i])
+            pthread_join(threads[i], &result);
+        else
+            /* Could not start a thread; do its share here instead. */
+            result = bls_pulse_worker(&tasks[i]);
+
+        if (result != NULL)
+            status = -1;
+    }
+
+    return status;
+}
+
+
+int do_bls_pulse(double *time, double *flux, double *fluxerr,
+    double *samples, int nbins, int nsegments, int nbins_min_dur,
+    int nbins_max_dur, int direction, int kernel, int nthreads, double *srsq,
+    double *duration, double *depth, double *midtime, double *srsq_blip,
+    double *duration_blip, double *depth_blip, double *midtime_blip)
+{
+    /**
+     * Run BLS pulse on all `nsegments` segments of a binned lightcurve at
+     * once, using up to `nthreads` threads. The inputs and outputs are
+     * arrays of `nsegments` * `nbins` values, one segment after the other.
+     * If `direction` is 2, `srsq`, `duration`, `depth`, and `midtime` receive
+     * the dip results and the `_blip` arrays the blip results; otherwise the
+     * `_blip` arrays are not used and may be NULL. Each segment is computed
+     * exactly as by `do_bls_pulse_segment` or
+     * `do_bls_pulse_segment_compound`, so the results do not depend on the
+     * number of threads. With `kernel` set to KERNEL_PREFIX, the segments go
+     * through `do_bls_pulse_segment_prefix` instead, which only fills in the
+     * start bins that can hold the best event of each segment. This function
+     * does not touch any Python objects, so it can be called without the
+     * GIL.
+     */
+    bls_pulse_args args = {time, flux, fluxerr, samples, NULL, NULL, NULL,
+        nbins, nsegments, nbins_min_dur, nbins_max_dur, direction, 0, kernel,
+        srsq, duration, depth, midtime, srsq_blip, duration_blip, depth_blip,
+        midtime_blip};
+
+    return run_bls_pulse(&args, nthreads);
+}
+
+
+int do_bls_pulse_single(double *time, float *flux, float *fluxerr,
+    float *samples, int nbins, int nsegments, int nbins_min_dur,
+    int nbins_max_dur, int direction, int kernel, int nthreads, double *srsq,
+    double *duration, double *depth, double *midtime, double *srsq_blip,
+    double *duration_blip, double *depth_blip, double *midtime_blip)
+{
+    /**
+     * Same as `do_bls_pulse`, but with single-precision fluxes, errors, and
+     * sample counts. Each segment is widened to double precision as it is
+     * searched, so the results are those of `do_bls_pulse` on the same values
+     * in double precision, while only half as much binned data is read.
+     * Returns -1 if the workspace for a segment could not be allocated.
+     */
+    bls_pulse_args args = {time, NULL, NULL, NULL, flux, fluxerr, samples,
+        nbins, nsegments, nbins_min_dur, nbins_max_dur, direction, 0, kernel,
+        srsq, duration, depth, midtime, srsq_blip, duration_blip, depth_blip,
+        midtime_blip};
+
+    return run_bls_pulse(&args, nthreads);
+}
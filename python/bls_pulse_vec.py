@@ -1,109 +1,167 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+'''
+BLS_PULSE algorithm in pure NumPy. Every segment is binned at once, and the
+signal residuals of all segments are found together, one event duration at a
+time, so there is no Python loop over segments or bins. This gives the same
+results as ``bls_pulse_cython`` (binning with ``bin_and_detrend`` and no
+detrending) on hosts where the extension has not been built.
+'''
+
 from __future__ import division
-import sys
 import numpy as np
-import pandas as pd
-from collections import OrderedDict
-from PyKE.kepfit import lsqclip
 from utils import setup_logging
 
 # Basic logging configuration.
 logger = setup_logging(__file__)
 
 
-def __reindex_to_matrix(series, matrix):
+def __phase_bin(time, flux, fluxerr, n_bins, segment_size):
     '''
-    Reindexes a series on a 2d matrix of values. Pandas does not support 2d
-    indexing, so we need to flatten the matrix, reindex, and then reshape the
-    result back to 2d.
+    Phase-bin every segment of a zero-based light curve at once. Points with a
+    NaN flux are left out. The points are binned exactly as
+    ``bls_pulse_cython.bin_and_detrend`` does, and summed in the same order, so
+    the binned values are the same.
 
-    :param series: Array to reindex
-    :type series: pandas.Series
-    :param matrix: Reindexing matrix
-    :type matrix: numpy.ndarray
+    :param time: Array of zero-based, sorted times of observations
+    :type time: numpy.ndarray
+    :param flux: Array of fluxes corresponding to times
+    :type flux: numpy.ndarray
+    :param fluxerr: Array of flux errors corresponding to times
+    :type fluxerr: numpy.ndarray
+    :param n_bins: Number of bins in each segment
+    :type n_bins: int
+    :param segment_size: Length of a segment, in days
+    :type segment_size: float
 
-    :rtype: numpy.ndarray
+    :rtype: tuple
     '''
-    return np.array(series.reindex(matrix.flatten())).reshape(matrix.shape)
-
-
-def __compute_signal_residual(binned_segment, matrix, duration,
-n_bins_min_duration, direction):
+    n_segments = int(np.floor(np.nanmax(time) / segment_size) + 1)
+
+    # A point belongs to the first segment whose end is after it.
+    segment = np.floor(time / segment_size)
+    segment[time >= segment * segment_size + segment_size] += 1.
+    segment[time < (segment - 1.) * segment_size + segment_size] -= 1.
+
+    ndx = np.flatnonzero(~np.isnan(flux) & (segment < n_segments))
+    start = segment[ndx] * segment_size
+    binsize = segment_size / n_bins
+    bins = np.minimum(np.floor((time[ndx] - start) / binsize), n_bins - 1)
+    bins = (segment[ndx] * n_bins + bins).astype('int64')
+
+    # Empty bins are left as NaN.
+    size = n_segments * n_bins
+    samples = np.bincount(bins, minlength=size).astype('float64')
+    with np.errstate(invalid='ignore'):
+        btime = np.bincount(bins, weights=time[ndx], minlength=size) / samples
+        bflux = np.bincount(bins, weights=flux[ndx], minlength=size) / samples
+        bfluxerr = np.bincount(bins, weights=fluxerr[ndx], minlength=size) / \
+            samples
+
+    return btime.reshape((n_segments,n_bins)), \
+        bflux.reshape((n_segments,n_bins)), \
+        bfluxerr.reshape((n_segments,n_bins)), \
+        samples.reshape((n_segments,n_bins))
+
+
+def __compute_signal_residual(time, flux, samples, n_bins_min_duration,
+n_bins_max_duration, directions):
     '''
-    Run BLS algorithm on a binned segment.
-
-    :param binned_segment: Segment for which to calculate the residual
-    :type binned_segment: pandas.DataFrame
-    :param matrx: Matrix of i1, i2 indices
-    :type matrix: numpy.ndarray
-    :param duration: Array of durations to consider
-    :type duration: numpy.ndarray
+    Run the BLS algorithm on a block of binned segments, one row per segment.
+    For every start bin, the sums over the event are built up one bin at a
+    time, in the same order as the C implementation, for all start bins and
+    segments at once; the best event of each start bin is kept, and then the
+    best start bin of each segment. Returns, for each direction, the SR^2,
+    duration, depth, and midtime of the best event of each segment.
+
+    :param time: Binned times
+    :type time: numpy.ndarray
+    :param flux: Binned fluxes
+    :type flux: numpy.ndarray
+    :param samples: Number of points in each bin
+    :type samples: numpy.ndarray
     :param n_bins_min_duration: Length of minimum duration in full bins
     :type n_bins_min_duration: int
-    :param direction: Signal direction to accept; -1 for dips, +1 for blips,
-        or 0 for best
-    :type direction: int
-
-    :rtype: pandas.Series
-    '''
-    binned_segment_indexed = binned_segment.reset_index(drop=True)
-    r = __reindex_to_matrix(binned_segment_indexed.samples, matrix).cumsum(
-        axis=1)
-    s = __reindex_to_matrix(binned_segment_indexed.flux, matrix).cumsum(axis=1)
-    n = binned_segment_indexed.samples.sum()
-    sr = s**2 / (r * (n - r))
-    depths = (s / r) + (s / (n - r))
-
-    # NOTE: Modified by emprice. Durations can be the minimum value but not
-    # smaller.
-    sr[:,duration < n_bins_min_duration] = np.nan
-    SR_index = np.unravel_index(np.ma.masked_invalid(sr).argmax(), sr.shape)
-    i1 = int(SR_index[0])
-    i2 = int(matrix[SR_index])
-
-    # Make sure the best SR matches the desired direction.
-    if s[SR_index]*direction >= 0:
-        return pd.Series(dict(phases=i1,
-            durations=(binned_segment.time.values[i2] -
-                binned_segment.time.values[i1]),
-            signal_residuals=sr[SR_index],
-            depths=depths[SR_index],
-            midtimes=0.5*(binned_segment.time.values[i1] +
-                binned_segment.time.values[i2])))
-    else:
-        return pd.Series(dict(phases=np.nan, durations=np.nan,
-            signal_residuals=np.nan, depths=np.nan, midtimes=np.nan))
-
-
-def __phase_bin(segment, bins):
-    '''
-    Phase-bin a light curve segment.
-
-    :param segment: Segment to bin
-    :type segment: pandas.DataFrame
-    :param bins: Array of bin edges to use
-    :type bins: numpy.ndarray
-
-    :rtype: pandas.DataFrame
+    :param n_bins_max_duration: Length of maximum duration in full bins
+    :type n_bins_max_duration: int
+    :param directions: Signal directions to search; -1 for dips, +1 for
+        blips, or 0 for best, as for ``bls_pulse``, or 2 and 3 for the dips
+        and the blips of a compound search
+    :type directions: list
+
+    :rtype: list
     '''
-    # NOTE: emprice added `right` option to emualte behavior of other binning
-    # schemes.
-    grouper = segment.groupby(pd.cut(segment['phase'], bins, right=False))
-    y = grouper.mean()
-    y["samples"] = grouper.time.count()
-    del y["segment"]
-    return y
+    n_segments, n_bins = samples.shape
+    seg = np.arange(n_segments)
+    start = np.arange(n_bins)[None,:]
+    nn = np.floor(np.sum(samples, axis=1))[:,None]
+
+    # Empty bins add nothing to the sums; padding the ends with empty bins
+    # stops the events at the end of the segment.
+    pad = np.zeros((n_segments,n_bins_max_duration+1), dtype='float64')
+    flux = np.hstack((np.where(samples == 0., 0., flux), pad))
+    samples = np.hstack((samples, pad))
+    valid = (samples[:,:n_bins] != 0.) & (start < n_bins - n_bins_min_duration)
+
+    s = np.zeros((n_segments,n_bins), dtype='float64')
+    r = np.zeros((n_segments,n_bins), dtype='float64')
+    for k in xrange(n_bins_min_duration):
+        s += flux[:,k:k+n_bins]
+        r += samples[:,k:k+n_bins]
+
+    best = [(np.zeros((n_segments,n_bins), dtype='float64'),
+        np.tile(start, (n_segments,1)), np.empty((n_segments,n_bins),
+        dtype='float64')) for direction in directions]
+    for best_srsq, best_end, best_depth in best:
+        best_depth[:] = np.nan
+
+    for k in xrange(n_bins_min_duration, n_bins_max_duration + 1):
+        s += flux[:,k:k+n_bins]
+        r += samples[:,k:k+n_bins]
+        srsq = (s * s) / (r * (nn - r))
+        depth = s / r + s / (nn - r)
+        ok = valid & (samples[:,k:k+n_bins] != 0.) & (r != nn)
+
+        for direction, (best_srsq, best_end, best_depth) in zip(directions,
+        best):
+            if direction == 2:
+                better = ok & (srsq > best_srsq) & (s < 0.)
+            elif direction == 3:
+                better = ok & (srsq > best_srsq) & (s > 0.)
+            else:
+                better = ok & (srsq > best_srsq) & (direction * s >= 0)
+
+            best_srsq[better] = srsq[better]
+            best_end[better] = np.nonzero(better)[1] + k
+            best_depth[better] = depth[better]
+
+    results = []
+    for best_srsq, best_end, best_depth in best:
+        i = np.argmax(best_srsq, axis=1)
+        j = best_end[seg,i]
+        ok = valid[seg,i]
+
+        duration = np.where(ok, time[seg,j] - time[seg,i], np.nan)
+        midtime = np.where(ok, (time[seg,j] + time[seg,i]) / 2., np.nan)
+        results.append((best_srsq[seg,i], duration, best_depth[seg,i],
+            midtime))
+
+    return results
 
 
 def bls_pulse(time, flux, fluxerr, n_bins, segment_size, min_duration,
-max_duration, detrend_order=3, direction=0, remove_nan_segs=False):
+max_duration, detrend_order=3, direction=0, remove_nan_segs=False,
+chunk_size=2**18):
     '''
     Main function for this module; performs the BLS pulse algorithm on the input
     lightcurve data, in a vectorized way. Lightcurve should be 0-based if no
     detrending is used.
 
+    The segments are searched in blocks of about `chunk_size` bin values, which
+    caps the memory used at a few dozen times that many values; the results do
+    not depend on it.
+
     See Kovacs et al. (2002)
 
     :param time: Array of times of observations; nominally in units of days
@@ -121,7 +179,7 @@ max_duration, detrend_order=3, direction=0, remove_nan_segs=False):
     :param max_duration: Maximum signal duration to accept, in days
     :type max_duration: float
     :param direction: Signal direction to accept; -1 for dips, +1 for blips,
-        or 0 for best
+        0 for best, or 2 for best dip and blip
     :type direction: int
     :param detrend_order: Order of detrending to use on input; 0 for no
         detrending
@@ -129,6 +187,8 @@ max_duration, detrend_order=3, direction=0, remove_nan_segs=False):
     :param remove_nan_segs: Remove from the output segments with no accepted
         events
     :type remove_nan_segs: bool
+    :param chunk_size: Number of bin values to search at once
+    :type chunk_size: int
 
     :rtype: dict
     '''
@@ -141,47 +201,56 @@ max_duration, detrend_order=3, direction=0, remove_nan_segs=False):
     if n_bins <= 1:
         raise ValueError("Number of bins must be > 1.")
 
-    light_curve = pd.DataFrame(data=np.column_stack((flux,fluxerr)), index=time,
-        columns=['flux','flux_error'])
-    light_curve.index.name = 'time'
+    time = np.asarray(time, dtype='float64')
+    flux = np.asarray(flux, dtype='float64')
+    fluxerr = np.asarray(fluxerr, dtype='float64')
 
-    n_bins_min_duration = max(np.floor(min_duration/segment_size*n_bins), 1)
-    n_bins_max_duration = np.ceil(max_duration/segment_size*n_bins)
-    light_curve["segment"] = np.floor(np.array(light_curve.index).astype(
-        np.float)/segment_size)
-    light_curve["phase"] = np.remainder(np.array(light_curve.index),
-        segment_size) / segment_size
-    sample_rate = np.median(np.diff(np.array(light_curve.index).astype(
-        np.float)))
+    n_bins_min_duration = int(max(np.floor(min_duration / segment_size *
+        n_bins), 1))
+    n_bins_max_duration = int(np.ceil(max_duration / segment_size * n_bins))
 
     # TODO: Detrending!
 
-    # Define equally spaced bins and bin according to phase.
-    bins = np.linspace(0., 1., n_bins+1)
-    phase_binned_segments = light_curve.reset_index().groupby('segment').apply(
-        lambda x: __phase_bin(x, bins=bins))
-
-    i1 = np.arange(n_bins - n_bins_min_duration)[:,None]
-    duration = np.arange(0, n_bins_max_duration)
-
-    # matrix is the grid of indices to be used for evaluating SR
-    # i1 is vertical, i2 is horizontal
-    # each row is a segment, for example row 2 has bin indices from 2 to 6
-    # 1 2 3 4 5
-    # 2 3 4 5 6
-    # 3 4 5 6 7
-    matrix = i1 + duration
-
-    results = phase_binned_segments.groupby(level="segment").apply(lambda x:
-        __compute_signal_residual(x, matrix=matrix, duration=duration,
-        n_bins_min_duration=n_bins_min_duration, direction=direction))
+    # Bin all the segments on zero-based times, then shift the binned times to
+    # start at zero as well.
+    t = np.nanmin(time)
+    btime, bflux, bfluxerr, samples = __phase_bin(time - t, flux, fluxerr,
+        n_bins, segment_size)
+    tb = np.nanmin(btime)
+    btime -= tb
+
+    # As in ``bls_pulse_cython``, the segments are counted again on the
+    # binned times.
+    n_segments = int(np.floor(np.nanmax(btime) / segment_size) + 1)
+    btime = btime[:n_segments]
+    bflux = bflux[:n_segments]
+    samples = samples[:n_segments]
+
+    if direction == 2:
+        directions = [2, 3]
+        names = ['_dip', '_blip']
+    else:
+        directions = [direction]
+        names = ['']
+
+    rows = max(1, chunk_size // (n_bins + n_bins_max_duration + 1))
+    blocks = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in xrange(0, n_segments, rows):
+            blocks.append(__compute_signal_residual(btime[i:i+rows],
+                bflux[i:i+rows], samples[i:i+rows], n_bins_min_duration,
+                n_bins_max_duration, directions))
+
+    return_data = dict()
+    for k, name in enumerate(names):
+        srsq, duration, depth, midtime = [np.concatenate([b[k][m] for b in
+            blocks]) for m in xrange(4)]
+        return_data.update({'srsq' + name:srsq, 'duration' + name:duration,
+            'depth' + name:depth, 'midtime' + name:midtime + tb + t})
 
     if remove_nan_segs:
-        results = results.dropna()
-
-    return_data = dict(srsq=results.signal_residuals.values,
-        duration=results.durations.values, depth=results.depths.values,
-        midtime=results.midtimes.values)
+        keep = np.all(np.isfinite(np.column_stack(return_data.values())),
+            axis=1)
+        return_data = dict((k, v[keep]) for k, v in return_data.iteritems())
 
     return return_data
-
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+cimport numpy as np
+cimport cython
+
+
+cdef extern int do_bls_search(double *time, double *flux, double *weight, int nsamples,
+    double *periods, int nperiods, int nbins, double mindur, double maxdur, int direction,
+    int nthreads, double *srsq, double *duration, double *depth, double *midtime) nogil
+
+
+def period_grid(double minper, double maxper, int nsearch):
+    '''
+    Returns `nsearch` trial periods evenly spaced from `minper` to `maxper`.
+
+    :param minper: Shortest trial period
+    :type minper: float
+    :param maxper: Longest trial period
+    :type maxper: float
+    :param nsearch: Number of trial periods
+    :type nsearch: int
+
+    :rtype: np.ndarray
+    '''
+    if minper <= 0.:
+        raise ValueError('Minimum period must be > 0.')
+    if maxper < minper:
+        raise ValueError('Maximum period must be >= minimum period.')
+    if nsearch < 1:
+        raise ValueError('Number of trial periods must be >= 1.')
+
+    return np.linspace(minper, maxper, nsearch)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.profile(True)
+@cython.embedsignature(True)
+def bls_search(time, flux, fluxerr, int nbins, double mindur, double maxdur,
+periods=None, minper=None, maxper=None, nsearch=None, int direction=0,
+nthreads=None):
+    '''
+    Run the periodic BLS algorithm (Kovacs et al. 2002) on a lightcurve, such
+    as the detrended output of ``bin_and_detrend``, for every trial period.
+    The trial periods are either given in `periods`, or as `nsearch` periods
+    evenly spaced from `minper` to `maxper` (see ``period_grid``).
+
+    The points are weighted by the inverse square of their errors, and the
+    weighted mean flux is subtracted. For each trial period, the C code folds
+    and bins the lightcurve into `nbins` phase bins, and tries every event
+    from `mindur` to `maxdur` long that starts and ends in a non-empty bin,
+    including those that wrap around the end of the phase. The trial periods
+    are split over `nthreads` threads, without the GIL; the results are the
+    same for any number of threads. Points with a NaN time, flux, or error
+    are left out.
+
+    Returns a dictionary with the trial periods and, for each of them, the
+    SR^2, duration, depth, and midtime (of the first event after the first
+    point) of the best event. Periods with no event have zero SR^2 and NaN
+    for the rest.
+
+    :param time: Array of times of observations
+    :type time: np.ndarray
+    :param flux: Array of fluxes corresponding to times
+    :type flux: np.ndarray
+    :param fluxerr: Array of flux errors corresponding to times
+    :type fluxerr: np.ndarray
+    :param nbins: Number of phase bins
+    :type nbins: int
+    :param mindur: Minimum signal duration to accept, in the units of `time`
+    :type mindur: float
+    :param maxdur: Maximum signal duration to accept, in the units of `time`
+    :type maxdur: float
+    :param periods: Trial periods
+    :type periods: np.ndarray
+    :param minper: Shortest trial period, if `periods` is not given
+    :type minper: float
+    :param maxper: Longest trial period, if `periods` is not given
+    :type maxper: float
+    :param nsearch: Number of trial periods, if `periods` is not given
+    :type nsearch: int
+    :param direction: Signal direction to accept; -1 for dips, +1 for blips,
+        or 0 for best
+    :type direction: int
+    :param nthreads: Number of threads to use; if None, the value of the
+        environment variable ``CLOUD_KEPLER_THREADS``, or 1 if it is not set
+    :type nthreads: int
+
+    :rtype: dict
+    '''
+    cdef int nsamples, nperiods, cnthreads, status
+    cdef np.ndarray[double, ndim=1, mode='c'] ctime, cflux, cweight, cperiods
+    cdef np.ndarray[double, ndim=1, mode='c'] srsq, duration, depth, midtime
+
+    if nbins <= 1:
+        raise ValueError('Number of bins must be > 1.')
+    if mindur <= 0.:
+        raise ValueError('Minimum duration must be > 0.')
+    if maxdur <= mindur:
+        raise ValueError('Maximum duration must be > minimum duration.')
+    if direction not in (-1, 0, 1):
+        raise ValueError('%d is not a valid value for direction.' % direction)
+
+    if nthreads is None:
+        nthreads = os.environ.get('CLOUD_KEPLER_THREADS', 1)
+    cnthreads = int(nthreads)
+    if cnthreads < 1:
+        raise ValueError('Number of threads must be >= 1.')
+
+    if periods is None:
+        if minper is None or maxper is None or nsearch is None:
+            raise ValueError('Need either the trial periods, or the minimum '
+                'and maximum periods and the number of trial periods.')
+        periods = period_grid(minper, maxper, nsearch)
+    cperiods = np.ascontiguousarray(periods, dtype='float64')
+    if cperiods.shape[0] == 0 or np.any(~(cperiods > 0.)):
+        raise ValueError('Trial periods must be > 0.')
+
+    time = np.asarray(time, dtype='float64')
+    flux = np.asarray(flux, dtype='float64')
+    fluxerr = np.asarray(fluxerr, dtype='float64')
+
+    ndx = np.isfinite(time) & np.isfinite(flux) & np.isfinite(fluxerr) & \
+        (fluxerr > 0.)
+    if np.count_nonzero(ndx) < 2:
+        raise ValueError('Need at least two points with finite flux and error.')
+
+    # Zero-based times keep the phases accurate; the weights add up to one,
+    # and the weighted mean flux is zero.
+    t = np.min(time[ndx])
+    ctime = time[ndx] - t
+    cweight = fluxerr[ndx]**-2.
+    cweight /= np.sum(cweight)
+    cflux = flux[ndx] - np.dot(cweight, flux[ndx])
+    nsamples = ctime.shape[0]
+    nperiods = cperiods.shape[0]
+
+    srsq = np.empty((nperiods,), dtype='float64')
+    duration = np.empty((nperiods,), dtype='float64')
+    depth = np.empty((nperiods,), dtype='float64')
+    midtime = np.empty((nperiods,), dtype='float64')
+
+    with nogil:
+        status = do_bls_search(&ctime[0], &cflux[0], &cweight[0], nsamples,
+            &cperiods[0], nperiods, nbins, mindur, maxdur, direction,
+            cnthreads, &srsq[0], &duration[0], &depth[0], &midtime[0])
+
+    if status != 0:
+        raise MemoryError('Could not allocate the BLS search workspace.')
+
+    return dict(period=cperiods.copy(), srsq=srsq, duration=duration,
+        depth=depth, midtime=midtime + t)
@@ -0,0 +1,230 @@
+#include <math.h>
+#include <stdlib.h>
+#include <pthread.h>
+
+#define false           (0)
+#define true            (1)
+
+#define min(a,b)        (a < b ? a : b)
+#define max(a,b)        (a > b ? a : b)
+
+/* Upper limit on the number of threads used by `do_bls_search`. */
+#define MAX_THREADS     256
+
+
+int bls_search_work_size(int nbins)
+{
+    /**
+     * Number of doubles of workspace that `do_bls_search_period` needs: the
+     * cumulative sums of the weighted fluxes and of the weights over two
+     * turns of the phase-binned lightcurve.
+     */
+    return 2 * (2 * nbins + 1);
+}
+
+
+int do_bls_search_period(double *time, double *flux, double *weight,
+    int nsamples, double period, int nbins, double mindur, double maxdur,
+    int direction, double *work, double *srsq, double *duration,
+    double *depth, double *midtime)
+{
+    /**
+     * Run the periodic BLS algorithm (Kovacs et al. 2002) for a single trial
+     * period. The times must be zero-based, the weights must add up to one,
+     * and the weighted mean of the fluxes must be zero; none of them may be
+     * NaN. The lightcurve is folded on `period` and binned into `nbins` phase
+     * bins, and every event from `mindur` to `maxdur` (in the units of
+     * `time`) that starts and ends in a non-empty bin is tried. The SR^2,
+     * duration, depth, and midtime (the first one after zero) of the best
+     * event are returned through the pointers; if there is none, SR^2 is
+     * zero and the rest are NaN. `direction` is as for BLS pulse: -1 for
+     * dips, +1 for blips, or 0 for either.
+     */
+    double *s = work, *r = work + 2 * nbins + 1;
+    double frequency = 1. / period, phase, sk, rk, srsqnew;
+    double srsqmax = 0., bests = 0., bestr = 0.;
+    int i, j, k, kmin, kmax, besti = -1, bestk = 0;
+
+    for (j = 0; j <= 2 * nbins; j++)
+    {
+        s[j] = 0.;
+        r[j] = 0.;
+    }
+
+    /* Fold and bin; bin `j` is accumulated in element `j` + 1, so that the
+     * cumulative sums below start with a zero. */
+    for (i = 0; i < nsamples; i++)
+    {
+        phase = time[i] * frequency;
+        phase -= floor(phase);
+        j = min((int) (phase * nbins), nbins - 1);
+
+        s[j+1] += weight[i] * flux[i];
+        r[j+1] += weight[i];
+    }
+
+    /* Repeat the bins once more, so that events can wrap around the end of
+     * the phase, and take the cumulative sums. */
+    for (j = 1; j <= nbins; j++)
+    {
+        s[nbins+j] = s[j];
+        r[nbins+j] = r[j];
+    }
+
+    for (j = 1; j <= 2 * nbins; j++)
+    {
+        s[j] += s[j-1];
+        r[j] += r[j-1];
+    }
+
+    /* The range of event durations, in bins; an event covers less than the
+     * whole phase. */
+    kmin = max((int) floor(mindur / period * nbins), 1);
+    kmax = min((int) ceil(maxdur / period * nbins), nbins - 1);
+
+    for (i = 0; i < nbins; i++)
+    {
+        if (r[i+1] == r[i])
+            continue;
+
+        for (k = kmin; k <= kmax; k++)
+        {
+            /* The event covers bins `i` to `i` + `k` - 1. */
+            if (r[i+k] == r[i+k-1])
+                continue;
+
+            sk = s[i+k] - s[i];
+            rk = r[i+k] - r[i];
+            if (rk >= 1.)
+                continue;
+
+            srsqnew = sk * sk / (rk * (1. - rk));
+            if ((srsqnew > srsqmax) && (direction * sk >= 0))
+            {
+                srsqmax = srsqnew;
+                besti = i;
+                bestk = k;
+                bests = sk;
+                bestr = rk;
+            }
+        }
+    }
+
+    *srsq = srsqmax;
+    if (besti < 0)
+    {
+        *duration = NAN;
+        *depth = NAN;
+        *midtime = NAN;
+        return 0;
+    }
+
+    *duration = bestk * period / nbins;
+    *depth = bests / (bestr * (1. - bestr));
+    *midtime = fmod((besti + 0.5 * bestk) * period / nbins, period);
+
+    return 0;
+}
+
+
+
+
+/* Arguments shared by the threads of `do_bls_search`; see that function. */
+typedef struct
+{
+    double *time, *flux, *weight, *periods;
+    int nsamples, nperiods, nbins, direction, nthreads;
+    double mindur, maxdur;
+    double *srsq, *duration, *depth, *midtime;
+} bls_search_args;
+
+typedef struct
+{
+    bls_search_args *args;
+    int thread;
+} bls_search_task;
+
+
+static void *bls_search_worker(void *ptr)
+{
+    /**
+     * Search every `nthreads`-th trial period, starting with period
+     * `thread`. Interleaving the periods spreads the long ones, which try
+     * more event durations, evenly over the threads.
+     */
+    bls_search_task *task = (bls_search_task *) ptr;
+    bls_search_args *a = task->args;
+    double *work;
+    int i;
+
+    work = (double *) malloc(sizeof(double) * bls_search_work_size(a->nbins));
+    if (work == NULL)
+        return (void *) task;
+
+    for (i = task->thread; i < a->nperiods; i += a->nthreads)
+    {
+        do_bls_search_period(a->time, a->flux, a->weight, a->nsamples,
+            a->periods[i], a->nbins, a->mindur, a->maxdur, a->direction, work,
+            a->srsq + i, a->duration + i, a->depth + i, a->midtime + i);
+    }
+
+    free(work);
+
+    return NULL;
+}
+
+
+int do_bls_search(double *time, double *flux, double *weight, int nsamples,
+    double *periods, int nperiods, int nbins, double mindur, double maxdur,
+    int direction, int nthreads, double *srsq, double *duration,
+    double *depth, double *midtime)
+{
+    /**
+     * Run `do_bls_search_period` on each of the `nperiods` trial periods,
+     * using up to `nthreads` threads, and write the results for period `i`
+     * to element `i` of the outputs. The periods are searched independently,
+     * so the results do not depend on the number of threads. Returns 0, or
+     * -1 if a workspace could not be allocated. This function does not touch
+     * any Python objects, so it can be called without the GIL.
+     */
+    bls_search_args args = {time, flux, weight, periods, nsamples, nperiods,
+        nbins, direction, 0, mindur, maxdur, srsq, duration, depth, midtime};
+    bls_search_task tasks[MAX_THREADS];
+    pthread_t threads[MAX_THREADS];
+    int started[MAX_THREADS];
+    int i, status = 0;
+
+    nthreads = max(1, min(min(nthreads, nperiods), MAX_THREADS));
+    args.nthreads = nthreads;
+
+    for (i = 0; i < nthreads; i++)
+    {
+        tasks[i].args = &args;
+        tasks[i].thread = i;
+        started[i] = false;
+    }
+
+    /* The calling thread takes the first share of the periods itself. */
+    for (i = 1; i < nthreads; i++)
+        started[i] = (pthread_create(&threads[i], NULL, bls_search_worker,
+            &tasks[i]) == 0);
+
+    if (bls_search_worker(&tasks[0]) != NULL)
+        status = -1;
+
+    for (i = 1; i < nthreads; i++)
+    {
+        void *result = NULL;
+
+        if (started[i])
+            pthread_join(threads[i], &result);
+        else
+            /* Could not start a thread; do its share here instead. */
+            result = bls_search_worker(&tasks[i]);
+
+        if (result != NULL)
+            status = -1;
+    }
+
+    return status;
+}
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Distutils import build_ext
+
+import numpy as np
+
+setup(cmdclass = {'build_ext': build_ext}, ext_modules =
+    [Extension('bls_search', sources=['bls_search.pyx','bls_search_extern.c'],
+    include_dirs=[np.get_include()], extra_compile_args=['-pthread'],
+    extra_link_args=['-pthread'])])
+
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Catalog of the candidate events in the FITS output of ``drive_bls_pulse.py``,
+so that questions such as "which stars have a dip with SR^2 above X and depth
+below Y" can be answered without opening every output file. For each star
+and pass, the catalog keeps the `top` dips and blips with the highest SR^2,
+and the parameters of the periodic signal that ``clean_signal`` found in the
+pass (period, phase, duration, depth), if any. Output searched for dips and
+blips at once (``direction = 2``) has separate columns for each; otherwise,
+dips and blips are told apart by the sign of their depth. The catalog is
+stored in an SQLite database, indexed on SR^2, depth, period, and KIC ID.
+
+Build or refresh a catalog with::
+
+    python catalog.py build /path/to/fits_dir candidates.db
+
+Stars in result stores (see ``result_store.py``) under the directory are read
+as well, and listed as ``<store>#<key>``. Refreshing only reads the output
+files that are new or have changed since the last scan, and drops those that
+have disappeared; files that cannot be read are skipped until they change.
+Query it with, e.g.::
+
+    python catalog.py query candidates.db --direction -1 --min-srsq 1e-6 \\
+        --max-depth -0.001 --limit 20
+
+Depths are signed, as in the output files: dips have negative depths.
+'''
+
+import os
+import sys
+import sqlite3
+import numpy as np
+from functools import partial
+from argparse import ArgumentParser
+from postprocessing.read_bls_fits import BLSOutput
+from result_store import ResultStore
+from utils import setup_logging, handle_exception
+
+# Basic logging configuration.
+logger = setup_logging(__file__)
+
+# Events kept per star, pass, and direction, unless told otherwise.
+TOP = 5
+
+# Results are sorted by SR^2, so SQLite prefers walking the SR^2 index to
+# any other; it holds the direction and depth as well, so that thresholds on
+# them are checked without looking up each event.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    top INTEGER,
+    kic TEXT,
+    cadence TEXT,
+    passes INTEGER
+);
+CREATE TABLE IF NOT EXISTS passes (
+    path TEXT,
+    kic TEXT,
+    pass INTEGER,
+    period REAL,
+    phase REAL,
+    duration REAL,
+    depth REAL,
+    PRIMARY KEY (path, pass)
+);
+CREATE TABLE IF NOT EXISTS events (
+    path TEXT,
+    kic TEXT,
+    pass INTEGER,
+    direction INTEGER,
+    rank INTEGER,
+    srsq REAL,
+    duration REAL,
+    depth REAL,
+    midtime REAL,
+    segstart REAL,
+    segend REAL
+);
+CREATE INDEX IF NOT EXISTS events_path ON events (path);
+CREATE INDEX IF NOT EXISTS events_srsq ON events (srsq, direction, depth);
+CREATE INDEX IF NOT EXISTS events_depth ON events (depth);
+CREATE INDEX IF NOT EXISTS events_kic ON events (kic);
+CREATE INDEX IF NOT EXISTS passes_period ON passes (period);
+CREATE INDEX IF NOT EXISTS passes_kic ON passes (kic);
+'''
+
+# Columns returned by ``Catalog.query``; those of the pass's periodic signal
+# are prefixed, so they are not confused with those of the event.
+COLUMNS = ['kic', 'pass', 'direction', 'rank', 'srsq', 'duration', 'depth',
+    'midtime', 'segstart', 'segend', 'period', 'phase', 'signal_duration',
+    'signal_depth', 'path']
+
+
+class Catalog(object):
+    '''
+    Indexed table of the strongest events in a directory of BLS pulse output
+    files.
+    '''
+
+    def __init__(self, catalogfile):
+        '''
+        Open (or create) the catalog stored in `catalogfile`.
+
+        :param catalogfile: Path of the SQLite catalog file
+        :type catalogfile: str
+        '''
+        self.db = sqlite3.connect(catalogfile)
+        self.db.executescript(SCHEMA)
+
+
+    def refresh(self, resultdir, top=TOP):
+        '''
+        Scan `resultdir`, and its subdirectories, for FITS output files and
+        result stores, and bring the catalog up to date. Only the files that
+        are new, or whose size or modification time has changed, are read;
+        those that cannot be read are logged and left out, and are not tried
+        again until they change. Returns the number of files that were read.
+
+        :param resultdir: Directory of FITS output files
+        :type resultdir: str
+        :param top: Number of events to keep per star, pass, and direction
+        :type top: int
+
+        :rtype: int
+        '''
+        if top < 1:
+            raise ValueError('Number of events per pass must be >= 1.')
+
+        resultdir = os.path.abspath(resultdir)
+        known = dict((row[0], row[1:]) for row in self.db.execute('SELECT '
+            'path, size, mtime, top FROM files'))
+        seen = set()
+        nchanged = 0
+
+        for path, size, mtime, source in self.__list_files(resultdir):
+            seen.add(path)
+            if known.get(path) == (size, mtime, top):
+                continue
+
+            try:
+                contents = self.__read_file(source(), top)
+            except Exception as e:
+                # One bad file must not stop the scan.
+                logger.warning('Skipping %s: %s' % (path, e))
+                contents = None
+            else:
+                nchanged += 1
+
+            self.__store_file(path, (size, mtime, top), contents)
+
+        # Forget about files under this directory that have disappeared.
+        for path in set(known) - seen:
+            if path.startswith(resultdir + os.sep):
+                self.__store_file(path, None, None)
+
+        self.db.commit()
+
+        return nchanged
+
+
+    def query(self, min_srsq=None, min_depth=None, max_depth=None,
+    direction=None, kic=None, min_period=None, max_period=None, limit=None):
+        '''
+        Returns the events that pass all the given thresholds, strongest
+        first, as dictionaries with the keys in ``COLUMNS``.
+
+        :param min_srsq: Minimum SR^2 of the event
+        :type min_srsq: float
+        :param min_depth: Minimum (signed) depth of the event
+        :type min_depth: float
+        :param max_depth: Maximum (signed) depth of the event
+        :type max_depth: float
+        :param direction: -1 for dips, or +1 for blips
+        :type direction: int
+        :param kic: Zero-padded KIC ID of the star
+        :type kic: str
+        :param min_period: Minimum period of the periodic signal found in the
+            pass
+        :type min_period: float
+        :param max_period: Maximum period of the periodic signal found in the
+            pass
+        :type max_period: float
+        :param limit: Maximum number of events to return
+        :type limit: int
+
+        :rtype: list
+        '''
+        where = []
+        args = []
+        for clause, value in (('e.srsq >= ?', min_srsq),
+        ('e.depth >= ?', min_depth), ('e.depth <= ?', max_depth),
+        ('e.direction = ?', direction), ('e.kic = ?', kic),
+        ('p.period >= ?', min_period), ('p.period <= ?', max_period)):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+
+        sql = 'SELECT e.kic, e.pass, e.direction, e.rank, e.srsq, ' \
+            'e.duration, e.depth, e.midtime, e.segstart, e.segend, ' \
+            'p.period, p.phase, p.duration, p.depth, e.path FROM events e ' \
+            'JOIN passes p ON p.path = e.path AND p.pass = e.pass'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY e.srsq DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+
+        return [dict(zip(COLUMNS, row)) for row in self.db.execute(sql,
+            args)]
+
+
+    def close(self):
+        self.db.close()
+
+
+    def __list_files(self, resultdir):
+        '''
+        Yields the path, size, and modification time of each output file
+        under `resultdir`, and a function that returns the file name (or file
+        object) to read it from. Stars in result stores are listed as
+        ``<store>#<key>``, with the size of their FITS file and the time it
+        was written.
+        '''
+        for dirpath, dirnames, fnames in os.walk(resultdir):
+            dirnames.sort()
+
+            if any(fname.endswith('.idx') for fname in fnames):
+                store = ResultStore(dirpath)
+                for key in store.keys():
+                    size, written = store.stat(key)
+                    yield '%s#%s' % (dirpath, key), size, written, \
+                        partial(store.open, key)
+
+            for fname in sorted(fnames):
+                # Files being written are hidden until they are complete.
+                if fname.startswith('.') or not fname.endswith('.fits'):
+                    continue
+
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+
+                yield path, st.st_size, st.st_mtime, partial(str, path)
+
+
+    def __read_file(self, fitsfile, top):
+        '''
+        Read the primary header, the periodic signal of each pass, and the
+        `top` dips and blips of each pass from one output file. Passes are
+        numbered from the first, although the file holds the last first.
+        '''
+        with BLSOutput(fitsfile) as out:
+            kic = out.kic
+            cadence = out.header.get('CADENCE')
+            npasses = out.num_passes
+            passes = []
+            events = []
+
+            for i, bls in enumerate(out.dipblips):
+                n = npasses - i
+                hdr = out.hdulist[2 + 2 * i].header
+                passes.append((kic, n) + tuple(hdr.get(k) for k in ('period',
+                    'phase', 'duration', 'depth')))
+
+                if 'srsq' in bls.dtype.names:
+                    # A single search, for dips, blips, or the stronger of
+                    # the two in each segment.
+                    groups = ((-1, '', bls['depth'] < 0.), (1, '',
+                        bls['depth'] > 0.))
+                else:
+                    groups = ((-1, '_dip', True), (1, '_blip', True))
+
+                for direction, name, mask in groups:
+                    srsq = bls['srsq' + name]
+                    ndx = np.flatnonzero((srsq > 0.) & mask)
+                    ndx = ndx[np.argsort(-srsq[ndx], kind='mergesort')][:top]
+                    columns = [bls[c][ndx].tolist() for c in ('srsq' + name,
+                        'duration' + name, 'depth' + name, 'midtime' + name,
+                        'segstart', 'segend')]
+                    events.extend((kic, n, direction, rank) + row for rank,
+                        row in enumerate(zip(*columns), 1))
+
+        return kic, cadence, npasses, passes, events
+
+
+    def __store_file(self, path, stamp, contents):
+        '''
+        Replace the catalog entries of one output file, or remove them if
+        `stamp` is None. If `contents` is None, the file could not be read;
+        only its stamp is kept, so that it is not read again until it changes.
+        '''
+        self.db.execute('DELETE FROM events WHERE path = ?', (path,))
+        self.db.execute('DELETE FROM passes WHERE path = ?', (path,))
+
+        if stamp is None:
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            return
+        elif contents is None:
+            contents = (None, None, None, [], [])
+
+        kic, cadence, npasses, passes, events = contents
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, '
+            '?, ?)', (path,) + stamp + (kic, cadence, npasses))
+        self.db.executemany('INSERT INTO passes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(path,) + row for row in passes])
+        self.db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, '
+            '?, ?, ?, ?)', [(path,) + row for row in events])
+
+
+def main(args):
+    '''
+    Build or refresh a catalog, or print the events that pass the given
+    thresholds.
+
+    :param args: Parsed command line arguments
+    :type args: argparse.Namespace
+    '''
+    catalog = Catalog(args.catalogfile)
+
+    if args.command == 'build':
+        nchanged = catalog.refresh(args.resultdir, top=args.top)
+        nfiles = catalog.db.execute('SELECT COUNT(*) FROM files WHERE passes '
+            'IS NOT NULL').fetchone()[0]
+        logger.info('Read %d files; %d files in catalog' % (nchanged, nfiles))
+    else:
+        print '#' + '\t'.join(COLUMNS)
+        for row in catalog.query(min_srsq=args.min_srsq,
+        min_depth=args.min_depth, max_depth=args.max_depth,
+        direction=args.direction, kic=args.kic, min_period=args.min_period,
+        max_period=args.max_period, limit=args.limit):
+            print '\t'.join(str(row[c]) for c in COLUMNS)
+
+    catalog.close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build or query a catalog of the '
+        'candidate events in the FITS output of drive_bls_pulse.py.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build = subparsers.add_parser('build', help='Build or refresh a catalog.')
+    build.add_argument('resultdir', action='store', help='Directory of FITS '
+        'output files.')
+    build.add_argument('catalogfile', action='store', help='Catalog file to '
+        'create or update.')
+    build.add_argument('--top', action='store', type=int, default=TOP,
+        help='[Optional] Number of events to keep per star, pass, and '
+            'direction.')
+
+    query = subparsers.add_parser('query', help='Print the events that pass '
+        'the given thresholds, strongest first.')
+    query.add_argument('catalogfile', action='store', help='Catalog file.')
+    query.add_argument('--min-srsq', action='store', type=float,
+        dest='min_srsq', help='[Optional] Minimum SR^2.')
+    query.add_argument('--min-depth', action='store', type=float,
+        dest='min_depth', help='[Optional] Minimum (signed) depth.')
+    query.add_argument('--max-depth', action='store', type=float,
+        dest='max_depth', help='[Optional] Maximum (signed) depth.')
+    query.add_argument('--direction', action='store', type=int,
+        choices=[-1, 1], help='[Optional] -1 for dips, or +1 for blips.')
+    query.add_argument('--kic', action='store', type=str, help='[Optional] '
+        'Zero-padded KIC ID.')
+    query.add_argument('--min-period', action='store', type=float,
+        dest='min_period', help='[Optional] Minimum period of the periodic '
+            'signal found in the pass.')
+    query.add_argument('--max-period', action='store', type=float,
+        dest='max_period', help='[Optional] Maximum period of the periodic '
+            'signal found in the pass.')
+    query.add_argument('--limit', action='store', type=int, help='[Optional] '
+        'Maximum number of events to print.')
+
+    args = parser.parse_args()
+
+    try:
+        main(args)
+    except:
+        handle_exception(sys.exc_info())
+        sys.exit(1)
@@ -42,6 +42,11 @@ def clean_signal(time, flux, dtime, dflux, dfluxerr, out, model='box'):
     :param out: Output from BLS pulse algorithm
     :type out: dict
     '''
+    # The model fits build up running sums over the light curve, so they are
+    # done in double precision even if the binned fluxes are single precision.
+    dflux = np.asarray(dflux, dtype='float64')
+    dfluxerr = np.asarray(dfluxerr, dtype='float64')
+
     # We restrict the "standard deviation" of the cluster to be 5% of the
     # size of the space.
     size = max(np.nanmax(np.absolute(out['depth_dip'])),
@@ -56,11 +61,8 @@ def clean_signal(time, flux, dtime, dflux, dfluxerr, out, model='box'):
         out['duration_dip'][ndx], out['duration_blip'][ndx],
         out['midtime_dip'][ndx], out['midtime_blip'][ndx]))
 
-    metric = lambda x, y: np.sqrt((x[0] - y[0])**2. / mean_flux_err**2. +
-        (x[1] - y[1])**2. / mean_flux_err**2.)
-
     try:
-        db = DBSCAN(eps=1., min_samples=10, metric=metric).fit(X[:,0:2])
+        db = __do_dbscan(X[:,0:2], [mean_flux_err, mean_flux_err])
         #__do_cluster_plot(db, X[:,0:2])
     except ValueError:
         logger.info('Not enough points for DBSCAN to find clusters in the '
@@ -115,17 +117,16 @@ def clean_signal(time, flux, dtime, dflux, dfluxerr, out, model='box'):
                 'like integer multiples; investigate!')
             raise RuntimeError
 
-    # Clean up the best guess period by minimizing "chatter" in the data.
-    def chatter(time, flux, P):
-        pftime = np.mod(time, P)
-        ndx = np.argsort(pftime)
-
-        return np.sum(np.diff(flux[ndx])**2. / np.diff(time[ndx])**2.)
-
+    # Clean up the best guess period by minimizing "chatter" in the data. The
+    # period found from the midtimes is uncertain by about the duration over
+    # the number of cycles in the light curve.
     mask = np.isfinite(dflux)
-    res = opt.minimize(lambda x: chatter(dtime[mask], dflux[mask], x),
-        best_period, tol=1.e-7, options={'disp':False})
-    best_period = res.x[0]
+    width = best_duration * best_period / (np.amax(dtime[mask]) -
+        np.amin(dtime[mask]))
+    best_period, nsaved = __refine_period(dtime[mask], dflux[mask],
+        best_period, width)
+    logger.info('Period refinement reused the phase order for %d trial '
+        'periods' % nsaved)
 
     logger.info('Best period: %g' % best_period)
     best_phase = np.median(np.mod(best_midtimes, best_period))
@@ -157,10 +158,117 @@ def clean_signal(time, flux, dtime, dflux, dfluxerr, out, model='box'):
         phase=best_phase)
 
 
+def __refine_period(time, flux, period, width, ngrid=33, niter=20,
+maxsize=2**21):
+    '''
+    Refine a period by minimizing the "chatter" of the light curve folded on
+    it: the sum of the squared flux differences over the squared time
+    differences of the points taken in order of phase. The chatter depends on
+    the period only through that order, so it is piecewise constant, and a
+    local optimizer started at `period` does not move off it. Instead, the
+    chatter is found on a grid of trial periods within `width` of `period`.
+    Their phases are found together, in blocks of about `maxsize` values,
+    with the points in the order of `period`; only the trial periods that
+    change that order are sorted, and the others share the chatter of
+    `period`. The best trial period (the closest to `period` among equals) is
+    then polished by bisecting for the edges of the range of periods that
+    keep its order, and taking the middle of that range.
+
+    Returns the refined period and the number of trial periods whose chatter
+    was reused without a sort.
+
+    :param time: Array of observation times
+    :type time: np.ndarray
+    :param flux: Array of fluxes observed at `times`
+    :type flux: np.ndarray
+    :param period: Initial guess for the period
+    :type period: float
+    :param width: Largest distance of the trial periods from `period`
+    :type width: float
+    :param ngrid: Number of trial periods
+    :type ngrid: int
+    :param niter: Number of bisections for each edge of the best range
+    :type niter: int
+    :param maxsize: Largest number of phases to work on at once
+    :type maxsize: int
+    '''
+    periods = period + width * np.linspace(-1., 1., ngrid)
+    chatter = np.empty((ngrid,), dtype='float64')
+    order = np.argsort(np.mod(time, period))
+    otime = time[order]
+    oflux = flux[order]
+    rows = max(1, maxsize // len(time))
+    nsaved = 0
+
+    # Trial periods that keep the order of `period` have the same chatter.
+    chatter[:] = np.sum(np.diff(oflux)**2. / np.diff(otime)**2.)
+
+    for i in xrange(0, ngrid, rows):
+        phase = np.mod(otime[None,:], periods[i:i+rows,None])
+        todo = np.any(np.diff(phase, axis=1) < 0., axis=1)
+        nsaved += np.count_nonzero(~todo)
+
+        for j in np.flatnonzero(todo):
+            ndx = np.argsort(phase[j])
+            chatter[i+j] = np.sum(np.diff(oflux[ndx])**2. /
+                np.diff(otime[ndx])**2.)
+
+    k = np.lexsort((np.absolute(periods - period), chatter))[0]
+    ptime = otime[np.argsort(np.mod(otime, periods[k]))]
+    same = lambda p: np.all(np.diff(np.mod(ptime, p)) >= 0.)
+
+    # Bisect for each edge of the range, within a grid step of the best trial
+    # period.
+    edges = []
+    for outer in (periods[k] - 2. * width / (ngrid - 1),
+    periods[k] + 2. * width / (ngrid - 1)):
+        inner = periods[k]
+        if same(outer):
+            edges.append(outer)
+            continue
+
+        for j in xrange(niter):
+            middle = 0.5 * (inner + outer)
+            if same(middle):
+                inner = middle
+            else:
+                outer = middle
+        edges.append(inner)
+
+    best = 0.5 * (edges[0] + edges[1])
+    if not same(best):
+        best = periods[k]
+
+    return best, nsaved
+
+
+def __cycle_windows(time, phase, period, halfwidth):
+    '''
+    Find the points of the sorted `time` array within `halfwidth` of the
+    center of each cycle, at `phase` plus a multiple of `period`; points
+    exactly `halfwidth` away are left out. The windows are cut at half a
+    period, so that each point falls in at most one. Returns the centers of
+    the windows and the start and end (exclusive) index of each.
+    '''
+    halfwidth = min(halfwidth, period / 2.)
+    n = np.arange(np.floor((time[0] - phase - halfwidth) / period),
+        np.ceil((time[-1] - phase + halfwidth) / period) + 1.)
+    centers = phase + n * period
+    lo = np.searchsorted(time, centers - halfwidth, side='right')
+    hi = np.searchsorted(time, centers + halfwidth, side='left')
+
+    return centers, lo, np.maximum(lo, hi)
+
+
 def __do_fit_box(p0, time, flux):
     '''
     Fit the given data with a boxcar function, given guess parameters.
 
+    The data are sorted in time once, with cumulative sums of the flux and
+    its square. Each evaluation of the squared residuals then only looks up
+    the points in each box by bisection, rather than building the model over
+    the full light curve.
+
     :param p0: Array of [duration, depth, phase, period] to use as guess
     :type p0: np.ndarray
     :param time: Array of observation times
@@ -182,7 +290,29 @@ def __do_fit_box(p0, time, flux):
 
         return flux
 
-    f = lambda x: np.sum((flux - boxcar(time, *x))**2.)
+    ndx = np.argsort(time, kind='mergesort')
+    time = time[ndx]
+    flux = flux[ndx]
+    csum = np.concatenate(([0.], np.cumsum(flux)))
+    total = np.sum(flux**2.)
+
+    def f(x):
+        duration, depth, phase, period = x
+
+        if not period > 0. or (time[-1] - time[0]) / period > len(time):
+            # Too many cycles to be worth looking up; build the model.
+            return np.sum((flux - boxcar(time, *x))**2.)
+        elif duration >= period:
+            n = len(time)
+            s = csum[-1]
+        else:
+            _, lo, hi = __cycle_windows(time, phase, period, duration / 2.)
+            n = np.sum(hi - lo)
+            s = np.sum(csum[hi] - csum[lo])
+
+        # Points in the box add (flux - depth)**2 instead of flux**2.
+        return total + n * depth**2. - 2. * depth * s
+
     pbest = opt.fmin(f, p0, disp=0)
     logger.info('Best fit boxcar parameters:\n\t' + str(pbest))
 
@@ -195,6 +325,11 @@ def __do_fit_trapezoid(p0, time, flux, frac=0.25):
     Note that since there is no guess for `tau` (ingress/egress duration),
     some fraction of the duration is used.
 
+    The data are sorted in time once, with cumulative sums of the squared
+    flux. Each evaluation of the squared residuals then only builds the
+    model for the points within the transits, which are looked up by
+    bisection.
+
     :param p0: Array of [duration, depth, phase, period] to use as guess
     :type p0: np.ndarray
     :param time: Array of observation times
@@ -222,8 +357,41 @@ def __do_fit_trapezoid(p0, time, flux, frac=0.25):
 
         return flux
 
-    f = lambda x: np.sum((flux - trapezoid(time, *x))**2.) if x[0] < 0. and \
-        x[1] >= x[2] and x[1] > 0. and x[2] > 0. and x[3] > 0. else np.inf
+    ndx = np.argsort(time, kind='mergesort')
+    time = time[ndx]
+    flux = flux[ndx]
+    csum = np.concatenate(([0.], np.cumsum(flux**2.)))
+
+    def f(x):
+        delta, T, tau, phase, period = x
+
+        if not (delta < 0. and T >= tau and T > 0. and tau > 0. and phase > 0.):
+            return np.inf
+        elif not period > 0. or (time[-1] - time[0]) / period > len(time):
+            # Too many cycles to be worth looking up; build the model.
+            return np.sum((flux - trapezoid(time, *x))**2.)
+
+        # Gather the points within each transit. Their residuals follow from
+        # the distance into the ingress or egress, which is zero on the flat
+        # bottom of the trapezoid.
+        centers, lo, hi = __cycle_windows(time, phase, period, T / 2. +
+            tau / 2.)
+        count = hi - lo
+        ndx = np.repeat(lo - np.concatenate(([0], np.cumsum(count)[:-1])),
+            count) + np.arange(np.sum(count))
+
+        resid = time[ndx]
+        resid -= np.repeat(centers, count)
+        np.absolute(resid, resid)
+        resid -= T / 2. - tau / 2.
+        np.maximum(resid, 0., resid)
+        resid *= delta / tau
+        resid += flux[ndx]
+        resid -= delta
+
+        # Points outside the transits add flux**2.
+        return csum[-1] - np.sum(csum[hi] - csum[lo]) + np.dot(resid, resid)
+
     qbest = opt.fmin(f, q0, disp=0)
     logger.info('Best fit trapezoid parameters:\n\t' + str(qbest))
 
@@ -235,6 +403,26 @@ def __do_fit_trapezoid(p0, time, flux, frac=0.25):
     return pbest
 
 
+def __do_dbscan(X, scale, eps=1., min_samples=10):
+    '''
+    Find clusters with DBSCAN, where the distance between two points is the
+    Euclidean distance with each axis divided by its `scale`. The points are
+    rescaled up front, so that DBSCAN can use its native metric and a k-d tree
+    to find neighbors, rather than calling back into Python for every pair.
+
+    :param X: Array of points, one per row
+    :type X: np.ndarray
+    :param scale: Scale of each axis (column) of `X`
+    :type scale: list
+    :param eps: Largest scaled distance between neighbors
+    :type eps: float
+    :param min_samples: Number of neighbors of a core point, itself included
+    :type min_samples: int
+    '''
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='euclidean',
+        algorithm='kd_tree').fit(X / np.asarray(scale, dtype='float64'))
+
+
 def __do_period_search(X, time, mask, step=1, err_midtime=0.1, err_flux=0.01,
 max_period_err=0.1):
     # Remove all samples not in the core of this cluster from the data array.
@@ -243,14 +431,11 @@ max_period_err=0.1):
     Y[0:-1,1] = np.diff(Y[:,4])
     Y = Y[0:-1,:]
 
-    metric = lambda x, y: np.sqrt((x[0] - y[0])**2. / err_flux**2. + \
-        (x[1] - y[1])**2. / err_midtime**2.)
-
     # Search for clusters a second time, this time to identify the period.
     # We expect a cluster around the mean value and less significant ones
     # around integer multiples of that value.
     try:
-        db = DBSCAN(eps=1., min_samples=10, metric=metric).fit(Y[:,0:2])
+        db = __do_dbscan(Y[:,0:2], [err_flux, err_midtime])
         #__do_cluster_plot(db, Y[:,0:2])
     except ValueError:
         logger.info('Not enough points for DBSCAN to find clusters in the '
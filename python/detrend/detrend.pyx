@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from numpy.polynomial import polynomial as poly
 cimport numpy as np
 cimport cython
 
 
+cdef extern int do_polyfit_window(double *time, double *flux, double *fluxerr, int n,
+    double center, int order, double threshold, int niter, unsigned char *mask,
+    double *resid, double *coeffs) nogil
+
+# Highest polynomial order supported; this must match MAX_ORDER in
+# detrend_extern.c.
+MAX_ORDER = 8
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.profile(True)
@@ -30,32 +38,78 @@ int order, double threshold=3., int niter=3):
     :param niter: Number of clipping iterations
     :type niter: int
     '''
-    cdef int i
-    cdef double sigma
     cdef np.ndarray[long, ndim=1, mode='c'] ndx
-    cdef np.ndarray[double, ndim=1, mode='c'] x, y, yerr, coeffs, resid
 
-    x = time.copy()
-    y = flux.copy()
-    yerr = fluxerr.copy()
-    i = 0
+    ndx = np.array([0, len(time)], dtype='int64')
+    return polyfit_windows(time, flux, fluxerr, ndx[:1], ndx[1:],
+        np.zeros((1,), dtype='float64'), order, threshold, niter)[0]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.profile(True)
+@cython.embedsignature(True)
+def polyfit_windows(np.ndarray[double, ndim=1, mode='c'] time,
+np.ndarray[double, ndim=1, mode='c'] flux, np.ndarray[double, ndim=1, mode='c'] fluxerr,
+np.ndarray[long, ndim=1, mode='c'] starts, np.ndarray[long, ndim=1, mode='c'] ends,
+np.ndarray[double, ndim=1, mode='c'] centers, int order, double threshold=3.,
+int niter=3):
+    '''
+    Same as ``polyfit``, but fits many windows of the data at once. Window `k`
+    holds the points from `starts[k]` to `ends[k]` (exclusive), with
+    `centers[k]` subtracted from their times. The windows may overlap. Each
+    fit accumulates the weighted normal equations in one pass over its window,
+    and clipped points are masked rather than copied out, so nothing is
+    allocated per window.
+
+    :param time: Vector of times
+    :type time: numpy.ndarray
+    :param flux: Vector of fluxes
+    :type flux: numpy.ndarray
+    :param fluxerr: Vector of flux errors
+    :type fluxerr: numpy.ndarray
+    :param starts: Index of the first point of each window
+    :type starts: numpy.ndarray
+    :param ends: Index after the last point of each window
+    :type ends: numpy.ndarray
+    :param centers: Time subtracted from the points of each window
+    :type centers: numpy.ndarray
+    :param order: Order of the fitting polynomial
+    :type order: int
+    :param threshold: Maximum multiple of the standard deviation to be allowed
+    :type threshold: float
+    :param niter: Number of clipping iterations
+    :type niter: int
+    :rtype: numpy.ndarray of shape (number of windows, `order` + 1); windows
+        with no more than `order` + 1 points are NaN
+    '''
+    cdef int i, nwindows, length
+    cdef np.ndarray[np.uint8_t, ndim=1, mode='c'] mask
+    cdef np.ndarray[double, ndim=1, mode='c'] resid
+    cdef np.ndarray[double, ndim=2, mode='c'] coeffs
 
-    while i < niter and len(x) > order + 1:
-        # Fit the current data or residuals with a polynomial.
-        coeffs = poly.polyfit(x, y, order, w=yerr)
-        resid = y - poly.polyval(x, coeffs)
+    if order < 0 or order > MAX_ORDER:
+        raise ValueError('Polynomial order must be between 0 and %d' % MAX_ORDER)
 
-        # Calcualte the root-mean-square statistic for the fit.
-        sigma = np.sqrt(np.sum(resid**2.) / len(x))
+    nwindows = starts.shape[0]
+    if ends.shape[0] != nwindows or centers.shape[0] != nwindows:
+        raise ValueError('Need the same number of window starts, ends, and centers')
+    if flux.shape[0] != time.shape[0] or fluxerr.shape[0] != time.shape[0]:
+        raise ValueError('Time, flux, and error must have the same length')
+    if nwindows > 0 and (np.any(starts < 0) or np.any(ends > time.shape[0])):
+        raise ValueError('Windows must be within the data')
 
-        # Perform the sigma clipping.
-        ndx = np.where(np.absolute(resid) < threshold * sigma)[0]
-        x = x[ndx]
-        y = y[ndx]
-        yerr = yerr[ndx]
+    # Scratch space for the clipping mask and residuals, shared by the
+    # windows since they are fitted one after another.
+    length = max(1, np.max(ends - starts)) if nwindows > 0 else 1
+    mask = np.empty((length,), dtype='uint8')
+    resid = np.empty((length,), dtype='float64')
+    coeffs = np.empty((nwindows,order+1), dtype='float64')
 
-        # Increase the iteration counter.
-        i += 1
+    with nogil:
+        for i in range(nwindows):
+            do_polyfit_window(&time[0] + starts[i], &flux[0] + starts[i],
+                &fluxerr[0] + starts[i], max(0, ends[i] - starts[i]), centers[i],
+                order, threshold, niter, &mask[0], &resid[0], &coeffs[i,0])
 
     return coeffs
-
@@ -0,0 +1,199 @@
+#include <math.h>
+#include <stdio.h>
+
+#define false           (0)
+#define true            (1)
+
+#define min(a,b)        (a < b ? a : b)
+#define max(a,b)        (a > b ? a : b)
+
+/* Highest polynomial order supported by `do_polyfit_window`. */
+#define MAX_ORDER       8
+
+
+static void solve_normal(double *a, double *b, int m, double *c)
+{
+    /**
+     * Solve the `m` x `m` symmetric positive semi-definite system a c = b in
+     * place by Cholesky decomposition. The system is scaled to a unit
+     * diagonal first, as `numpy.polynomial.polyfit` scales the columns of its
+     * design matrix. Directions that are numerically singular get a zero
+     * coefficient, much like the rank cutoff of a least-squares solver.
+     */
+    int i, j, k;
+    int skip[MAX_ORDER+1];
+    double d[MAX_ORDER+1], x;
+
+    for (i = 0; i < m; i++)
+        d[i] = (a[i*m+i] > 0.) ? sqrt(a[i*m+i]) : 1.;
+
+    for (i = 0; i < m; i++)
+    {
+        b[i] /= d[i];
+        for (j = 0; j < m; j++)
+            a[i*m+j] /= d[i] * d[j];
+    }
+
+    /* Lower triangular factor, overwriting the lower half of a. */
+    for (j = 0; j < m; j++)
+    {
+        x = a[j*m+j];
+        for (k = 0; k < j; k++)
+            x -= a[j*m+k] * a[j*m+k];
+
+        skip[j] = (x <= 1e-13);
+        a[j*m+j] = skip[j] ? 0. : sqrt(x);
+
+        for (i = j + 1; i < m; i++)
+        {
+            if (skip[j])
+            {
+                a[i*m+j] = 0.;
+                continue;
+            }
+
+            x = a[i*m+j];
+            for (k = 0; k < j; k++)
+                x -= a[i*m+k] * a[j*m+k];
+            a[i*m+j] = x / a[j*m+j];
+        }
+    }
+
+    /* Forward and back substitution. */
+    for (i = 0; i < m; i++)
+    {
+        x = b[i];
+        for (k = 0; k < i; k++)
+            x -= a[i*m+k] * c[k];
+        c[i] = skip[i] ? 0. : x / a[i*m+i];
+    }
+
+    for (i = m - 1; i >= 0; i--)
+    {
+        x = c[i];
+        for (k = i + 1; k < m; k++)
+            x -= a[k*m+i] * c[k];
+        c[i] = skip[i] ? 0. : x / a[i*m+i];
+    }
+
+    for (i = 0; i < m; i++)
+        c[i] /= d[i];
+}
+
+
+int do_polyfit_window(double *time, double *flux, double *fluxerr, int n,
+    double center, int order, double threshold, int niter,
+    unsigned char *mask, double *resid, double *coeffs)
+{
+    /**
+     * Fit a polynomial of order `order` to the `n` points of a window, with
+     * `center` subtracted from their times, weighting each point by its
+     * error (as `detrend.polyfit` always has), and clip the points more than
+     * `threshold` standard deviations away, up to `niter` times. Each fit
+     * accumulates the weighted normal equations in a single pass over the
+     * window; clipped points are only flagged in `mask`. `mask` and `resid`
+     * are scratch arrays of at least `n` values. The coefficients, lowest
+     * order first, are written to `coeffs`; they are NaN if there are never
+     * more than `order` + 1 points to fit. Returns the number of fits.
+     */
+    int i, j, k, count, nfit, m = order + 1;
+    double scale, t, p, y, w2, r, ss, sigma;
+    double pw[2*MAX_ORDER+1], a[(MAX_ORDER+1)*(MAX_ORDER+1)], b[MAX_ORDER+1];
+    double c[MAX_ORDER+1];
+
+    for (j = 0; j < m; j++)
+        coeffs[j] = NAN;
+
+    /* Times are scaled to [-1, 1] for the fit, which keeps the normal
+     * equations well conditioned; the coefficients are scaled back at the
+     * end of each fit. */
+    scale = 0.;
+    for (i = 0; i < n; i++)
+    {
+        mask[i] = true;
+        scale = max(scale, fabs(time[i] - center));
+    }
+
+    if (scale == 0.)
+        scale = 1.;
+
+    count = n;
+    nfit = 0;
+
+    while (nfit < niter && count > m)
+    {
+        for (j = 0; j < 2 * m - 1; j++)
+            pw[j] = 0.;
+        for (j = 0; j < m; j++)
+            b[j] = 0.;
+
+        for (i = 0; i < n; i++)
+        {
+            if (!mask[i])
+                continue;
+
+            t = (time[i] - center) / scale;
+            w2 = fluxerr[i] * fluxerr[i];
+            p = w2;
+
+            for (j = 0; j < m; j++)
+            {
+                pw[j] += p;
+                b[j] += p * flux[i];
+                p *= t;
+            }
+
+            for (; j < 2 * m - 1; j++)
+            {
+                pw[j] += p;
+                p *= t;
+            }
+        }
+
+        for (j = 0; j < m; j++)
+            for (k = 0; k < m; k++)
+                a[j*m+k] = pw[j+k];
+
+        solve_normal(a, b, m, c);
+        nfit++;
+
+        /* Residuals of the fit (Horner's scheme) and their root-mean-square
+         * statistic. */
+        ss = 0.;
+        for (i = 0; i < n; i++)
+        {
+            if (!mask[i])
+                continue;
+
+            t = (time[i] - center) / scale;
+            y = c[m-1];
+            for (j = m - 2; j >= 0; j--)
+                y = c[j] + y * t;
+
+            r = flux[i] - y;
+            resid[i] = r;
+            ss += r * r;
+        }
+
+        sigma = sqrt(ss / count);
+
+        /* Perform the sigma clipping. */
+        for (i = 0; i < n; i++)
+        {
+            if (mask[i] && !(fabs(resid[i]) < threshold * sigma))
+            {
+                mask[i] = false;
+                count--;
+            }
+        }
+
+        p = 1.;
+        for (j = 0; j < m; j++)
+        {
+            coeffs[j] = c[j] / p;
+            p *= scale;
+        }
+    }
+
+    return nfit;
+}
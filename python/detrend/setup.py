@@ -7,5 +7,6 @@ from Cython.Distutils import build_ext
 import numpy as np
 
 setup(cmdclass = {'build_ext': build_ext}, ext_modules =
-    [Extension('detrend', sources=['detrend.pyx'], include_dirs=[np.get_include()])])
+    [Extension('detrend', sources=['detrend.pyx','detrend_extern.c'],
+    include_dirs=[np.get_include()])])
 
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+
+'''
+Concurrent HTTP download engine with an on-disk FITS cache. Files are fetched
+by a bounded pool of threads, each of which keeps one persistent connection
+per host; transient failures are retried with exponential backoff, and
+interrupted transfers are resumed from the partial file left in the cache.
+Completed files are stored in a content-addressed cache keyed by their path
+relative to the archive root (e.g. ``0111/011138155/kplr011138155-...fits``),
+so a later run against the same archive, or any mirror of it, is served from
+disk.
+'''
+
+import os
+import re
+import time
+import errno
+import socket
+import hashlib
+import httplib
+import urlparse
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from utils import setup_logging
+
+# Basic logging configuration.
+logger = setup_logging(__file__)
+
+# Default cache size limit, in bytes; roughly 250 stars with all long-cadence
+# quarters.
+DEFAULT_CACHE_SIZE = 2 * 1024**3
+
+# Default number of concurrent downloads.
+DEFAULT_WORKERS = 4
+
+# Size of the chunks read from the network and written to disk.
+CHUNK_SIZE = 1024**2
+
+
+class FITSCache(object):
+    '''
+    Content-addressed cache of downloaded files. Each file is stored under
+    the SHA-1 digest of its key; when the total size of the cache exceeds
+    the limit, the least recently used files are evicted. Writes are atomic
+    (rename from a partial file), and only one download of a key at a time
+    writes to its resumable partial file, so several processes can share one
+    cache directory.
+    '''
+
+    def __init__(self, cachedir, max_bytes=DEFAULT_CACHE_SIZE):
+        '''
+        Open the cache, creating the directory if needed, and index the
+        files already present.
+
+        :param cachedir: Root directory of the cache
+        :type cachedir: str
+        :param max_bytes: Maximum total size of the cache, in bytes
+        :type max_bytes: int
+        '''
+        self.cachedir = os.path.abspath(os.path.expanduser(cachedir))
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.total = 0
+
+        try:
+            os.makedirs(self.cachedir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        for dirpath, _, fnames in os.walk(self.cachedir):
+            for f in fnames:
+                if not f.endswith('.fits'):
+                    continue
+
+                path = os.path.join(dirpath, f)
+                st = os.stat(path)
+                self.entries[path] = [st.st_mtime, st.st_size]
+                self.total += st.st_size
+
+
+    def get(self, key):
+        '''
+        Return the contents of the cached file for `key`, or None if it is
+        not in the cache. A hit marks the file as most recently used.
+
+        :param key: Cache key; the path of the file relative to the archive
+        :type key: str
+
+        :rtype: str
+        '''
+        path = self.__path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            with self.lock:
+                self.__forget(path)
+            return None
+
+        with self.lock:
+            try:
+                # Use the modification time for recency; many of the shared
+                # filesystems we run on are mounted with `noatime`.
+                os.utime(path, None)
+            except OSError:
+                pass
+
+            if path not in self.entries:
+                # Another process added this file after we indexed the cache.
+                self.total += len(data)
+            self.entries[path] = [time.time(), len(data)]
+
+        return data
+
+
+    def partial_path(self, key):
+        '''
+        Return the path where a partial download for `key` should be written.
+        If the file exists, its contents are the start of an interrupted
+        transfer that can be resumed.
+
+        :param key: Cache key
+        :type key: str
+
+        :rtype: str
+        '''
+        path = self.__path(key)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        return path + '.part'
+
+
+    def acquire(self, key):
+        '''
+        Return the path a new download of `key` should be written to. The
+        first caller takes a lock on the key, created with O_EXCL, and gets
+        the resumable ``partial_path``; while the lock is held, other callers,
+        in this process or another, get a file of their own, which is not
+        resumed by later downloads. Each call must be matched by a call to
+        ``release``. A lock left behind by a process that died is not broken;
+        delete it to resume that key's partial file again.
+
+        :param key: Cache key
+        :type key: str
+
+        :rtype: str
+        '''
+        partial = self.partial_path(key)
+
+        try:
+            os.close(os.open(partial + '.lock',
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return '%s.%d.%d' % (partial, os.getpid(),
+                threading.current_thread().ident)
+
+        return partial
+
+
+    def release(self, key, partial):
+        '''
+        Release a path returned by ``acquire``. An incomplete resumable
+        partial file is kept for the next download of `key`, and its lock is
+        removed; any other partial file is deleted.
+
+        :param key: Cache key
+        :type key: str
+        :param partial: Path returned by ``acquire``
+        :type partial: str
+        '''
+        if partial == self.partial_path(key):
+            partial += '.lock'
+
+        try:
+            os.unlink(partial)
+        except OSError:
+            pass
+
+
+    def commit(self, key, partial):
+        '''
+        Atomically move a completed download into the cache, then evict least
+        recently used files until the cache fits within its size limit.
+
+        :param key: Cache key
+        :type key: str
+        :param partial: Path of the completed download, from ``acquire``
+        :type partial: str
+        '''
+        path = self.__path(key)
+        size = os.path.getsize(partial)
+        os.rename(partial, path)
+
+        with self.lock:
+            self.__forget(path)
+            self.entries[path] = [time.time(), size]
+            self.total += size
+
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                oldest = min((e for e in self.entries if e != path),
+                    key=lambda e: self.entries[e][0])
+
+                try:
+                    os.unlink(oldest)
+                except OSError:
+                    pass
+
+                logger.debug('Evicted ' + oldest + ' from cache')
+                self.__forget(oldest)
+
+
+    def __forget(self, path):
+        '''
+        Drop `path` from the index; the caller must hold the lock.
+        '''
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total -= entry[1]
+
+
+    def __path(self, key):
+        '''
+        Map a cache key to its location on disk.
+        '''
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.cachedir, digest[0:2], digest + '.fits')
+
+
+class Downloader(object):
+    '''
+    Downloads files relative to a base URL with a bounded pool of threads.
+    Results are returned in the order they were requested, and at most a
+    fixed number of downloads are held in memory at any time.
+    '''
+
+    def __init__(self, baseurl, cache=None, workers=DEFAULT_WORKERS,
+    retries=3, backoff=0.5, timeout=60.):
+        '''
+        :param baseurl: URL of the archive root
+        :type baseurl: str
+        :param cache: Cache to read from and write to; None disables caching
+        :type cache: FITSCache
+        :param workers: Number of concurrent downloads
+        :type workers: int
+        :param retries: Number of times to retry a failed download
+        :type retries: int
+        :param backoff: Delay before the first retry, in seconds; doubled for
+            each subsequent retry
+        :type backoff: float
+        :param timeout: Socket timeout, in seconds
+        :type timeout: float
+        '''
+        if workers < 1:
+            raise ValueError('Number of workers must be >= 1.')
+
+        self.baseurl = baseurl if baseurl.endswith('/') else baseurl + '/'
+        self.cache = cache
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+        self.pool = ThreadPool(workers)
+
+
+    def fetch_all(self, requests):
+        '''
+        Download a sequence of files concurrently. Yields ``(tag, url,
+        data)`` for each ``(tag, path)`` in `requests`, in the same order;
+        `data` is None if the file could not be downloaded.
+
+        :param requests: Iterable of (tag, path relative to the base URL)
+        :type requests: iterable
+
+        :rtype: generator
+        '''
+        pending = deque()
+
+        for tag, path in requests:
+            pending.append((tag, self.baseurl + path,
+                self.pool.apply_async(self.fetch, (path,))))
+
+            # Bound the number of downloads in flight (and in memory), so a
+            # slow file at the head of the queue cannot let the rest pile up.
+            if len(pending) >= 2 * self.workers:
+                yield self.__next_result(pending)
+
+        while pending:
+            yield self.__next_result(pending)
+
+
+    def fetch(self, path):
+        '''
+        Download a single file, from the cache if possible. Raises
+        RuntimeError if the file cannot be downloaded.
+
+        :param path: Path of the file relative to the base URL
+        :type path: str
+
+        :rtype: str
+        '''
+        if self.cache is None:
+            return self.__download(self.baseurl + path, None)
+
+        data = self.cache.get(path)
+        if data is not None:
+            return data
+
+        partial = self.cache.acquire(path)
+
+        try:
+            data = self.__download(self.baseurl + path, partial)
+
+            try:
+                self.cache.commit(path, partial)
+            except OSError as e:
+                # The file was downloaded; it just won't be served from the
+                # cache next time.
+                logger.warning('Cannot add %s to cache: %s' % (path, str(e)))
+        finally:
+            self.cache.release(path, partial)
+
+        return data
+
+
+    def close(self):
+        '''
+        Shut down the thread pool.
+        '''
+        self.pool.close()
+        self.pool.join()
+
+
+    def __next_result(self, pending):
+        tag, url, result = pending.popleft()
+
+        try:
+            return tag, url, result.get()
+        except (RuntimeError, EnvironmentError):
+            return tag, url, None
+
+
+    def __connection(self, scheme, netloc):
+        '''
+        Return this thread's persistent connection to the given host.
+        '''
+        conns = getattr(self.local, 'conns', None)
+        if conns is None:
+            conns = self.local.conns = dict()
+
+        if (scheme, netloc) not in conns:
+            if scheme == 'https':
+                conns[(scheme, netloc)] = httplib.HTTPSConnection(netloc,
+                    timeout=self.timeout)
+            else:
+                conns[(scheme, netloc)] = httplib.HTTPConnection(netloc,
+                    timeout=self.timeout)
+
+        return conns[(scheme, netloc)]
+
+
+    def __drop_connection(self, scheme, netloc):
+        conn = self.local.conns.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+
+    def __download(self, url, partial):
+        '''
+        Download `url`, retrying transient failures. If `partial` is given,
+        the transfer is streamed to that file and resumed from its current
+        length; otherwise it is held in memory. A transfer is complete once
+        the length given by the server (Content-Length, or the total in
+        Content-Range) has been received; a shorter one is retried, resuming
+        from `partial` if given.
+        '''
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+
+        for attempt in xrange(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2**(attempt - 1))
+
+            offset = 0
+            if partial is not None and os.path.exists(partial):
+                offset = os.path.getsize(partial)
+
+            headers = dict()
+            if offset > 0:
+                headers['Range'] = 'bytes=%d-' % offset
+
+            try:
+                conn = self.__connection(scheme, netloc)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+
+                if response.status == 416 and offset > 0:
+                    # The partial file is not a prefix of this file; start
+                    # over from scratch.
+                    response.read()
+                    os.unlink(partial)
+                    continue
+                elif response.status >= 500:
+                    response.read()
+                    logger.warning('Server error %d for %s (attempt %d)' %
+                        (response.status, url, attempt + 1))
+                    continue
+                elif response.status not in (200, 206):
+                    response.read()
+                    raise RuntimeError('HTTP error %d for %s' %
+                        (response.status, url))
+
+                if response.status == 206:
+                    # Only append to the partial file if the server resumed
+                    # the transfer where it ends.
+                    m = re.match(r'bytes (\d+)-\d+/(\d+)$',
+                        response.getheader('content-range', '').strip())
+                    if m is None or int(m.group(1)) != offset:
+                        self.__drop_connection(scheme, netloc)
+                        if partial is not None:
+                            os.unlink(partial)
+                        logger.warning('Bad range in response for %s '
+                            '(attempt %d)' % (url, attempt + 1))
+                        continue
+                    expected = int(m.group(2))
+                elif response.getheader('content-length') is not None:
+                    expected = int(response.getheader('content-length'))
+                else:
+                    expected = None
+
+                if partial is None:
+                    data = response.read()
+                else:
+                    mode = 'ab' if response.status == 206 else 'wb'
+                    with open(partial, mode) as f:
+                        while True:
+                            chunk = response.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            f.write(chunk)
+
+                    with open(partial, 'rb') as f:
+                        data = f.read()
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                self.__drop_connection(scheme, netloc)
+                logger.warning('Download of %s failed (attempt %d): %s' %
+                    (url, attempt + 1, str(e)))
+                continue
+
+            if expected is not None and len(data) != expected:
+                # The connection was closed early; keep what we have and
+                # resume from there.
+                self.__drop_connection(scheme, netloc)
+                logger.warning('Incomplete download of %s (attempt %d): %d '
+                    'of %d bytes' % (url, attempt + 1, len(data), expected))
+                continue
+
+            if not data.startswith('SIMPLE'):
+                # Whatever we got, it is not a FITS file; don't let it into
+                # the cache.
+                if partial is not None:
+                    os.unlink(partial)
+                raise RuntimeError('Not a FITS file: %s' % url)
+
+            return data
+
+        raise RuntimeError('Giving up on %s after %d attempts' %
+            (url, self.retries + 1))
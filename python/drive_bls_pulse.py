@@ -5,14 +5,21 @@ import os
 import sys
 import pstats
 import cProfile
+import traceback
 import numpy as np
 import matplotlib.pyplot as plt
 from clean_signal import clean_signal
 from fits_output import BLSFitsBundler
+from result_store import open_store
 from utils import read_mapper_output, encode_array, setup_logging, \
     handle_exception
 from bls_pulse_cython import bls_pulse, bin_and_detrend
+from bls_search import bls_search, period_grid
 from argparse import ArgumentParser
+from collections import deque
+from multiprocessing import Pool
+from Queue import Queue
+from timeit import default_timer
 if sys.version_info[0] >= 3:
     from configparser import ConfigParser, NoOptionError
 else:
@@ -23,17 +30,35 @@ logger = setup_logging(__file__)
 
 np.seterr(all='ignore')
 
-def __init_parser(defaults):
+# This is a global list of default values that will be used by the argument
+# parser and the configuration parser.
+DEFAULTS = {'min_duration':'0.0416667', 'max_duration':'0.5', 'n_bins':'100',
+    'direction':'0', 'print_format':'encoded', 'verbose':'0', 'profiling':'0',
+    'clean_max':'5', 'fits_output':'1', 'fits_dir':'', 'model_type':'box',
+    'incremental_clean':'0', 'precision':'double', 'engine':'pulse',
+    'min_period':'1.', 'max_period':'20.', 'n_periods':'1000',
+    'n_phase_bins':'1000', 'fits_store':''}
+
+# Data types of the binned fluxes for each value of the `precision` option.
+PRECISIONS = {'double':'float64', 'single':'float32'}
+
+
+def __init_parser(defaults, parser=None):
     '''
     Set up an argument parser for all possible command line options. Returns
     the parser object.
 
     :param defaults: Default values of each parameter
     :type defaults: dict
+    :param parser: Existing parser to add the options to; a new one is
+        created if None
+    :type parser: argparse.ArgumentParser
 
     :rtype: argparse.ArgumentParser
     '''
-    parser = ArgumentParser()
+    if parser is None:
+        parser = ArgumentParser()
+
     parser.add_argument('-c', '--config', action='store', type=str,
         dest='config', help='Configuration file to read. Configuration '
             'supersedes command line arguments.')
@@ -74,9 +99,42 @@ def __init_parser(defaults):
     parser.add_argument('--fitsdir', action='store', type=str,
         dest='fitsdir', default=defaults['fits_dir'],
         help='[Optional] Directory for FITS output.')
+    parser.add_argument('--fitsstore', action='store', type=str,
+        dest='fitsstore', default=defaults['fits_store'],
+        help='[Optional] Write the FITS output of all stars to the result '
+            'store in this directory, rather than a file per star (see '
+            'result_store.py).')
     parser.add_argument('--model', action='store', type=str, dest='model',
         default=defaults['model_type'],
         help='[Optional] Type of model to fit (box or trapezoid)')
+    parser.add_argument('--incremental-clean', action='store_true',
+        dest='incremental', default=bool(int(defaults['incremental_clean'])),
+        help='[Optional] On each cleaning iteration, bin, detrend, and search '
+            'only the segments changed by the previous one, rather than the '
+            'whole light curve.')
+    parser.add_argument('--precision', action='store', type=str,
+        dest='precision', default=defaults['precision'],
+        help='[Optional] Precision of the binned fluxes searched by BLS pulse '
+            '(double or single).')
+    parser.add_argument('--engine', action='store', type=str,
+        dest='engine', default=defaults['engine'],
+        help='[Optional] Search to run: \'pulse\' (BLS pulse on each '
+            'segment, with signal cleaning) or \'periodic\' (periodic BLS '
+            'on the whole light curve).')
+    parser.add_argument('--minper', action='store', type=float,
+        dest='minper', default=float(defaults['min_period']),
+        help='[Optional] Shortest trial period for the periodic search '
+            '(days).')
+    parser.add_argument('--maxper', action='store', type=float,
+        dest='maxper', default=float(defaults['max_period']),
+        help='[Optional] Longest trial period for the periodic search '
+            '(days).')
+    parser.add_argument('--nsearch', action='store', type=int,
+        dest='nsearch', default=int(defaults['n_periods']),
+        help='[Optional] Number of trial periods for the periodic search.')
+    parser.add_argument('--phasebins', action='store', type=int,
+        dest='phase_bins', default=int(defaults['n_phase_bins']),
+        help='[Optional] Number of phase bins for the periodic search.')
 
     return parser
 
@@ -111,21 +169,31 @@ def __check_args(segment, mindur, maxdur, nbins, direction):
         raise ValueError('%d is not a valid value for direction.' % direction)
 
 
-def main():
+def get_parser(parser=None):
     '''
-    Main function for this module. Parses all command line arguments, reads
-    in data from stdin, and sends it to the proper BLS algorithm.
+    Returns an argument parser for all of the BLS pulse options, added to
+    `parser` if one is given. Pass the parsed arguments to ``get_config``.
+
+    :param parser: Existing parser to add the options to
+    :type parser: argparse.ArgumentParser
+
+    :rtype: argparse.ArgumentParser
+    '''
+    return __init_parser(DEFAULTS, parser=parser)
+
+
+def get_config(parser, args):
+    '''
+    Build the run configuration from the command line arguments, or from the
+    configuration file if one was given, and sanity-check it.
+
+    :param parser: Parser returned by ``get_parser``; used to report errors
+    :type parser: argparse.ArgumentParser
+    :param args: Parsed command line arguments
+    :type args: argparse.Namespace
+
+    :rtype: dict
     '''
-    # This is a global list of default values that will be used by the
-    # argument parser and the configuration parser.
-    defaults = {'min_duration':'0.0416667', 'max_duration':'0.5',
-        'n_bins':'100', 'direction':'0', 'print_format':'encoded',
-        'verbose':'0', 'profiling':'0', 'clean_max':'5', 'fits_output':'1',
-        'fits_dir':'', 'model_type':'box'}
-
-    # Set up the parser for command line arguments and read them.
-    parser = __init_parser(defaults)
-    args = parser.parse_args()
     cfg = dict()
 
     if not args.config:
@@ -145,10 +213,18 @@ def main():
         cfg['clean_max'] = args.clean_max
         cfg['fitsout'] = args.fitsout
         cfg['fitsdir'] = args.fitsdir
-        cfg['model'] = args.model_type
+        cfg['fitsstore'] = args.fitsstore
+        cfg['model'] = args.model
+        cfg['incremental'] = args.incremental
+        cfg['precision'] = args.precision
+        cfg['engine'] = args.engine
+        cfg['minper'] = args.minper
+        cfg['maxper'] = args.maxper
+        cfg['nsearch'] = args.nsearch
+        cfg['phase_bins'] = args.phase_bins
     else:
         # Configuration file was given; read it instead.
-        cp = ConfigParser(defaults)
+        cp = ConfigParser(DEFAULTS)
         cp.read(args.config)
 
         cfg['segment'] = cp.getfloat('DEFAULT', 'segment')
@@ -162,166 +238,450 @@ def main():
         cfg['clean_max'] = cp.getint('DEFAULT', 'clean_max')
         cfg['fitsout'] = cp.getboolean('DEFAULT', 'fits_output')
         cfg['fitsdir'] = cp.get('DEFAULT', 'fits_dir')
+        cfg['fitsstore'] = cp.get('DEFAULT', 'fits_store')
         cfg['model'] = cp.get('DEFAULT', 'model_type')
+        cfg['incremental'] = cp.getboolean('DEFAULT', 'incremental_clean')
+        cfg['precision'] = cp.get('DEFAULT', 'precision')
+        cfg['engine'] = cp.get('DEFAULT', 'engine')
+        cfg['minper'] = cp.getfloat('DEFAULT', 'min_period')
+        cfg['maxper'] = cp.getfloat('DEFAULT', 'max_period')
+        cfg['nsearch'] = cp.getint('DEFAULT', 'n_periods')
+        cfg['phase_bins'] = cp.getint('DEFAULT', 'n_phase_bins')
+
+    if cfg['engine'] not in ('pulse', 'periodic'):
+        parser.error('%s is not a valid engine.' % cfg['engine'])
+    if cfg['engine'] == 'periodic':
+        try:
+            period_grid(cfg['minper'], cfg['maxper'], cfg['nsearch'])
+        except ValueError as e:
+            parser.error(str(e))
+        if cfg['direction'] == 2:
+            parser.error('The periodic engine searches for dips, blips, or '
+                'either (direction -1, 1, or 0).')
+        if cfg['fitsout']:
+            logger.warning('The periodic engine does not write FITS files; '
+                'turning off FITS output.')
+            cfg['fitsout'] = False
 
-    if cfg['fitsout'] and cfg['fitsdir'] == '':
+    if cfg['fitsout'] and cfg['fitsdir'] == '' and cfg['fitsstore'] == '':
         parser.error('No FITS output directory specified.')
+    if cfg['precision'] not in PRECISIONS:
+        parser.error('%s is not a valid precision.' % cfg['precision'])
 
     # Perform any sanity-checking on the arguments.
     __check_args(cfg['segment'], cfg['mindur'], cfg['maxdur'], cfg['nbins'],
         cfg['direction'])
 
-    # Send the data to the algorithm.
-    for k, q, time, flux, fluxerr in read_mapper_output(sys.stdin):
-        logger.info('Beginning analysis for ' + k)
+    return cfg
+
+
+def analyze_star(k, time, flux, fluxerr, cfg):
+    '''
+    Run the full analysis of one star and write its FITS file if the
+    configuration asks for it. With the "pulse" engine, this is binning and
+    detrending, BLS pulse, and signal cleaning; with the "periodic" engine,
+    binning and detrending and a periodic BLS search. Returns the BLS output
+    of the last successful pass (None if there was none), the segment start
+    and end times, and the name of the FITS file (None if it was not
+    written). The time taken is logged.
+
+    :param k: Star identifier; KIC ID and cadence, e.g. "011138155_llc"
+    :type k: str
+    :param time: Time vector
+    :type time: np.ndarray
+    :param flux: Flux vector
+    :type flux: np.ndarray
+    :param fluxerr: Flux error vector
+    :type fluxerr: np.ndarray
+    :param cfg: Run configuration from ``get_config``
+    :type cfg: dict
+
+    :rtype: tuple
+    '''
+    logger.info('Beginning analysis for ' + k)
+    start = default_timer()
+
+    # Extract the array columns.
+    time = np.array(time, dtype='float64')
+    flux = np.array(flux, dtype='float64')
+    fluxerr = np.array(fluxerr, dtype='float64')
+
+    # Don't assume the times are sorted already!
+    ndx = np.argsort(time)
+    time = time[ndx]
+    flux = flux[ndx]
+    fluxerr = fluxerr[ndx]
+
+    if cfg['profile']:
+        # Turn on profiling.
+        pr = cProfile.Profile()
+        pr.enable()
+
+    if cfg.get('engine', 'pulse') == 'periodic':
+        result = __search_periodic(k, time, flux, fluxerr, cfg)
+    else:
+        result = __search_pulse(k, time, flux, fluxerr, cfg)
+
+    if cfg['profile']:
+        # Turn off profiling and print results to STDERR.
+        pr.disable()
+        ps = pstats.Stats(pr, stream=sys.stderr).sort_stats('time')
+        ps.print_stats()
+
+    logger.info('Finished analysis for %s in %.3f s' % (k, default_timer() -
+        start))
 
-        # Extract the array columns.
-        time = np.array(time, dtype='float64')
-        flux = np.array(flux, dtype='float64')
-        fluxerr = np.array(fluxerr, dtype='float64')
+    return result
 
-        # Don't assume the times are sorted already!
-        ndx = np.argsort(time)
-        time = time[ndx]
-        flux = flux[ndx]
-        fluxerr = fluxerr[ndx]
 
-        if cfg['profile']:
-            # Turn on profiling.
-            pr = cProfile.Profile()
-            pr.enable()
+def __search_pulse(k, time, flux, fluxerr, cfg):
+    '''
+    Run BLS pulse and signal cleaning on the sorted light curve of one star
+    for ``analyze_star``, and write its FITS file if the configuration asks
+    for it.
+    '''
+    if cfg['fitsout']:
+        # Set up the FITS bundler.
+        bundler = BLSFitsBundler()
+        bundler.make_header(k)
+
+    clean_out = None
+    last_out = None
+    segstart = None
+    segend = None
+    outfile = None
+
+    # In incremental mode, the binned data and detrending fits are kept
+    # between cleaning iterations, so that only the segments touched by the
+    # newly masked points are detrended and searched again.
+    state = dict() if cfg['incremental'] else None
+    segments = None
+
+    for i in xrange(cfg['clean_max']):
+        # Do ALL detrending and binning here. The main algorithm
+        # function is now separate from this functionality.
+        dtime, dflux, dfluxerr, samples, segstart, segend  = \
+            bin_and_detrend(time, flux, fluxerr, cfg['nbins'],
+                cfg['segment'], detrend_order=3, state=state,
+                dtype=PRECISIONS[cfg.get('precision', 'double')])
+
+        if np.count_nonzero(~np.isnan(dflux)) == 0:
+            logger.warning('Not enough points left to continue BLS pulse')
+            bls_out = None
+            break
+
+        if state is not None and last_out is not None:
+            segments = state['changed']
+            logger.info('Searching %d of %d segments again' % (len(segments),
+                len(segstart)))
+
+        bls_out = bls_pulse(dtime, dflux, dfluxerr, samples, cfg['nbins'],
+            cfg['segment'], cfg['mindur'], cfg['maxdur'],
+            direction=cfg['direction'], segments=segments,
+            previous=last_out, nsegments=len(segstart))
+        last_out = bls_out
+
+        if cfg['direction'] != 2:
+            # Cleaning iterations currently won't work unless direction
+            # is 2, so we don't loop in this case.
+            break
+
+        try:
+            clean_out = clean_signal(time, flux, dtime, dflux, dfluxerr,
+                bls_out, model=cfg['model'])
+        except RuntimeError:
+            break
 
         if cfg['fitsout']:
-            # Set up the FITS bundler.
-            bundler = BLSFitsBundler()
-            bundler.make_header(k)
-
-        clean_out = None
-
-        for i in xrange(cfg['clean_max']):
-            # Do ALL detrending and binning here. The main algorithm
-            # function is now separate from this functionality.
-            dtime, dflux, dfluxerr, samples, segstart, segend  = \
-                bin_and_detrend(time, flux, fluxerr, cfg['nbins'],
-                    cfg['segment'], detrend_order=3)
-
-            if np.count_nonzero(~np.isnan(dflux)) == 0:
-                logger.warning('Not enough points left to continue BLS pulse')
-                bls_out = None
-                break
-
-            bls_out = bls_pulse(dtime, dflux, dfluxerr, samples, cfg['nbins'],
-                cfg['segment'], cfg['mindur'], cfg['maxdur'],
-                direction=cfg['direction'])
-
-            if cfg['direction'] != 2:
-                # Cleaning iterations currently won't work unless direction
-                # is 2, so we don't loop in this case.
-                break
-
-            srsq_dip = bls_out['srsq_dip']
-            duration_dip = bls_out['duration_dip']
-            depth_dip = bls_out['depth_dip']
-            midtime_dip = bls_out['midtime_dip']
-            srsq_blip = bls_out['srsq_blip']
-            duration_blip = bls_out['duration_blip']
-            depth_blip = bls_out['depth_blip']
-            midtime_blip = bls_out['midtime_blip']
-
-            try:
-                clean_out = clean_signal(time, flux, dtime, dflux, dfluxerr,
-                    bls_out, model=cfg['model'])
-            except RuntimeError:
-                break
-
-            if cfg['fitsout']:
-                ndx = np.where(np.isfinite(dflux))
-                bundler.push_detrended_lightcurve(dtime[ndx], dflux[ndx],
-                    dfluxerr[ndx], clean_out=clean_out)
-                bundler.push_bls_output(bls_out, segstart, segend)
-
-        if cfg['fitsout'] and bls_out is not None:
-            # Save the detrended light curve and BLS output from the last
-            # iteration. There won't be any output from `clean_signal`,
-            # either because of the `direction` parameter or because there
-            # are no more strong periodic signals.
             ndx = np.where(np.isfinite(dflux))
             bundler.push_detrended_lightcurve(dtime[ndx], dflux[ndx],
-                dfluxerr[ndx], clean_out=None)
+                dfluxerr[ndx], clean_out=clean_out)
             bundler.push_bls_output(bls_out, segstart, segend)
 
-        if cfg['fitsout']:
-            # Save the entire FITS file, including the configuration.
-            bundler.push_config(cfg)
+    if cfg['fitsout'] and bls_out is not None:
+        # Save the detrended light curve and BLS output from the last
+        # iteration. There won't be any output from `clean_signal`,
+        # either because of the `direction` parameter or because there
+        # are no more strong periodic signals.
+        ndx = np.where(np.isfinite(dflux))
+        bundler.push_detrended_lightcurve(dtime[ndx], dflux[ndx],
+            dfluxerr[ndx], clean_out=None)
+        bundler.push_bls_output(bls_out, segstart, segend)
+
+    if cfg['fitsout']:
+        # Save the entire FITS file, including the configuration.
+        bundler.push_config(cfg)
+        if cfg.get('fitsstore', ''):
+            outfile = open_store(cfg['fitsstore']).append(k, bundler)
+        else:
             outfile = os.path.abspath(os.path.expanduser(os.path.join(
                 cfg['fitsdir'], 'KIC' + k + '.fits')))
             bundler.write_file(outfile, clobber=True)
 
-        if cfg['profile']:
-            # Turn off profiling and print results to STDERR.
-            pr.disable()
-            ps = pstats.Stats(pr, stream=sys.stderr).sort_stats('time')
-            ps.print_stats()
+    return last_out, segstart, segend, outfile
 
-        if cfg['direction'] == 2:
-            # Print output.
-            if cfg['fmt'] == 'encoded':
-                print "\t".join([k, q, encode_array(segstart),
-                    encode_array(segend), encode_array(srsq_dip),
-                    encode_array(duration_dip), encode_array(depth_dip),
-                    encode_array(midtime_dip), encode_array(srsq_blip),
-                    encode_array(duration_blip), encode_array(depth_blip),
-                    encode_array(midtime_blip)])
-            elif cfg['fmt'] == 'normal':
-                print "-" * 120
-                print "Kepler " + k
-                print "Quarters: " + q
-                print "-" * 120
-                print '{0: <7s} {1: <13s} {2: <13s} {3: <13s} {4: <13s} ' \
-                    '{5: <13s} {6: <13s} {7: <13s} {8: <13s}'.format('Segment',
-                    'Dip SR^2', 'Dip dur.', 'Dip depth', 'Dip mid.',
-                    'Blip SR^2', 'Blip dur.', 'Blip depth', 'Blip mid.')
-                for i in xrange(len(srsq_dip)):
-                    print '{0: <7d} {1: <13.6f} {2: <13.6f} {3: <13.6f} ' \
-                        '{4: <13.6f} {5: <13.6f} {6: <13.6f} {7: <13.6f} ' \
-                        '{8: <13.6f}'.format(i, srsq_dip[i], duration_dip[i],
-                        depth_dip[i], midtime_dip[i], srsq_blip[i],
-                        duration_blip[i], depth_blip[i], midtime_blip[i])
-                print "-" * 120
-                print
-                print
-            elif cfg['fmt'] == 'outfile' and cfg['fitsout']:
-                print outfile
+
+def __search_periodic(k, time, flux, fluxerr, cfg):
+    '''
+    Run the periodic BLS search on the sorted, detrended light curve of one
+    star for ``analyze_star``. There are no cleaning iterations and no FITS
+    output.
+    '''
+    dtime, dflux, dfluxerr, samples, segstart, segend = bin_and_detrend(time,
+        flux, fluxerr, cfg['nbins'], cfg['segment'], detrend_order=3)
+
+    if np.count_nonzero(np.isfinite(dflux)) < 2:
+        logger.warning('Not enough points left to continue BLS search')
+        return None, segstart, segend, None
+
+    start = default_timer()
+    bls_out = bls_search(dtime, dflux, dfluxerr, cfg['phase_bins'],
+        cfg['mindur'], cfg['maxdur'], minper=cfg['minper'],
+        maxper=cfg['maxper'], nsearch=cfg['nsearch'],
+        direction=cfg['direction'])
+
+    best = np.argmax(bls_out['srsq'])
+    logger.info('Searched %d trial periods for %s in %.3f s; best period '
+        '%.6f days' % (len(bls_out['period']), k, default_timer() - start,
+        bls_out['period'][best]))
+
+    return bls_out, segstart, segend, None
+
+
+def print_result(k, q, bls_out, segstart, segend, outfile, cfg,
+outstream=sys.stdout):
+    '''
+    Print the results for one star in the format given by the configuration.
+    The arguments after `q` are those returned by ``analyze_star``.
+
+    :param k: Star identifier; KIC ID and cadence
+    :type k: str
+    :param q: Quarters included in the light curve
+    :type q: str
+    :param bls_out: BLS output of the last pass
+    :type bls_out: dict
+    :param segstart: Segment start times
+    :type segstart: np.ndarray
+    :param segend: Segment end times
+    :type segend: np.ndarray
+    :param outfile: Name of the FITS file
+    :type outfile: str
+    :param cfg: Run configuration from ``get_config``
+    :type cfg: dict
+    :param outstream: Stream to print to
+    :type outstream: file
+    '''
+    if bls_out is None:
+        if cfg['fmt'] == 'outfile' and cfg['fitsout']:
+            print >>outstream, outfile
+        return
+
+    if cfg.get('engine', 'pulse') == 'periodic':
+        # One value per trial period; the human-readable format only shows
+        # the best one.
+        if cfg['fmt'] == 'encoded':
+            print >>outstream, "\t".join([k, q,
+                encode_array(bls_out['period']), encode_array(bls_out['srsq']),
+                encode_array(bls_out['duration']),
+                encode_array(bls_out['depth']),
+                encode_array(bls_out['midtime'])])
+        elif cfg['fmt'] == 'normal':
+            i = np.argmax(bls_out['srsq'])
+            print >>outstream, "-" * 80
+            print >>outstream, "Kepler " + k
+            print >>outstream, "Quarters: " + q
+            print >>outstream, "-" * 80
+            print >>outstream, '{0: <13s} {1: <13s} {2: <10s} {3: <9s} ' \
+                '{4: <13s}'.format('Period', 'SR^2', 'Duration', 'Depth',
+                'Midtime')
+            print >>outstream, '{0: <13.6f} {1: <13.6f} {2: <10.6f} ' \
+                '{3: <9.6f} {4: <13.6f}'.format(bls_out['period'][i],
+                bls_out['srsq'][i], bls_out['duration'][i],
+                bls_out['depth'][i], bls_out['midtime'][i])
+            print >>outstream, "-" * 80
+            print >>outstream
+            print >>outstream
+        return
+
+    if cfg['direction'] == 2:
+        srsq_dip = bls_out['srsq_dip']
+        duration_dip = bls_out['duration_dip']
+        depth_dip = bls_out['depth_dip']
+        midtime_dip = bls_out['midtime_dip']
+        srsq_blip = bls_out['srsq_blip']
+        duration_blip = bls_out['duration_blip']
+        depth_blip = bls_out['depth_blip']
+        midtime_blip = bls_out['midtime_blip']
+
+        # Print output.
+        if cfg['fmt'] == 'encoded':
+            print >>outstream, "\t".join([k, q, encode_array(segstart),
+                encode_array(segend), encode_array(srsq_dip),
+                encode_array(duration_dip), encode_array(depth_dip),
+                encode_array(midtime_dip), encode_array(srsq_blip),
+                encode_array(duration_blip), encode_array(depth_blip),
+                encode_array(midtime_blip)])
+        elif cfg['fmt'] == 'normal':
+            print >>outstream, "-" * 120
+            print >>outstream, "Kepler " + k
+            print >>outstream, "Quarters: " + q
+            print >>outstream, "-" * 120
+            print >>outstream, '{0: <7s} {1: <13s} {2: <13s} {3: <13s} ' \
+                '{4: <13s} {5: <13s} {6: <13s} {7: <13s} {8: <13s}'.format(
+                'Segment', 'Dip SR^2', 'Dip dur.', 'Dip depth', 'Dip mid.',
+                'Blip SR^2', 'Blip dur.', 'Blip depth', 'Blip mid.')
+            for i in xrange(len(srsq_dip)):
+                print >>outstream, '{0: <7d} {1: <13.6f} {2: <13.6f} ' \
+                    '{3: <13.6f} {4: <13.6f} {5: <13.6f} {6: <13.6f} ' \
+                    '{7: <13.6f} {8: <13.6f}'.format(i, srsq_dip[i],
+                    duration_dip[i], depth_dip[i], midtime_dip[i],
+                    srsq_blip[i], duration_blip[i], depth_blip[i],
+                    midtime_blip[i])
+            print >>outstream, "-" * 120
+            print >>outstream
+            print >>outstream
+        elif cfg['fmt'] == 'outfile' and cfg['fitsout']:
+            print >>outstream, outfile
+    else:
+        srsq = bls_out['srsq']
+        duration = bls_out['duration']
+        depth = bls_out['depth']
+        midtime = bls_out['midtime']
+
+        # Print output.
+        if cfg['fmt'] == 'encoded':
+            print >>outstream, "\t".join([k, q, encode_array(segstart),
+                encode_array(segend), encode_array(srsq),
+                encode_array(duration), encode_array(depth),
+                encode_array(midtime)])
+        elif cfg['fmt'] == 'normal':
+            print >>outstream, "-" * 80
+            print >>outstream, "Kepler " + k
+            print >>outstream, "Quarters: " + q
+            print >>outstream, "-" * 80
+            print >>outstream, '{0: <7s} {1: <13s} {2: <10s} {3: <9s} ' \
+                '{4: <13s}'.format('Segment', 'SR^2', 'Duration', 'Depth',
+                'Midtime')
+            for i in xrange(len(srsq)):
+                print >>outstream, '{0: <7d} {1: <13.6f} {2: <10.6f} ' \
+                    '{3: <9.6f} {4: <13.6f}'.format(i, srsq[i], duration[i],
+                    depth[i], midtime[i])
+            print >>outstream, "-" * 80
+            print >>outstream
+            print >>outstream
+        elif cfg['fmt'] == 'outfile' and cfg['fitsout']:
+            print >>outstream, outfile
+
+
+def __analyze_task(task):
+    '''
+    Run ``analyze_star`` in a worker process. Exceptions are returned rather
+    than raised, along with their traceback, since the pool would otherwise
+    lose the traceback (and, for completion order, never call back).
+    '''
+    k, q, time, flux, fluxerr, cfg = task
+
+    try:
+        return k, q, analyze_star(k, time, flux, fluxerr, cfg), None
+    except Exception:
+        return k, q, None, traceback.format_exc()
+
+
+def analyze_stars(stars, cfg, workers=1, ordered=True):
+    '''
+    Run ``analyze_star`` on each star, fanning the stars out to a pool of
+    `workers` processes if there is more than one. A single reader takes
+    stars from `stars` only as workers become free, so that at most
+    ``2 * workers`` stars are held in memory at any time, however slow some
+    of them are. Yields the star identifier, the quarters, and the output of
+    ``analyze_star`` for each star, either in input order or in the order the
+    stars finish.
+
+    :param stars: Iterable of (star identifier, quarters, time, flux, error),
+        e.g. from ``utils.read_mapper_output``
+    :type stars: iterable
+    :param cfg: Run configuration from ``get_config``
+    :type cfg: dict
+    :param workers: Number of worker processes
+    :type workers: int
+    :param ordered: Whether to yield results in input order; otherwise they
+        are yielded as they are completed
+    :type ordered: bool
+
+    :rtype: generator
+    '''
+    if workers < 1:
+        raise ValueError('Number of workers must be >= 1.')
+
+    if workers == 1:
+        for k, q, time, flux, fluxerr in stars:
+            yield k, q, analyze_star(k, time, flux, fluxerr, cfg)
+        return
+
+    pool = Pool(workers)
+    pending = deque()
+    done = Queue()
+
+    def next_result():
+        if ordered:
+            k, q, result, error = pending.popleft().get()
         else:
-            srsq = out['srsq']
-            duration = out['duration']
-            depth = out['depth']
-            midtime = out['midtime']
-            segstart = out['segstart']
-            segend = out['segend']
-
-            # Print output.
-            if cfg['fmt'] == 'encoded':
-                print "\t".join([k, q, encode_array(segstart),
-                    encode_array(segend), encode_array(srsq),
-                    encode_array(duration), encode_array(depth),
-                    encode_array(midtime)])
-            elif cfg['fmt'] == 'normal':
-                print "-" * 80
-                print "Kepler " + k
-                print "Quarters: " + q
-                print "-" * 80
-                print '{0: <7s} {1: <13s} {2: <10s} {3: <9s} {4: <13s}'.format(
-                    'Segment', 'SR^2', 'Duration', 'Depth', 'Midtime')
-                for i in xrange(len(srsq)):
-                    print '{0: <7d} {1: <13.6f} {2: <10.6f} {3: <9.6f} ' \
-                        '{4: <13.6f}'.format(i, srsq[i], duration[i],
-                        depth[i], midtime[i])
-                print "-" * 80
-                print
-                print
-            elif cfg['fmt'] == 'outfile' and cfg['fitsout']:
-                print outfile
+            pending.pop()
+            k, q, result, error = done.get()
+
+        if error is not None:
+            raise RuntimeError('Analysis of %s failed in worker:\n%s' % (k,
+                error))
+
+        return k, q, result
+
+    try:
+        for k, q, time, flux, fluxerr in stars:
+            pending.append(pool.apply_async(__analyze_task, ((k, q, time,
+                flux, fluxerr, cfg),), callback=None if ordered else
+                done.put))
+
+            # Bound the number of stars in flight, so a slow star at the
+            # head of the queue cannot let the rest pile up in memory.
+            if len(pending) >= 2 * workers:
+                yield next_result()
+
+        while pending:
+            yield next_result()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def main():
+    '''
+    Main function for this module. Parses all command line arguments, reads
+    in data from stdin, and sends it to the proper BLS algorithm.
+    '''
+    # Set up the parser for command line arguments and read them. The
+    # process options are not part of `get_parser`, since they describe how
+    # to run rather than what to compute.
+    parser = get_parser()
+    parser.add_argument('--workers', action='store', type=int,
+        dest='workers', default=1, help='[Optional] Number of stars to '
+            'analyze in parallel, each in its own process.')
+    parser.add_argument('--order', action='store', type=str, dest='order',
+        choices=['input', 'completion'], default='input',
+        help='[Optional] Print results in input order or as each star is '
+            'completed; only matters with more than one worker.')
+    args = parser.parse_args()
+    cfg = get_config(parser, args)
+
+    # Send the data to the algorithm.
+    for k, q, (bls_out, segstart, segend, outfile) in analyze_stars(
+    read_mapper_output(sys.stdin), cfg, workers=args.workers,
+    ordered=(args.order == 'input')):
+        print_result(k, q, bls_out, segstart, segend, outfile, cfg)
+        sys.stdout.flush()
 
 
 if __name__ == '__main__':
@@ -330,4 +690,3 @@ if __name__ == '__main__':
     except:
         handle_exception(sys.exc_info())
         sys.exit(1)
-
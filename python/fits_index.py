@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Index of the lightcurve files under a data root with the MAST layout
+<root>/<nnnn>/<nnnnnnnnn>/. The index maps each (KIC ID, cadence) to the
+quarters, file names, byte sizes, and modification times that actually exist,
+so ``get_data.DiskDataLoader`` only opens files that are there instead of
+probing every possible quarter timestamp. It is stored in an SQLite database.
+
+Build or refresh an index with::
+
+    python fits_index.py /path/to/lightcurves lightcurves.idx
+
+Refreshing only lists the directories whose modification time has changed
+since the last scan, or that hold a file whose size or modification time has
+changed (rewriting a file in place leaves its directory's modification time
+alone), so it is much cheaper than the first build.
+'''
+
+import os
+import re
+import sys
+import sqlite3
+from stat import S_ISDIR
+from argparse import ArgumentParser
+from utils import setup_logging, handle_exception
+
+# Basic logging configuration.
+logger = setup_logging(__file__)
+
+FITS_NAME = re.compile(r'^kplr(\d{9})-(\d{13})_(llc|slc)\.fits$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    kic TEXT,
+    cadence TEXT,
+    quarter TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (kic, cadence, path)
+);
+CREATE INDEX IF NOT EXISTS files_lookup ON files (kic, cadence, quarter);
+'''
+
+
+class FITSIndex(object):
+    '''
+    Lookup table of the lightcurve files on disk. Lookups check the
+    modification time of the star's directory (a single ``stat``) and re-list
+    it if it has changed, so files added after the index was built are still
+    found; these updates are only kept in memory unless ``refresh`` is
+    called. The indexed sizes and modification times of the files are only
+    brought up to date by ``refresh``.
+    '''
+
+    def __init__(self, indexfile):
+        '''
+        Open (or create) the index stored in `indexfile`.
+
+        :param indexfile: Path of the SQLite index file
+        :type indexfile: str
+        '''
+        self.db = sqlite3.connect(indexfile)
+        self.db.executescript(SCHEMA)
+        self.quarters = self.__quarter_lookup()
+        self.checked = dict()
+
+
+    def get_paths(self, datapath, kepler_id, quarter, suffix):
+        '''
+        Return the paths of the files for the given star, quarter, and
+        cadence that exist under `datapath`.
+
+        :param datapath: Root of the lightcurve tree
+        :type datapath: str
+        :param kepler_id: Zero-padded KIC ID
+        :type kepler_id: str
+        :param quarter: Quarter number
+        :type quarter: str
+        :param suffix: Cadence key, "llc" or "slc"
+        :type suffix: str
+
+        :rtype: list
+        '''
+        if suffix not in ('llc', 'slc'):
+            raise ValueError('Invalid cadence key: %s' % suffix)
+
+        relpath = os.path.join(kepler_id[0:4], kepler_id)
+
+        if relpath not in self.checked:
+            self.checked[relpath] = self.__check_dir(datapath, relpath)
+
+        files = self.checked[relpath]
+        if files is None:
+            cur = self.db.execute('SELECT path FROM files WHERE kic = ? AND '
+                'cadence = ? AND quarter = ? ORDER BY path', (kepler_id,
+                suffix, quarter))
+            paths = [row[0] for row in cur]
+        else:
+            paths = sorted(p for p, (kic, cadence, q, _, _) in
+                files.iteritems() if cadence == suffix and q == quarter)
+
+        return [os.path.join(datapath, p) for p in paths]
+
+
+    def refresh(self, datapath):
+        '''
+        Scan `datapath` and bring the index up to date. Only the directories
+        whose modification times have changed, or that hold an indexed file
+        whose size or modification time has changed, are listed again.
+        Returns the number of directories that were re-listed.
+
+        :param datapath: Root of the lightcurve tree
+        :type datapath: str
+
+        :rtype: int
+        '''
+        known = dict(self.db.execute('SELECT path, mtime FROM dirs'))
+        stamps = dict()
+        for path, size, mtime in self.db.execute('SELECT path, size, mtime '
+        'FROM files'):
+            stamps.setdefault(os.path.dirname(path), []).append((path, size,
+                mtime))
+        seen = set()
+        nchanged = 0
+
+        for prefix in sorted(os.listdir(datapath)):
+            if not (len(prefix) == 4 and prefix.isdigit() and
+            os.path.isdir(os.path.join(datapath, prefix))):
+                continue
+
+            for kic in sorted(os.listdir(os.path.join(datapath, prefix))):
+                relpath = os.path.join(prefix, kic)
+                fullpath = os.path.join(datapath, relpath)
+
+                try:
+                    st = os.stat(fullpath)
+                except OSError:
+                    continue
+                if not S_ISDIR(st.st_mode):
+                    continue
+
+                seen.add(relpath)
+                mtime = st.st_mtime
+                if known.get(relpath) == mtime and \
+                self.__files_current(datapath, stamps.get(relpath, [])):
+                    continue
+
+                self.__store_dir(relpath, mtime,
+                    self.__list_dir(datapath, relpath))
+                nchanged += 1
+
+        # Forget about directories that have disappeared.
+        for relpath in set(known) - seen:
+            self.__store_dir(relpath, None, dict())
+
+        self.db.commit()
+        self.checked = dict()
+
+        return nchanged
+
+
+    def close(self):
+        self.db.close()
+
+
+    def __quarter_lookup(self):
+        '''
+        Reverse the quarter prefix tables in ``get_data``; maps (cadence,
+        timestamp) to the quarter number.
+        '''
+        from get_data import LONG_QUARTER_PREFIXES, SHORT_QUARTER_PREFIXES
+
+        lookup = dict()
+        for cadence, prefixes in (('llc', LONG_QUARTER_PREFIXES),
+        ('slc', SHORT_QUARTER_PREFIXES)):
+            for q, stamps in prefixes.iteritems():
+                for s in stamps:
+                    lookup[(cadence, s)] = q
+
+        return lookup
+
+
+    def __files_current(self, datapath, stamps):
+        '''
+        Returns whether the files with the given (path, size, mtime) stamps
+        all still have those sizes and modification times.
+        '''
+        for path, size, mtime in stamps:
+            try:
+                st = os.stat(os.path.join(datapath, path))
+            except OSError:
+                return False
+
+            if st.st_size != size or st.st_mtime != mtime:
+                return False
+
+        return True
+
+
+    def __check_dir(self, datapath, relpath):
+        '''
+        Returns None if the indexed contents of this star's directory are
+        current, otherwise a fresh listing of the directory.
+        '''
+        try:
+            mtime = os.stat(os.path.join(datapath, relpath)).st_mtime
+        except OSError:
+            return dict()
+
+        row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?',
+            (relpath,)).fetchone()
+
+        if row is not None and row[0] == mtime:
+            return None
+
+        logger.debug('Index is stale for ' + relpath)
+        return self.__list_dir(datapath, relpath)
+
+
+    def __list_dir(self, datapath, relpath):
+        '''
+        List the lightcurve files in one star's directory; maps each relative
+        path to (KIC ID, cadence, quarter, size, mtime).
+        '''
+        files = dict()
+
+        for fname in os.listdir(os.path.join(datapath, relpath)):
+            m = FITS_NAME.match(fname)
+            if m is None:
+                continue
+
+            kic, stamp, cadence = m.groups()
+            quarter = self.quarters.get((cadence, stamp))
+            if quarter is None:
+                logger.warning('Unknown quarter timestamp: ' + fname)
+                continue
+
+            path = os.path.join(relpath, fname)
+            st = os.stat(os.path.join(datapath, path))
+            files[path] = (kic, cadence, quarter, st.st_size, st.st_mtime)
+
+        return files
+
+
+    def __store_dir(self, relpath, mtime, files):
+        '''
+        Replace the indexed contents of one star's directory.
+        '''
+        self.db.execute('DELETE FROM files WHERE kic = ?',
+            (os.path.basename(relpath),))
+
+        if mtime is None:
+            self.db.execute('DELETE FROM dirs WHERE path = ?', (relpath,))
+        else:
+            self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                (relpath, mtime))
+
+        self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            [(kic, cadence, q, path, size, ftime) for path, (kic, cadence, q,
+            size, ftime) in files.iteritems()])
+
+
+def main(datapath, indexfile):
+    '''
+    Build or refresh the index of `datapath`, stored in `indexfile`.
+
+    :param datapath: Root of the lightcurve tree
+    :type datapath: str
+    :param indexfile: Path of the SQLite index file
+    :type indexfile: str
+    '''
+    index = FITSIndex(indexfile)
+    nchanged = index.refresh(datapath)
+    nfiles = index.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    index.close()
+
+    logger.info('Re-listed %d directories; %d files indexed' % (nchanged,
+        nfiles))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build or refresh the index of a '
+        'Kepler lightcurve tree.')
+    parser.add_argument('datapath', action='store', help='(Root) path to the '
+        'Kepler lightcurve data, such that root is the path part '
+        '<root>/<nnnn>/<nnnnnnnnn>/.')
+    parser.add_argument('indexfile', action='store', help='Index file to '
+        'create or update.')
+    args = parser.parse_args()
+
+    try:
+        main(os.path.normpath(args.datapath), args.indexfile)
+    except:
+        handle_exception(sys.exc_info())
+        sys.exit(1)
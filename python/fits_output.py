@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import os
 import pyfits
+import tempfile
 import numpy as np
+from io import BytesIO
 
 
 class BLSFitsBundler():
     '''
     Bundles all output from BLS pulse pipeline into a single FITS file and saves
     it to disk. These files can be read by the ``postprocessing`` modules.
+
+    Each extension is written to a temporary spool file as soon as it is
+    pushed, rather than kept in memory until the end. The output file lists
+    the passes last first, so the extensions are only copied from the spool
+    to the output file, in that order, by ``write_file``; the output file is
+    assembled under a temporary name and then renamed, so that a partial
+    file never appears under the final name.
     '''
 
     def __init__(self):
@@ -17,7 +27,12 @@ class BLSFitsBundler():
         self.prihdr = None
         self.prihdu = None
         self.cfghdu = None
+
+        # The spool holds the serialized extensions; `ext_list` holds the
+        # offset and size of each one in it, in the order they were pushed.
+        self.spool = None
         self.ext_list = []
+        self.npasses = dict()
 
 
     def make_header(self, kic_cadence_id):
@@ -66,7 +81,7 @@ class BLSFitsBundler():
             temp = pyfits.FITS_rec.from_columns(cols)
             tbhdu = pyfits.BinTableHDU(temp)
 
-        self.ext_list.insert(0, tbhdu)
+        self.__push_extension(tbhdu, 'BLIP-DIP')
 
 
     def push_detrended_lightcurve(self, time, flux, fluxerr, clean_out=None):
@@ -126,7 +141,7 @@ class BLSFitsBundler():
             temp = pyfits.FITS_rec.from_columns(cols)
             tbhdu = pyfits.BinTableHDU(temp, header=hdr)        
 
-        self.ext_list.insert(0, tbhdu)
+        self.__push_extension(tbhdu, 'TIME-FLUX')
 
 
     def push_config(self, config):
@@ -158,35 +173,110 @@ class BLSFitsBundler():
     def write_file(self, fname, clobber=False):
         '''
         Write all the data stored internally in this object to a file on disk.
+        The file is written under a temporary name in the same directory and
+        renamed once it is complete.
 
         :param fname: The name of the file to save
         :type fname: str
-        :param clobber: Whether to clobber an existing output file; passed
-            directly to pyfits
+        :param clobber: Whether to clobber an existing output file
         :type clobber: bool
         '''
-        hdus = []
+        if not clobber and os.path.exists(fname):
+            raise IOError('File %s already exists.' % fname)
 
+        # The name starts with a dot, so that the partial file does not show
+        # up among the output files.
+        dirname, basename = os.path.split(os.path.abspath(fname))
+        tmpname = os.path.join(dirname, '.%s.%d.part' % (basename,
+            os.getpid()))
+
+        try:
+            with open(tmpname, 'wb') as f:
+                self.write_stream(f)
+
+            os.rename(tmpname, fname)
+        except:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+            raise
+
+
+    def write_stream(self, f):
+        '''
+        Write all the data stored internally in this object, as a FITS file,
+        to an open file at its current position, such as a shard of a
+        ``result_store.ResultStore``.
+
+        :param f: File opened for writing in binary mode
+        :type f: file
+        '''
         if self.prihdr is not None:
             self.prihdr['N_EXTEN'] = (len(self.ext_list) + 1,
                 '(n_passes * 2) + 1')
             self.prihdu = pyfits.PrimaryHDU(header=self.prihdr)
-            hdus.append(self.prihdu)
+        else:
+            self.prihdu = pyfits.PrimaryHDU()
 
-        if len(self.ext_list) > 0:
-            j = len(self.ext_list) / 2
+        # The primary HDU is written on its own, so pyfits does not know
+        # that extensions follow it. It goes through memory, as pyfits will
+        # not write to a named file that is not empty.
+        if len(self.ext_list) > 0 or self.cfghdu is not None:
+            self.prihdu.header.set('EXTEND', True, after='NAXIS')
 
-            for i in xrange(0,len(self.ext_list),2):
-                self.ext_list[i].header['EXTNAME'] = 'BLIP-DIP_Pass_%02d' % j
-                self.ext_list[i+1].header['EXTNAME'] = 'TIME-FLUX_Pass_%02d' % j
+        primary = BytesIO()
+        self.prihdu.writeto(primary)
+        f.write(primary.getvalue())
 
-                j -= 1
+        # The last pass comes first, and the configuration last.
+        extensions = self.ext_list[::-1]
+        if self.cfghdu is not None:
+            extensions.append(self.__spool(self.cfghdu))
 
-            hdus.extend(self.ext_list)
+        for offset, size in extensions:
+            self.spool.seek(offset)
+            while size > 0:
+                chunk = self.spool.read(min(size, 2**20))
+                f.write(chunk)
+                size -= len(chunk)
 
-        if self.cfghdu is not None:
-            hdus.append(self.cfghdu)
 
-        hdulist = pyfits.HDUList(hdus)
-        hdulist.writeto(fname, clobber=clobber)
+    def __push_extension(self, hdu, kind):
+        '''
+        Name an extension after its kind and pass, and append it to the spool.
+
+        :param hdu: The extension
+        :type hdu: pyfits.BinTableHDU
+        :param kind: Kind of extension, "BLIP-DIP" or "TIME-FLUX"
+        :type kind: str
+        '''
+        self.npasses[kind] = self.npasses.get(kind, 0) + 1
+        hdu.header['EXTNAME'] = '%s_Pass_%02d' % (kind, self.npasses[kind])
+        self.ext_list.append(self.__spool(hdu))
+
+
+    def __spool(self, hdu):
+        '''
+        Write an extension to the end of the spool, as it will appear in the
+        output file, and return its offset and size. pyfits only writes
+        extensions after a primary HDU, so an empty one is written first and
+        skipped.
+
+        :param hdu: The extension
+        :type hdu: pyfits.BinTableHDU
+
+        :rtype: tuple
+        '''
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+
+        primary = BytesIO()
+        pyfits.PrimaryHDU().writeto(primary)
+
+        self.spool.seek(0, os.SEEK_END)
+        offset = self.spool.tell() + len(primary.getvalue())
+        pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(self.spool)
+        self.spool.seek(0, os.SEEK_END)
 
+        return offset, self.spool.tell() - offset
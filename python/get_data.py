@@ -12,12 +12,13 @@ Reference: http://www.michael-noll.com/tutorials/writing-an-hadoop-mapreduce-pro
 
 import os
 import sys
-import urllib2
-import tempfile
 import pyfits
+from io import BytesIO
 import numpy as np
-from contextlib import contextmanager
 from argparse import ArgumentParser
+from download import FITSCache, Downloader, DEFAULT_CACHE_SIZE, \
+    DEFAULT_WORKERS
+from fits_index import FITSIndex
 from utils import encode_array, decode_array, setup_logging, handle_exception
 
 # Basic logging configuration.
@@ -32,6 +33,8 @@ logger = setup_logging(__file__)
 ################################################################################
 NUM_QUARTERS = 17
 
+MAST_URL = 'http://archive.stsci.edu/pub/kepler/lightcurves/'
+
 LONG_QUARTER_PREFIXES = {'0':['2009131105131'],
                          '1':['2009166043257'],
                          '2':['2009259160929'],
@@ -107,145 +110,162 @@ class DataStream:
 
 class MASTDataDownloader(object):
     '''
-    Retrieves data from the MAST archive over the web.
+    Retrieves data from the MAST archive over the web. Quarters are downloaded
+    concurrently and, if a cache directory is given, kept on disk so that
+    later runs do not download them again.
+
+    If `outstream` is given, every quarter is written to it as encoded text.
+    Otherwise, iterate over the downloader to get the arrays directly, as
+    with ``DiskDataLoader``.
     '''
 
-    def __init__(self, data, outstream=None):
-        for kepler_id, quarter, suffix in data:
-            # Fix kepler_id missing zero-padding
-            if len(kepler_id) < 9:
-                kepler_id = str("%09d" % int(kepler_id))
+    def __init__(self, data, outstream=None, cachedir=None,
+    cachesize=DEFAULT_CACHE_SIZE, workers=DEFAULT_WORKERS, baseurl=MAST_URL):
+        self.data = data
+        self.cachedir = cachedir
+        self.cachesize = cachesize
+        self.workers = workers
+        self.baseurl = baseurl
 
-            # Now create the URLs.
-            path = self.__get_mast_path(kepler_id, quarter, suffix)
+        if outstream is not None:
+            for kepler_id, quarter, suffix, p, arrays in self:
+                self.stream = DataStream(arrays=arrays)
 
-            for p in path:
-                # Download the requested URL.
-                try:
-                    fits_stream = self.__download_file_serialize(p)
-                    tempfile, self.stream = \
-                        self.__process_fits_object(fits_stream)
-                except RuntimeError:
+                # Write the result to STDOUT as this will be an input to a
+                # reducer that aggregates the querters together
+                outstream.write("\t".join([kepler_id + '_' + suffix,
+                    quarter.zfill(2), p, self.stream.dstream1, self.stream.dstream2,
+                    self.stream.dstream3]) + '\n')
+
+
+    def __iter__(self):
+        '''
+        Yields the Kepler ID, quarter, cadence, URL, and (time, flux, error)
+        arrays for each quarter that could be downloaded and read.
+        '''
+        if self.cachedir is not None:
+            cache = FITSCache(self.cachedir, max_bytes=self.cachesize)
+        else:
+            cache = None
+
+        downloader = Downloader(self.baseurl, cache=cache,
+            workers=self.workers)
+
+        try:
+            for (kepler_id, quarter, suffix), p, fits_stream in \
+            downloader.fetch_all(self.__get_requests(self.data)):
+                if fits_stream is None:
                     logger.error('Cannot download: ' + p)
                     continue
 
-                if outstream is not None:
-                    # Write the result to STDOUT as this will be an input to a
-                    # reducer that aggregates the querters together
-                    outstream.write("\t".join([kepler_id + '_' + suffix,
-                        quarter.zfill(2), p, self.stream.dstream1, self.stream.dstream2,
-                        self.stream.dstream3]) + '\n')
+                try:
+                    arrays = read_lightcurve(BytesIO(fits_stream))
+                except RuntimeError:
+                    logger.error('Cannot read: ' + p)
+                    continue
 
-                os.unlink(tempfile)
+                yield kepler_id, quarter, suffix, p, arrays
+        finally:
+            downloader.close()
 
 
-    def __download_file_serialize(self, uri):
+    def __get_requests(self, data):
         '''
-        Downloads the FITS file at the given URI; if that fails, attempts to
-        download the file from the backup URI. On success, returns a raw
-        character stream. On failure, output is an empty string.
+        Expand the input target list into download requests; yields the
+        (Kepler ID, quarter, cadence) tag and the path relative to the archive
+        root for each file.
         '''
-        try:
-            response = urllib2.urlopen(uri)
-            fits_stream = response.read()
-        except IOError:
-            raise RuntimeError
+        for kepler_id, quarter, suffix in data:
+            # Fix kepler_id missing zero-padding
+            if len(kepler_id) < 9:
+                kepler_id = str("%09d" % int(kepler_id))
 
-        return fits_stream
+            # Now create the paths.
+            for p in self.__get_mast_path(kepler_id, quarter, suffix):
+                yield (kepler_id, quarter, suffix), p
 
 
     def __get_mast_path(self, kepler_id, quarter, suffix):
         '''
-        Construct download path from MAST, given the Kepler ID and quarter.
+        Construct download paths relative to the MAST lightcurve root, given
+        the Kepler ID and quarter.
         '''
         prefix = kepler_id[0:4]
         path = []
 
         if suffix == 'llc':
             for p in LONG_QUARTER_PREFIXES[quarter]:
-                path.append('http://archive.stsci.edu/pub/kepler/lightcurves/' \
-                    + prefix + '/' + kepler_id + '/kplr' + kepler_id + '-' + \
-                    p + '_' + suffix + '.fits')
+                path.append(prefix + '/' + kepler_id + '/kplr' + kepler_id +
+                    '-' + p + '_' + suffix + '.fits')
         elif suffix == 'slc':
             for p in SHORT_QUARTER_PREFIXES[quarter]:
-                path.append('http://archive.stsci.edu/pub/kepler/lightcurves/' \
-                    + prefix + '/' + kepler_id + '/kplr' + kepler_id + '-' + \
-                    p + '_' + suffix + '.fits')
+                path.append(prefix + '/' + kepler_id + '/kplr' + kepler_id +
+                    '-' + p + '_' + suffix + '.fits')
         else:
             raise ValueError('Invalid cadence key: %s' % suffix)
 
         return path
 
 
-    def __process_fits_object(self, fits_string):
-        '''
-        Process FITS file object and extract info.
-        http://stackoverflow.com/questions/11892623/python-stringio-and-compatibility-with-with-statement-context-manager
-        Returns the temporary file name and DataStream object.
-        '''
-        test = ''
-        with self.__tempinput(fits_string) as tempfilename:
-            test = tempfilename
-            fitsdata = pyfits.getdata(tempfilename)
-            bjd_trunci = float(pyfits.getval(tempfilename, 'bjdrefi', ext=1))
-            bjd_truncf = float(pyfits.getval(tempfilename, 'bjdreff', ext=1))
-
-            # Note: Times are updated to be in proper reduced barycentric
-            # Julian date, RBJD = BJD - 2400000.0
-            time = fitsdata['TIME'] + bjd_trunci + bjd_truncf - 2400000.
-            pdcflux = fitsdata['PDCSAP_FLUX']
-            pdcerror = fitsdata['PDCSAP_FLUX_ERR']
-            errorflag = fitsdata['SAP_QUALITY']
-
-            ndx = np.where(errorflag == 0)
-            retval = DataStream(arrays=(time[ndx], pdcflux[ndx], pdcerror[ndx]))
-
-            # Fix for windows, returns the filename into main so that os.unlink
-            # can be called there
-            return test, retval
-
-
-    @contextmanager
-    def __tempinput(self, data):
-        '''
-        Handle old legacy code that absolutely demands a filename instead of
-        streaming file content.
-        '''
-        temp = tempfile.NamedTemporaryFile(delete=False)
-        temp.write(data)
-        temp.close()
-        yield temp.name
-
-
 class DiskDataLoader(object):
     '''
     Retrieves data from a disk given a specified root directory (relative or
     absolute). The FITS files are expected to be under that directory with the
     pathspec <root directory>/<4-digit short KepID>/<full KepID>/
+
+    If `outstream` is given, every quarter is written to it as encoded text.
+    Otherwise, iterate over the loader to get the arrays directly, without
+    encoding them; this is the cheaper option when the consumer runs in the
+    same process.
+
+    If an `index` (see ``fits_index``) is given, it is used to find the files
+    that exist for each star, instead of trying to open every possible file
+    name for the quarter.
     '''
-    def __init__(self, data, datapath, outstream=None):
-        for kepler_id, quarter, suffix in data:
+    def __init__(self, data, datapath, outstream=None, index=None):
+        self.data = data
+        self.datapath = datapath
+        self.index = index
+
+        if outstream is not None:
+            for kepler_id, quarter, suffix, p, arrays in self:
+                self.stream = DataStream(arrays=arrays)
+
+                # Write the result to STDOUT as this will be an input to a
+                # reducer that aggregates the querters together
+                outstream.write("\t".join([kepler_id + '_' + suffix,
+                    quarter.zfill(2), p, self.stream.dstream1, self.stream.dstream2,
+                    self.stream.dstream3]) + '\n')
+
+
+    def __iter__(self):
+        '''
+        Yields the Kepler ID, quarter, cadence, file path, and (time, flux,
+        error) arrays for each quarter that could be read.
+        '''
+        for kepler_id, quarter, suffix in self.data:
             # Fix kepler_id missing zero-padding
             if len(kepler_id) < 9:
                 kepler_id = str("%09d" % int(kepler_id))
 
-            # Now create the URL regardless of Quarter.
-            path = self.__get_fits_path(datapath, kepler_id, quarter, suffix)
+            if self.index is not None:
+                # Only the files that exist for this quarter.
+                path = self.index.get_paths(self.datapath, kepler_id, quarter,
+                    suffix)
+            else:
+                # Now create the URL regardless of Quarter.
+                path = self.__get_fits_path(self.datapath, kepler_id, quarter,
+                    suffix)
 
             for p in path:
-                # Read in the FITS file and create the DataStream object.
+                # Read in the FITS file.
                 try:
-                    self.stream = self.__read_fits_file(p, kepler_id)
+                    arrays = self.__read_fits_file(p)
                 except RuntimeError:
                     logger.error("Cannot read: " + p)
                     continue
 
-                if outstream is not None:
-                    # Write the result to STDOUT as this will be an input to a
-                    # reducer that aggregates the querters together
-                    outstream.write("\t".join([kepler_id + '_' + suffix,
-                        quarter.zfill(2), p, self.stream.dstream1, self.stream.dstream2,
-                        self.stream.dstream3]) + '\n')
+                yield kepler_id, quarter, suffix, p, arrays
 
 
     def __get_fits_path(self, datapath, kepler_id, quarter, suffix):
@@ -270,35 +290,74 @@ class DiskDataLoader(object):
         return path
 
 
-    def __read_fits_file(self, input_fits_file, kepler_id):
+    def __read_fits_file(self, input_fits_file):
         '''
-        Read FITS file from disk for each quarter and each object into memory.
+        Read the lightcurve columns of a FITS file on disk into memory. The
+        file is memory-mapped, so only the pages holding the headers and the
+        columns that are used are read.
         '''
-        try:
-            hdulist = pyfits.open(input_fits_file)
-        except IOError:
-            raise RuntimeError
-
-        # Otherwise we've successfully opened the FITS file, so read the data,
-        # close the FITS file, and create the DataStream object.
-        # Note: Times are updated to be in proper reduced barycentric Julian
-        # date, RBJD = BJD - 2400000.0
+        return read_lightcurve(input_fits_file, memmap=True)
+
+
+def read_lightcurve(fits_file, memmap=False):
+    '''
+    Read a Kepler lightcurve from a FITS file, given either its name or a
+    file object such as an ``io.BytesIO`` holding a downloaded file, which is
+    then parsed in memory without being written to disk. Only the TIME,
+    PDCSAP_FLUX, PDCSAP_FLUX_ERR, and SAP_QUALITY columns of the first
+    extension are converted. Returns the time, flux, and flux error of the
+    points with no quality flags set, as native-endian arrays, with times in
+    reduced barycentric Julian date, RBJD = BJD - 2400000.0. Raises
+    RuntimeError if the file is not a readable lightcurve file.
+
+    :param fits_file: FITS file name or file object
+    :type fits_file: str or file
+    :param memmap: Whether to memory-map the file, if given by name
+    :type memmap: bool
+
+    :rtype: tuple
+    '''
+    try:
+        hdulist = pyfits.open(fits_file, memmap=memmap)
+    except (IOError, ValueError):
+        raise RuntimeError('Cannot open FITS file')
+
+    try:
         fitsdata = hdulist[1].data
-        bjd_trunci = float(hdulist[1].header['bjdrefi'])
-        bjd_truncf = float(hdulist[1].header['bjdreff'])
-        time = fitsdata['TIME'] + bjd_trunci + bjd_truncf - 2400000.
-        pdcflux = fitsdata['PDCSAP_FLUX']
-        pdcerror = fitsdata['PDCSAP_FLUX_ERR']
-        errorflag = fitsdata['SAP_QUALITY']
-
-        ndx = np.where(errorflag == 0)
-        retval = DataStream(arrays=(time[ndx], pdcflux[ndx], pdcerror[ndx]))
+        bjd_trunci = float(hdulist[1].header['BJDREFI'])
+        bjd_truncf = float(hdulist[1].header['BJDREFF'])
+
+        # The quality mask is applied first, so that only the good points are
+        # copied out of the table and swapped to native byte order.
+        ndx = np.where(fitsdata.field('SAP_QUALITY') == 0)
+        time = fitsdata.field('TIME')[ndx].astype('float64')
+        flux = __native(fitsdata.field('PDCSAP_FLUX')[ndx])
+        fluxerr = __native(fitsdata.field('PDCSAP_FLUX_ERR')[ndx])
+    except (IndexError, KeyError, AttributeError):
+        raise RuntimeError('Not a lightcurve file')
+    finally:
         hdulist.close()
 
-        return retval
+    # Note: Times are updated to be in proper reduced barycentric Julian
+    # date, RBJD = BJD - 2400000.0. The offsets are added in place, in the
+    # same order as before, so the result is identical to the bit.
+    time += bjd_trunci
+    time += bjd_truncf
+    time -= 2400000.
+
+    return time, flux, fluxerr
 
 
-def main(source, datapath, instream=sys.stdin, outstream=None):
+def __native(arr):
+    '''
+    Returns `arr` in native byte order; FITS data is big-endian.
+    '''
+    return arr.astype(arr.dtype.newbyteorder('='))
+
+
+def main(source, datapath, instream=sys.stdin, outstream=None, cachedir=None,
+cachesize=DEFAULT_CACHE_SIZE, workers=DEFAULT_WORKERS, baseurl=MAST_URL,
+index=None):
     '''
     Get data from the specified source and optional data path.
 
@@ -307,20 +366,66 @@ def main(source, datapath, instream=sys.stdin, outstream=None):
     :param datapath: If ``source`` is "disk", then the path to the files;
         ignored otherwise
     :type datapath: str
+    :param cachedir: If ``source`` is "mast", the directory in which to cache
+        downloaded files; None disables the cache
+    :type cachedir: str
+    :param cachesize: Maximum size of the download cache, in bytes
+    :type cachesize: int
+    :param workers: If ``source`` is "mast", the number of concurrent
+        downloads
+    :type workers: int
+    :param baseurl: If ``source`` is "mast", the URL of the lightcurve root
+    :type baseurl: str
+    :param index: If ``source`` is "disk", the path of an index file built by
+        ``fits_index``; None to look for every possible file name
+    :type index: str
     '''
     # Read in a list of KIC IDs and Quarter numbers to process from STDIN.
-    data = __read_input(instream)
+    data = read_input(instream)
+
+    get_loader(source, datapath, data, outstream=outstream, cachedir=cachedir,
+        cachesize=cachesize, workers=workers, baseurl=baseurl, index=index)
+
+
+def get_loader(source, datapath, data, outstream=None, cachedir=None,
+cachesize=DEFAULT_CACHE_SIZE, workers=DEFAULT_WORKERS, baseurl=MAST_URL,
+index=None):
+    '''
+    Returns the loader for the specified source. If `outstream` is None,
+    nothing is read until the loader is iterated over; see
+    ``DiskDataLoader``. The other arguments are as for ``main``.
+
+    :param data: Target list, as returned by ``read_input``
+    :type data: iterable
 
+    :rtype: DiskDataLoader or MASTDataDownloader
+    '''
     # Call the correct function based on the desired source.
     if source == 'mast':
-        MASTDataDownloader(data, outstream=outstream)
+        return MASTDataDownloader(data, outstream=outstream,
+            cachedir=cachedir, cachesize=cachesize, workers=workers,
+            baseurl=baseurl)
     elif source == 'disk':
-        DiskDataLoader(data, datapath, outstream=outstream)
+        if index is not None:
+            index = FITSIndex(index)
+
+        return DiskDataLoader(data, datapath, outstream=outstream,
+            index=index)
     else:
         raise ValueError('Invalid source parameter: %s' % source)
 
 
-def __read_input(file):
+def read_input(file):
+    '''
+    Read the target list: one Kepler ID, quarter number (or "*" for all
+    quarters), and cadence ("llc" or "slc") per line. Yields [Kepler ID,
+    quarter, cadence] for each quarter.
+
+    :param file: Stream to read from
+    :type file: file
+
+    :rtype: generator
+    '''
     for line in file:
         # Split the line into words
         s = line.split()
@@ -334,21 +439,57 @@ def __read_input(file):
                 yield s
 
 
-if __name__ == "__main__":
-    # Set up the command line argument parser.
-    parser = ArgumentParser(description="Retrieve Kepler lightcurve data given "
-        "a set of Kepler IDs and Quarter numbers from STDIN.")
+def get_parser(parser=None):
+    '''
+    Set up an argument parser for the data source options, or add them to
+    `parser` if one is given. Returns the parser object.
+
+    :param parser: Existing parser to add the options to
+    :type parser: argparse.ArgumentParser
+
+    :rtype: argparse.ArgumentParser
+    '''
+    if parser is None:
+        parser = ArgumentParser(description="Retrieve Kepler lightcurve data "
+            "given a set of Kepler IDs and Quarter numbers from STDIN.")
+
     parser.add_argument("source", action="store", choices=['mast','disk'],
         help="Select the source where Kepler FITS files should be retrieved.")
     parser.add_argument("datapath", action="store", nargs='?',
         default=os.curdir+os.sep, help="(Root) path to the Kepler lightcurve "
         "data, such that root is the path part <root>/<nnnn>/<nnnnnnnnn>/.  "
         "Defaults to the current working directory.")
+    parser.add_argument("--cachedir", action="store", type=str,
+        dest="cachedir", default=os.environ.get('CLOUD_KEPLER_CACHE'),
+        help="[Optional] Directory in which to cache files downloaded from "
+        "MAST. Defaults to $CLOUD_KEPLER_CACHE; no caching if unset.")
+    parser.add_argument("--cachesize", action="store", type=float,
+        dest="cachesize", default=DEFAULT_CACHE_SIZE / 1024.**2,
+        help="[Optional] Maximum size of the download cache (MB).")
+    parser.add_argument("--workers", action="store", type=int,
+        dest="workers", default=DEFAULT_WORKERS,
+        help="[Optional] Number of concurrent downloads from MAST.")
+    parser.add_argument("--url", action="store", type=str, dest="baseurl",
+        default=MAST_URL, help="[Optional] URL of the lightcurve root on "
+        "MAST or a mirror, with the same <nnnn>/<nnnnnnnnn>/ layout.")
+    parser.add_argument("--index", action="store", type=str, dest="index",
+        default=None, help="[Optional] Index of the files under the data "
+        "path, built with fits_index.py; only files listed in the index (or "
+        "added since) are opened.")
+
+    return parser
+
+
+if __name__ == "__main__":
+    # Set up the command line argument parser.
+    parser = get_parser()
     args = parser.parse_args()
 
     try:
         main(args.source, os.path.normpath(args.datapath), instream=sys.stdin,
-            outstream=sys.stdout)
+            outstream=sys.stdout, cachedir=args.cachedir,
+            cachesize=int(args.cachesize * 1024**2), workers=args.workers,
+            baseurl=args.baseurl, index=args.index)
     except:
         handle_exception(sys.exc_info())
         sys.exit(1)
@@ -12,13 +12,73 @@ import numpy as np
 from itertools import groupby
 from operator import itemgetter
 from collections import OrderedDict
-from utils import read_mapper_output, encode_list, setup_logging, handle_exception
+from argparse import ArgumentParser
+from utils import read_mapper_output, encode_array, setup_logging, \
+    handle_exception
 
 # Basic logging configuration.
 logger = setup_logging(__file__)
 
 
-def main(instream=sys.stdin, outstream=None):
+def stitch_quarters(quarters):
+    '''
+    Join the data from several quarters of one star into single arrays sorted
+    by time. Each output array is allocated once and filled quarter by
+    quarter, in order of each quarter's first time; the full sort is only
+    done if the result is not already in order (e.g., a quarter that is not
+    sorted internally). Returns the time, flux, and error arrays, the index
+    in those arrays at which each quarter begins, and the order of the
+    quarters in the output as indices into `quarters`.
+
+    :param quarters: List of (time, flux, error) arrays, one per quarter
+    :type quarters: list
+
+    :rtype: tuple
+    '''
+    # Quarters do not overlap in time, so ordering them by start time leaves
+    # the concatenated arrays (nearly always) sorted already. Empty quarters
+    # go last.
+    order = sorted(xrange(len(quarters)), key=lambda i: np.nanmin(
+        quarters[i][0]) if len(quarters[i][0]) > 0 else np.inf)
+    quarters = [quarters[i] for i in order]
+
+    sizes = [len(t) for t, _, _ in quarters]
+    offsets = np.cumsum([0] + sizes[:-1]).astype('int64')
+    total = sum(sizes)
+
+    out = []
+    for i in xrange(3):
+        dtype = np.result_type(*[q[i].dtype for q in quarters]) if \
+            len(quarters) > 0 else np.dtype('float64')
+        buf = np.empty((total,), dtype=dtype)
+
+        for o, n, q in zip(offsets, sizes, quarters):
+            buf[o:o+n] = q[i]
+
+        out.append(buf)
+
+    time, flux, fluxerr = out
+
+    if np.any(np.diff(time) < 0.):
+        # Quarters do not overlap in time, so a stable sort never moves a
+        # point into another quarter and the offsets are still valid.
+        ndx = np.argsort(time, kind='mergesort')
+        time = time[ndx]
+        flux = flux[ndx]
+        fluxerr = fluxerr[ndx]
+
+    return time, flux, fluxerr, offsets, order
+
+
+def main(instream=sys.stdin, outstream=None, offsets=False):
+    '''
+    Join the quarters of each star read from `instream` and write one line
+    per star to `outstream`.
+
+    :param offsets: Whether to append the index at which each quarter begins
+        as an extra field on each line; see ``utils.read_mapper_output``
+    :type offsets: bool
+    '''
     data = read_mapper_output(instream, uri=True)
 
     for current_kic, group in groupby(data, itemgetter(0)):
@@ -29,33 +89,33 @@ def main(instream=sys.stdin, outstream=None):
             for _, q, time, flux, eflux in group:
                 all_quarters[q] = (time, flux, eflux)
 
-            concatenated_time = list()
-            concatenated_flux = list()
-            concatenated_eflux = list()
+            time, flux, eflux, qoffsets, order = stitch_quarters(
+                all_quarters.values())
 
-            keys, vals = (all_quarters.keys(), all_quarters.values())
+            all_q = [all_quarters.keys()[i] for i in order]
+            fields = [str(current_kic), str(all_q), encode_array(time),
+                encode_array(flux), encode_array(eflux)]
 
-            for k, v in zip(keys, vals):
-                t, f, e = v
-                concatenated_time.extend(t)
-                concatenated_flux.extend(f)
-                concatenated_eflux.extend(e)
+            if offsets:
+                fields.append(encode_array(qoffsets.astype('float64')))
 
-            all_q = list(keys)
-            outstream.write('\t'.join([str(current_kic), str(all_q),
-                encode_list(concatenated_time),
-                encode_list(concatenated_flux),
-                encode_list(concatenated_eflux)]) + '\n')
+            outstream.write('\t'.join(fields) + '\n')
         except ValueError:
             # count was not a number, so silently discard this item
             pass
 
 
 if __name__ == '__main__':
+    parser = ArgumentParser(description='Join the quarters of each star from '
+        'the output of get_data.py.')
+    parser.add_argument('--offsets', action='store_true', dest='offsets',
+        default=False, help='[Optional] Append the index at which each '
+        'quarter begins to each line.')
+    args = parser.parse_args()
+
     try:
         # input comes from STDIN (standard input)
-        main(instream=sys.stdin, outstream=sys.stdout)
+        main(instream=sys.stdin, outstream=sys.stdout, offsets=args.offsets)
     except:
         handle_exception(sys.exc_info())
         sys.exit(1)
-
@@ -1,12 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+'''
+Render the FITS output of ``drive_bls_pulse.py`` as PDF reports, one page per
+pass. The FITS file names are read from stdin, one per line, as printed by
+``drive_bls_pulse.py`` with ``print_format = outfile``, and each report is
+saved in a subdirectory of its FITS file's directory. Stars written to a
+result store (``--fitsstore``) are named as ``<store>#<key>``, and their
+reports are saved in a subdirectory of the store, as ``KIC<key>.pdf``.
+Reports that are newer than their FITS file are skipped, so an interrupted
+batch can be run again.
+'''
+
 import os
 import sys
-import Image
 import pyfits
 import cStringIO
+import traceback
 import numpy as np
+from multiprocessing import Pool
+from timeit import default_timer
 
 # Need this backend for running on remote systems.
 import matplotlib
@@ -19,30 +32,77 @@ from reportlab.lib.units import inch, cm
 from reportlab.lib.utils import ImageReader
 from reportlab.platypus import Table
 from argparse import ArgumentParser
+from result_store import open_store, split_location
 from utils import setup_logging
 
 # Basic logging configuration.
 logger = setup_logging(__file__)
 
+# Scatter plots with more points than this are thinned out before drawing.
+MAX_POINTS = 5000
 
-def make_report(infile, subdir='pdfs'):
-    outdir = os.path.join(os.path.dirname(infile), subdir)
-    try:
-        os.makedirs(outdir)
-    except OSError:
-        pass
+# Figures and axes reused from page to page (and report to report) in this
+# process, by layout; creating a figure costs more than drawing a pass.
+FIGURES = dict()
 
-    basename = '.'.join(os.path.basename(infile).split('.')[:-1])
-    outfile = os.path.join(outdir, basename + '.pdf')
 
-    logger.info('Saving output to file ' + outfile)
+def __get_figure(layout, fig_width, fig_height):
+    '''
+    Returns the figure and axes for a layout, cleared for the next pass. The
+    "fold" layout has the light curve above the folded light curve, and the
+    "lightcurve" layout only the light curve.
+
+    :param layout: Page layout, "fold" or "lightcurve"
+    :type layout: str
+    :param fig_width: Figure width, in inches
+    :type fig_width: float
+    :param fig_height: Figure height, in inches
+    :type fig_height: float
+
+    :rtype: tuple
+    '''
+    key = (layout, fig_width, fig_height)
+
+    if key not in FIGURES:
+        fig = plt.figure(figsize=(fig_width,fig_height), dpi=inch)
+        if layout == 'fold':
+            axes = (fig.add_subplot(211), fig.add_subplot(212))
+        else:
+            axes = (fig.add_subplot(111),)
+        FIGURES[key] = (fig, axes)
+
+    fig, axes = FIGURES[key]
+    for ax in axes:
+        ax.cla()
+    del fig.texts[:]
 
-    # Open the input FITS file and extract the HDUs.
-    hdulist = pyfits.open(infile)
+    return fig, axes
+
+
+def __thin(ndx, max_points):
+    '''
+    Returns at most `max_points` of the indices `ndx`, evenly spaced.
+
+    :param ndx: Indices of the points to plot
+    :type ndx: np.ndarray
+    :param max_points: Maximum number of points, or None for no limit
+    :type max_points: int
+
+    :rtype: np.ndarray
+    '''
+    if max_points is None or len(ndx) <= max_points:
+        return ndx
+    return ndx[np.linspace(0, len(ndx) - 1, max_points).astype('int64')]
+
+
+def __draw_pages(c, hdulist, max_points):
+    '''
+    Draw a page for each pass in the FITS output of one star on the canvas
+    `c`, from the last pass to the first.
+    '''
     kic_id = hdulist[0].header['kic_id']
     data_hdus = hdulist[1:-1]
 
-    c = canvas.Canvas(outfile)
     page_width, page_height = portrait(letter)
     c.setPageSize((page_width,page_height))
 
@@ -69,8 +129,7 @@ def make_report(infile, subdir='pdfs'):
         time = lc['time']
         flux = lc['flux']
         yrng = np.ptp(flux)
-
-        fig = plt.figure(figsize=(fig_width,fig_height), dpi=inch)
+        ndx = __thin(np.arange(len(time)), max_points)
 
         try:
             period = lchdr['period']
@@ -78,50 +137,56 @@ def make_report(infile, subdir='pdfs'):
             duration = lchdr['duration']
             depth = lchdr['depth']
 
+            fig, (ax1, ax2) = __get_figure('fold', fig_width, fig_height)
+
             pftime = np.mod(time, period)
             pftime2 = np.mod(time - phase + period / 2., period)
             signal_mask = ((pftime2 > 0.5 * period - 0.5 * duration) &
                 (pftime2 < 0.5 * period + 0.5 * duration))
+            signal = __thin(np.flatnonzero(signal_mask), max_points)
+            other = __thin(np.flatnonzero(~signal_mask), None if max_points
+                is None else max_points - len(signal))
 
-            plt.subplot(211)
-            plt.scatter(time, flux, color=color1, edgecolor=edgecolor,
-                alpha=alpha, s=markersize)
-            plt.xlim(time[0], time[-1])
-            plt.ylim(np.amin(flux) - 0.05 * yrng, np.amax(flux) + 0.05 * yrng)
-            plt.xlabel(r'Time (BJD)')
-            plt.ylabel(r'Flux')
-            plt.title(r'KIC' + kic_id + r', pass #%d' % count)
-
-            plt.subplot(212)
-            plt.scatter(pftime[~signal_mask], flux[~signal_mask], color=color1,
+            ax1.scatter(time[ndx], flux[ndx], color=color1,
+                edgecolor=edgecolor, alpha=alpha, s=markersize)
+            ax1.set_xlim(time[0], time[-1])
+            ax1.set_ylim(np.amin(flux) - 0.05 * yrng,
+                np.amax(flux) + 0.05 * yrng)
+            ax1.set_xlabel(r'Time (BJD)')
+            ax1.set_ylabel(r'Flux')
+            ax1.set_title(r'KIC' + kic_id + r', pass #%d' % count)
+
+            ax2.scatter(pftime[other], flux[other], color=color1,
+                edgecolor=edgecolor, alpha=alpha, s=markersize)
+            ax2.scatter(pftime[signal], flux[signal], color=color2,
                 edgecolor=edgecolor, alpha=alpha, s=markersize)
-            plt.scatter(pftime[signal_mask], flux[signal_mask],
-                color=color2, edgecolor=edgecolor, alpha=alpha, s=markersize)
-            plt.xlim(np.amin(pftime), np.amax(pftime))
-            plt.ylim(np.amin(flux) - 0.05 * yrng, np.amax(flux) + 0.05 * yrng)
-            plt.xlabel(r'Time (days)')
-            plt.ylabel(r'Flux')
-            plt.figtext(0.05, 0.02,
+            ax2.set_xlim(np.amin(pftime), np.amax(pftime))
+            ax2.set_ylim(np.amin(flux) - 0.05 * yrng,
+                np.amax(flux) + 0.05 * yrng)
+            ax2.set_xlabel(r'Time (days)')
+            ax2.set_ylabel(r'Flux')
+            fig.text(0.05, 0.02,
                 r'P = %.4f, phi = %.2f, W = %.2f, delta = %.2g' % (period,
                 phase / period, duration, depth))
 
-            plt.tight_layout()
-            plt.subplots_adjust(bottom=0.15)
+            fig.tight_layout()
+            fig.subplots_adjust(bottom=0.15)
         except KeyError:
-            plt.subplot(111)
-            plt.scatter(time, flux, color=color1, edgecolor=edgecolor,
-                alpha=alpha, s=markersize)
-            plt.xlim(time[0], time[-1])
-            plt.ylim(np.amin(flux) - 0.05 * yrng, np.amax(flux) + 0.05 * yrng)
-            plt.xlabel(r'Time (BJD)')
-            plt.ylabel(r'Flux')
-            plt.title(r'KIC' + kic_id + r', pass #%d' % count)
+            fig, (ax,) = __get_figure('lightcurve', fig_width, fig_height)
 
-            plt.tight_layout()
+            ax.scatter(time[ndx], flux[ndx], color=color1,
+                edgecolor=edgecolor, alpha=alpha, s=markersize)
+            ax.set_xlim(time[0], time[-1])
+            ax.set_ylim(np.amin(flux) - 0.05 * yrng,
+                np.amax(flux) + 0.05 * yrng)
+            ax.set_xlabel(r'Time (BJD)')
+            ax.set_ylabel(r'Flux')
+            ax.set_title(r'KIC' + kic_id + r', pass #%d' % count)
+
+            fig.tight_layout()
 
         imgdata = cStringIO.StringIO()
         fig.savefig(imgdata, format='png')
-        plt.close()
         imgdata.seek(0)
         img = ImageReader(imgdata)
         c.drawImage(img, margin * inch, 0.5 * page_height * inch,
@@ -156,10 +221,172 @@ def make_report(infile, subdir='pdfs'):
         c.showPage()
         count -= 1
 
-    c.save()
 
+def make_report(infile, subdir='pdfs', force=False, max_points=MAX_POINTS):
+    '''
+    Render the FITS output of one star as a PDF report, with a page for each
+    pass, in `subdir` of the FITS file's directory. Scatter plots with more
+    than `max_points` points are thinned out evenly; the points in the
+    signal of a folded light curve are kept before any others.
+
+    Returns the name of the report, or None if it is newer than the FITS file
+    and `force` is not set.
+
+    :param infile: FITS output file of ``drive_bls_pulse.py``, or
+        ``<store>#<key>`` for a star in a result store
+    :type infile: str
+    :param subdir: Subdirectory of the FITS file's directory (or of the
+        store) for the report
+    :type subdir: str
+    :param force: Whether to render the report even if it is up to date
+    :type force: bool
+    :param max_points: Maximum number of points per scatter plot, or None for
+        no limit
+    :type max_points: int
+
+    :rtype: str
+    '''
+    path, key = split_location(infile)
+    if key is None:
+        outdir = os.path.join(os.path.dirname(infile), subdir)
+        basename = '.'.join(os.path.basename(infile).split('.')[:-1])
+        mtime = os.path.getmtime(infile)
+    else:
+        # Look for stars written since the store was opened.
+        store = open_store(path)
+        if key not in store:
+            store.refresh()
+        outdir = os.path.join(path, subdir)
+        basename = 'KIC' + key
+        mtime = store.stat(key)[1]
 
-if __name__ == '__main__':
-    for line in sys.stdin:
-        make_report(line)
+    try:
+        os.makedirs(outdir)
+    except OSError:
+        pass
+
+    outfile = os.path.join(outdir, basename + '.pdf')
+
+    if not force and os.path.exists(outfile) and \
+    os.path.getmtime(outfile) >= mtime:
+        logger.info('Report ' + outfile + ' is up to date; skipping')
+        return None
+
+    logger.info('Saving output to file ' + outfile)
+    start = default_timer()
 
+    # The report is only given its name once complete, so that an
+    # interrupted run does not leave a partial report that looks up to date.
+    tmpfile = os.path.join(outdir, '.%s.%d.part' % (basename + '.pdf',
+        os.getpid()))
+
+    # Open the input FITS file and draw a page for each pass.
+    hdulist = pyfits.open(infile if key is None else store.open(key))
+
+    try:
+        c = canvas.Canvas(tmpfile)
+        __draw_pages(c, hdulist, max_points)
+        c.save()
+        os.rename(tmpfile, outfile)
+    except:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    finally:
+        hdulist.close()
+
+    logger.info('Rendered %s in %.3f s' % (outfile, default_timer() - start))
+    return outfile
+
+
+def __report_task(task):
+    '''
+    Run ``make_report`` in a worker process. Exceptions are returned rather
+    than raised, along with their traceback, since the pool would otherwise
+    lose the traceback.
+    '''
+    infile, kwargs = task
+
+    try:
+        return infile, make_report(infile, **kwargs), None
+    except Exception:
+        return infile, None, traceback.format_exc()
+
+
+def make_reports(infiles, workers=1, **kwargs):
+    '''
+    Run ``make_report`` on each FITS file, fanning the files out to a pool
+    of `workers` processes if there is more than one. Each process keeps its
+    figures from report to report. Yields the name of each FITS file and of
+    its report (None if skipped), in the order the reports are completed.
+
+    :param infiles: Iterable of FITS output files of ``drive_bls_pulse.py``,
+        or locations of stars in result stores
+    :type infiles: iterable
+    :param workers: Number of worker processes
+    :type workers: int
+    :param kwargs: Options for ``make_report``
+    :type kwargs: dict
+
+    :rtype: generator
+    '''
+    if workers < 1:
+        raise ValueError('Number of workers must be >= 1.')
+
+    if workers == 1:
+        for infile in infiles:
+            yield infile, make_report(infile, **kwargs)
+        return
+
+    pool = Pool(workers)
+
+    try:
+        for infile, outfile, error in pool.imap_unordered(__report_task,
+        ((infile, kwargs) for infile in infiles)):
+            if error is not None:
+                raise RuntimeError('Report for %s failed in worker:\n%s' %
+                    (infile, error))
+            yield infile, outfile
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def main():
+    '''
+    Main function for this module. Parses the command line arguments and
+    renders a report for each FITS file named on stdin.
+    '''
+    parser = ArgumentParser(description='Render the FITS output of '
+        'drive_bls_pulse.py, named on stdin, as PDF reports.')
+    parser.add_argument('--workers', action='store', type=int,
+        dest='workers', default=1, help='[Optional] Number of reports to '
+            'render in parallel, each in its own process.')
+    parser.add_argument('--subdir', action='store', type=str,
+        dest='subdir', default='pdfs', help='[Optional] Subdirectory of '
+            'each FITS file\'s directory for its report.')
+    parser.add_argument('--force', action='store_true', dest='force',
+        help='[Optional] Render reports even if they are newer than their '
+            'FITS files.')
+    parser.add_argument('--maxpoints', action='store', type=int,
+        dest='max_points', default=MAX_POINTS, help='[Optional] Thin out '
+            'scatter plots with more points than this; 0 for no limit.')
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error('Number of workers must be >= 1.')
+    if args.max_points < 0:
+        parser.error('Maximum number of points must be >= 0.')
+
+    infiles = (line.strip() for line in sys.stdin if line.strip())
+    for _ in make_reports(infiles, workers=args.workers, subdir=args.subdir,
+    force=args.force, max_points=args.max_points or None):
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -4,29 +4,120 @@ import pyfits
 import numpy as np
 
 
-class BLSOutput():
-    def __init__(self, fname):
-        self.hdulist = pyfits.open(fname)
+class _PassList(object):
+    '''
+    Read-only list of the tables of one kind, one per pass, in file order (the
+    last pass first). Each table is read the first time it is asked for and
+    kept; when the file is memory-mapped, the tables are views of the map
+    rather than copies.
+    '''
 
+    def __init__(self, hdulist, start, stop):
+        self.hdulist = hdulist
+        self.start = start
+        self.stop = stop
+        self.cache = dict()
 
-    def __getattr__(self, name):
-        if name.lower() == 'dipblips':
-            return [np.array(db.data) for db in self.hdulist[1:-1:2]]
-        elif name.lower() == 'lightcurves':
-            return [np.array(lc.data) for lc in self.hdulist[2:-1:2]]
-        elif name.lower() == 'params':
-            return dict(self.hdulist[-1].data)
-        elif name.lower() == 'num_passes':
-            return (int(self.hdulist[0].header['N_EXTEN']) - 1) / 2
-        elif name.lower() == 'kic':
-            return self.hdulist[0].header['KIC_ID']
+
+    def __len__(self):
+        return max(self.stop - self.start + 1, 0) // 2
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('Pass index out of range')
+
+        if i not in self.cache:
+            self.cache[i] = self.hdulist[self.start + 2 * i].data.view(
+                np.ndarray)
+        return self.cache[i]
+
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class BLSOutput(object):
+    '''
+    Wrapper around the FITS output of ``drive_bls_pulse.py`` for one star.
+    Use it as a context manager to close the file when done::
+
+        with BLSOutput('KIC011138155.fits') as out:
+            for bls in out.dipblips:
+                ...
+    '''
+
+    def __init__(self, fname, memmap=True, header_only=False):
+        '''
+        :param fname: FITS file name, or a file object such as those returned
+            by ``result_store.ResultStore.open``
+        :type fname: str or file
+        :param memmap: Whether to memory-map the file, so that the tables are
+            only read from disk when used
+        :type memmap: bool
+        :param header_only: Only read the primary header, for quick scans of
+            the KIC ID and number of passes of many files
+        :type header_only: bool
+        '''
+        self.hdulist = None
+        self.header = None
+        self.cache = dict()
+
+        if header_only:
+            self.header = pyfits.getheader(fname, 0)
         else:
+            self.hdulist = pyfits.open(fname, memmap=memmap)
+            self.header = self.hdulist[0].header
+
+
+    def __getattr__(self, name):
+        name = name.lower()
+        if name == 'num_passes':
+            return (int(self.header['N_EXTEN']) - 1) / 2
+        elif name == 'kic':
+            return self.header['KIC_ID']
+        elif name not in ('dipblips', 'lightcurves', 'params'):
             raise AttributeError('No such member')
 
+        if self.hdulist is None:
+            raise RuntimeError('Only the primary header was read.')
+
+        if name not in self.cache:
+            if name == 'dipblips':
+                self.cache[name] = _PassList(self.hdulist, 1,
+                    len(self.hdulist) - 1)
+            elif name == 'lightcurves':
+                self.cache[name] = _PassList(self.hdulist, 2,
+                    len(self.hdulist) - 1)
+            else:
+                self.cache[name] = dict(self.hdulist[-1].data)
+        return self.cache[name]
+
+
+    def close(self):
+        '''
+        Close the file. Tables read before then remain usable.
+        '''
+        if self.hdulist is not None:
+            self.hdulist.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
 
     def __del__(self):
         try:
-            self.hdulist.close()
-        except AttributeError, OSError:
+            self.close()
+        except (AttributeError, OSError):
             pass
-
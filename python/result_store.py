@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Consolidated store for the FITS output of many stars, as an alternative to
+one file per star in the FITS output directory. A store is a directory of
+shards. Every process that writes to the store appends to a shard of its own,
+``<host>-<pid>.dat``, so that many workers (on one or more hosts) can write
+at once without locking. A shard holds the FITS files written by
+``fits_output.BLSFitsBundler`` one after the other, each unchanged, and its
+index, ``<host>-<pid>.idx``, has a line for each of them with the star's key
+(KIC ID and cadence), the offset and size of its FITS file in the shard, and
+the time it was written.
+
+A star's FITS file is written to the shard, and synced to disk, before its
+index line, so a process or host that dies while writing leaves no index line
+for the star, and readers never see a partial file. Readers look stars up in
+the indexes of all the shards, without reading the shards themselves. The FITS
+file of a star can be opened with ``pyfits`` or
+``postprocessing.read_bls_fits.BLSOutput``.
+
+If a star was written more than once, the copy used is the last one in its
+shard's index; between shards, it is the one with the latest write time (and
+the last shard by name if the times are equal). Write times come from the
+clock of the host that wrote the shard, so copies written by different hosts
+less than their clock skew apart may be picked either way; rerun a star on
+one host, or into a new store, to be sure which copy is used.
+
+``drive_bls_pulse.py`` prints the location of a star in a store as
+``<store>#<key>``; ``split_location`` splits it up again, and ``make_report.py``
+and ``catalog.py`` read stores as well as plain FITS files.
+
+List the stars in a store, or extract the FITS file of one of them, with::
+
+    python result_store.py /path/to/store [011138155_llc KIC011138155.fits]
+'''
+
+import os
+import sys
+import socket
+from io import BytesIO
+from time import time
+from argparse import ArgumentParser
+from utils import setup_logging, handle_exception
+
+# Basic logging configuration.
+logger = setup_logging(__file__)
+
+# Result stores opened by this process, by directory; see ``open_store``.
+STORES = dict()
+
+
+class ResultStore(object):
+    '''
+    Sharded, append-only store of the FITS output of many stars.
+    '''
+
+    def __init__(self, path):
+        '''
+        Open the store in the directory `path`, which is created if it does
+        not exist.
+
+        :param path: Directory of the store
+        :type path: str
+        '''
+        self.path = os.path.abspath(os.path.expanduser(path))
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+
+        self.pid = None
+        self.shard = None
+        self.index = None
+        self.entries = None
+
+
+    def append(self, key, bundler):
+        '''
+        Write the FITS file of one star to this process's shard. Returns the
+        location of the star in the store, ``<store>#<key>``.
+
+        :param key: Star identifier; KIC ID and cadence, e.g. "011138155_llc"
+        :type key: str
+        :param bundler: Output of the star
+        :type bundler: fits_output.BLSFitsBundler
+
+        :rtype: str
+        '''
+        if not key or any(c in key for c in '\t\n#'):
+            raise ValueError('Invalid key: %r' % key)
+
+        self.__open_shard()
+
+        self.shard.seek(0, os.SEEK_END)
+        offset = self.shard.tell()
+        bundler.write_stream(self.shard)
+        self.shard.flush()
+        os.fsync(self.shard.fileno())
+        size = self.shard.tell() - offset
+
+        # The index line goes in a single write, after the data.
+        written = time()
+        self.index.write('%s\t%d\t%d\t%.6f\n' % (key, offset, size, written))
+        self.index.flush()
+
+        if self.entries is not None:
+            self.entries[key] = (self.__shard_name(), offset, size, written)
+
+        return '%s#%s' % (self.path, key)
+
+
+    def keys(self):
+        '''
+        Returns the keys of the stars in the store.
+
+        :rtype: list
+        '''
+        if self.entries is None:
+            self.refresh()
+        return sorted(self.entries.keys())
+
+
+    def __contains__(self, key):
+        if self.entries is None:
+            self.refresh()
+        return key in self.entries
+
+
+    def open(self, key):
+        '''
+        Returns the FITS file of a star as a file object, which can be passed
+        to ``pyfits.open`` or ``BLSOutput``. Raises KeyError if the star is not
+        in the store.
+
+        :param key: Star identifier; KIC ID and cadence
+        :type key: str
+
+        :rtype: io.BytesIO
+        '''
+        if self.entries is None:
+            self.refresh()
+
+        name, offset, size, _ = self.entries[key]
+        with open(os.path.join(self.path, name + '.dat'), 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+
+        if len(data) != size:
+            raise IOError('Shard %s is shorter than its index.' % name)
+
+        return BytesIO(data)
+
+
+    def stat(self, key):
+        '''
+        Returns the size of the FITS file of a star and the time it was
+        written, as ``os.stat`` would for a file of its own. Raises KeyError
+        if the star is not in the store.
+
+        :param key: Star identifier; KIC ID and cadence
+        :type key: str
+
+        :rtype: tuple
+        '''
+        if self.entries is None:
+            self.refresh()
+
+        _, _, size, written = self.entries[key]
+        return size, written
+
+
+    def refresh(self):
+        '''
+        Read the indexes of all the shards again, to find the stars written
+        since the store was opened.
+        '''
+        entries = dict()
+
+        for fname in sorted(os.listdir(self.path)):
+            if not fname.endswith('.idx'):
+                continue
+            name = fname[:-len('.idx')]
+
+            with open(os.path.join(self.path, fname), 'r') as f:
+                for line in f:
+                    # A line without its newline is still being written.
+                    fields = line.split('\t')
+                    if not line.endswith('\n') or len(fields) != 4:
+                        continue
+
+                    key = fields[0]
+                    entry = (name, int(fields[1]), int(fields[2]),
+                        float(fields[3]))
+                    if key not in entries or entries[key][0] == name or \
+                    entry[3] >= entries[key][3]:
+                        entries[key] = entry
+
+        self.entries = entries
+
+
+    def close(self):
+        '''
+        Close this process's shard.
+        '''
+        if self.shard is not None:
+            self.shard.close()
+            self.index.close()
+        self.pid = None
+        self.shard = None
+        self.index = None
+
+
+    def __shard_name(self):
+        return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+    def __open_shard(self):
+        '''
+        Open this process's shard and its index for appending. A process
+        forked after the store was opened gets a shard of its own.
+        '''
+        if self.shard is not None and self.pid == os.getpid():
+            return
+
+        # Leave the parent's files to the parent.
+        self.shard = None
+        self.index = None
+
+        name = os.path.join(self.path, self.__shard_name())
+        self.shard = open(name + '.dat', 'ab')
+        self.index = open(name + '.idx', 'a+')
+        self.pid = os.getpid()
+
+        # An earlier process with the same ID may have died while writing an
+        # index line; end that line, so that it is skipped.
+        self.index.seek(0, os.SEEK_END)
+        if self.index.tell() > 0:
+            self.index.seek(-1, os.SEEK_END)
+            if self.index.read(1) != '\n':
+                self.index.write('\n')
+                self.index.flush()
+
+
+def open_store(path):
+    '''
+    Returns the result store in directory `path`, opening it the first time
+    it is asked for in this process. A process then appends to one shard, and
+    reads the indexes once, from star to star.
+
+    :param path: Directory of the store
+    :type path: str
+
+    :rtype: ResultStore
+    '''
+    path = os.path.abspath(os.path.expanduser(path))
+    if path not in STORES:
+        STORES[path] = ResultStore(path)
+    return STORES[path]
+
+
+def split_location(location):
+    '''
+    Split the location of a star's FITS output, as printed by
+    ``drive_bls_pulse.py``, into the directory of its result store and its
+    key. For a plain FITS file, returns the file name and None.
+
+    :param location: ``<store>#<key>``, or a FITS file name
+    :type location: str
+
+    :rtype: tuple
+    '''
+    path, sep, key = location.rpartition('#')
+    if sep and key and os.path.isdir(path):
+        return path, key
+    return location, None
+
+
+def main(path, key=None, outfile=None):
+    '''
+    List the stars in the store at `path`, or write the FITS file of star
+    `key` to `outfile`.
+    '''
+    store = ResultStore(path)
+
+    if key is None:
+        for k in store.keys():
+            print k
+        return
+
+    with open(outfile, 'wb') as f:
+        f.write(store.open(key).read())
+    logger.info('Wrote %s to %s' % (key, outfile))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='List the stars in a result store, '
+        'or extract the FITS file of one of them.')
+    parser.add_argument('store', help='Directory of the store')
+    parser.add_argument('key', nargs='?', help='Star to extract, e.g. '
+        '011138155_llc')
+    parser.add_argument('outfile', nargs='?', help='FITS file to write')
+    args = parser.parse_args()
+
+    if args.key is not None and args.outfile is None:
+        parser.error('No output file given.')
+
+    try:
+        main(args.store, args.key, args.outfile)
+    except:
+        handle_exception(sys.exc_info())
+        sys.exit(1)
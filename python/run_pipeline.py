@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Run the whole pipeline in one process. This is equivalent to::
+
+    cat targets.txt | python get_data.py <source> <datapath> | sort | \
+        python join_quarters.py | python drive_bls_pulse.py -c <config>
+
+and takes the same target list on STDIN, the same data source options as
+``get_data.py``, and the same options (or configuration file) as
+``drive_bls_pulse.py``; the output is identical. The light curves are passed
+between the stages as arrays, so nothing is encoded, written to a pipe, and
+decoded again between the stages. As with ``sort`` (or the shuffle between
+the mapper and the reducer in Hadoop), the stars are analyzed once each, in
+order of their identifiers, wherever their quarters are in the target list.
+'''
+
+import os
+import sys
+from itertools import groupby
+from operator import itemgetter
+from collections import OrderedDict
+from argparse import ArgumentParser
+from get_data import get_loader, read_input, get_parser as get_data_parser
+from join_quarters import stitch_quarters
+from drive_bls_pulse import analyze_star, print_result, get_config, \
+    get_parser as get_bls_parser
+from utils import setup_logging, handle_exception
+
+# Basic logging configuration.
+logger = setup_logging(__file__)
+
+
+def sort_targets(data):
+    '''
+    Sort the target list by star identifier (zero-padded KIC ID and cadence),
+    so that the loader reads the quarters of each star one after the other.
+
+    :param data: Target list, as returned by ``get_data.read_input``
+    :type data: iterable
+
+    :rtype: list
+    '''
+    def star_key(target):
+        kepler_id, _, suffix = target
+        if len(kepler_id) < 9:
+            kepler_id = str('%09d' % int(kepler_id))
+        return kepler_id + '_' + suffix
+
+    return sorted(data, key=star_key)
+
+
+def iter_stars(loader):
+    '''
+    Join the quarters read by `loader` into one light curve per star, in the
+    same way as ``sort | join_quarters``. The quarters of a star must be
+    adjacent in the loader's output; see ``sort_targets``. Within a star, they
+    are taken in the order of ``sort``, by quarter and then by file, so that
+    the same copy of a duplicate quarter is kept. Yields the star identifier
+    (KIC ID and cadence), the list of quarters, and the time, flux, and error
+    arrays.
+
+    :param loader: Loader returned by ``get_data.get_loader``
+    :type loader: DiskDataLoader or MASTDataDownloader
+
+    :rtype: generator
+    '''
+    quarters = ((kepler_id + '_' + suffix, quarter.zfill(2), p, arrays) for
+        kepler_id, quarter, suffix, p, arrays in loader)
+
+    for k, group in groupby(quarters, itemgetter(0)):
+        all_quarters = OrderedDict()
+
+        # Patch to remove duplicate quarters.
+        for _, q, _, arrays in sorted(group, key=itemgetter(1, 2)):
+            all_quarters[q] = arrays
+
+        time, flux, fluxerr, _, order = stitch_quarters(
+            all_quarters.values())
+        all_q = [all_quarters.keys()[i] for i in order]
+
+        yield k, str(all_q), time, flux, fluxerr
+
+
+def main(source, datapath, cfg, instream=sys.stdin, outstream=sys.stdout,
+**kwargs):
+    '''
+    Read the target list from `instream`, analyze each star, and print the
+    results to `outstream`.
+
+    :param source: Either "disk" or "mast"
+    :type source: str
+    :param datapath: If ``source`` is "disk", then the path to the files;
+        ignored otherwise
+    :type datapath: str
+    :param cfg: Run configuration; see ``drive_bls_pulse.get_config``
+    :type cfg: dict
+    :param kwargs: Other data source options; see ``get_data.main``
+    :type kwargs: dict
+    '''
+    loader = get_loader(source, datapath, sort_targets(read_input(instream)),
+        **kwargs)
+
+    for k, q, time, flux, fluxerr in iter_stars(loader):
+        bls_out, segstart, segend, outfile = analyze_star(k, time, flux,
+            fluxerr, cfg)
+        print_result(k, q, bls_out, segstart, segend, outfile, cfg,
+            outstream=outstream)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Retrieve the light curves of the '
+        'Kepler IDs and quarters given on STDIN and run BLS pulse on each '
+        'star, in a single process.')
+    get_data_parser(parser)
+    get_bls_parser(parser)
+    args = parser.parse_args()
+    cfg = get_config(parser, args)
+
+    try:
+        main(args.source, os.path.normpath(args.datapath), cfg,
+            instream=sys.stdin, outstream=sys.stdout, cachedir=args.cachedir,
+            cachesize=int(args.cachesize * 1024**2), workers=args.workers,
+            baseurl=args.baseurl, index=args.index)
+    except:
+        handle_exception(sys.exc_info())
+        sys.exit(1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from time import clock
+from utils import encode_array, encode_array_legacy, decode_array
+
+
+def __time_codec(encode, arr, ntrials):
+    '''
+    Returns the mean encode time, mean decode time, and encoded length for the
+    given encoder, checking that the round trip is exact.
+    '''
+    encode_start = clock()
+    for i in xrange(ntrials):
+        s = encode(arr)
+    encode_end = clock()
+
+    decode_start = clock()
+    for i in xrange(ntrials):
+        out = decode_array(s)
+    decode_end = clock()
+
+    if not np.array_equal(out, arr.astype(out.dtype)):
+        print 'Round trip FAILED'
+        sys.exit(1)
+
+    return (encode_end - encode_start) / ntrials, \
+        (decode_end - decode_start) / ntrials, len(s)
+
+
+def main():
+    # Number of repetitions per array size.
+    ntrials = 5
+
+    # Long cadence is ~4,500 points per quarter and ~70,000 per star; short
+    # cadence is ~45,000 points per month and several hundred thousand per
+    # star.
+    sizes = [4500, 70000, 500000]
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(4)
+
+    codecs = [('json+zlib', encode_array_legacy),
+        ('binary', lambda x: encode_array(x)),
+        ('binary+zlib', lambda x: encode_array(x, compress=True)),
+        ('binary f32', lambda x: encode_array(x, dtype='float32'))]
+
+    print '{0: <9s} {1: <12s} {2: <12s} {3: <12s} {4: <12s}'.format('Size',
+        'Codec', 'Encode (s)', 'Decode (s)', 'Length')
+
+    for n in sizes:
+        # Something that looks like a Kepler time and flux vector.
+        time = np.sort(np.random.uniform(54953., 56424., size=n))
+        flux = np.random.normal(1.e5, 30., size=n)
+
+        for arr in (time, flux):
+            for name, encode in codecs:
+                tenc, tdec, length = __time_codec(encode, arr, ntrials)
+                print '{0: <9d} {1: <12s} {2: <12.6f} {3: <12.6f} ' \
+                    '{4: <12d}'.format(n, name, tenc, tdec, length)
+
+    # Mixed streams must still parse; the legacy and binary formats should
+    # decode to the same array.
+    arr = np.random.normal(size=1000)
+    if not np.array_equal(decode_array(encode_array_legacy(arr)),
+    decode_array(encode_array(arr))):
+        print 'Legacy/binary mismatch FAILED'
+        sys.exit(1)
+
+    # Empty arrays are legal (e.g., a quarter where every point is flagged).
+    if decode_array(encode_array(np.array([]))).size != 0:
+        print 'Empty array round trip FAILED'
+        sys.exit(1)
+
+    # Arrays that would be flattened or converted are refused.
+    for arr in (np.zeros((2, 3)), np.arange(3)):
+        try:
+            encode_array(arr)
+        except ValueError:
+            continue
+        print 'Refusing %s array FAILED' % arr.dtype.name
+        sys.exit(1)
+
+    print 'Round trip checks complete'
+
+
+if __name__ == '__main__':
+    main()
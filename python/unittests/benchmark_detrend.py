@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from numpy.polynomial import polynomial as poly
+from time import clock
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bin_and_detrend
+
+np.seterr(all='ignore')
+
+
+def __polyfit(time, flux, fluxerr, order, threshold=3., niter=3):
+    '''
+    ``detrend.polyfit`` as it was before it was compiled: a NumPy fit per
+    clipping iteration. Kept here so that the loop below stays the original
+    reference whatever ``detrend.polyfit`` becomes.
+    '''
+    x = time.copy()
+    y = flux.copy()
+    yerr = fluxerr.copy()
+    i = 0
+
+    while i < niter and len(x) > order + 1:
+        # Fit the current data or residuals with a polynomial.
+        coeffs = poly.polyfit(x, y, order, w=yerr)
+        resid = y - poly.polyval(x, coeffs)
+
+        # Calculate the root-mean-square statistic for the fit.
+        sigma = np.sqrt(np.sum(resid**2.) / len(x))
+
+        # Perform the sigma clipping.
+        ndx = np.where(np.absolute(resid) < threshold * sigma)[0]
+        x = x[ndx]
+        y = y[ndx]
+        yerr = yerr[ndx]
+
+        i += 1
+
+    return coeffs
+
+
+def __detrend_loop(btime, bflux, bfluxerr, nbins, segsize, detrend_order,
+maxgap=100):
+    '''
+    The detrending step of ``bin_and_detrend`` as it was before it was
+    vectorized: a Python loop over the bins to find the gaps, and one call to
+    ``__polyfit`` per segment.
+    '''
+    dflux = np.empty_like(bflux)
+    dfluxerr = np.empty_like(bflux)
+    dflux[:] = np.nan
+    dfluxerr[:] = np.nan
+
+    ingap = True
+    gapcount = 0
+    dstart_ = 0
+    dend_ = 0
+
+    for i in xrange(len(bflux)):
+        if np.isnan(bflux[i]):
+            gapcount += 1
+        else:
+            gapcount = 0
+
+            if ingap:
+                ingap = False
+                dstart_ = i
+            else:
+                dend_ = i
+
+        if gapcount > maxgap and not ingap and dstart_ < dend_:
+            ingap = True
+
+            ns = int(np.floor((np.nanmax(btime[dstart_:dend_]) -
+                np.nanmin(btime[dstart_:dend_])) / segsize) + 1)
+
+            for j in xrange(ns):
+                x = max(dstart_, dstart_ + (j - 1) * nbins)
+                y = min(dend_, dstart_ + (j + 2) * nbins) + 1
+                w = dstart_ + j * nbins
+                z = min(dend_, dstart_ + (j + 1) * nbins) + 1
+
+                ndx = np.where(np.isfinite(bflux[w:z]))[0]
+
+                if len(ndx) <= detrend_order + 1:
+                    dflux[w:z] = np.nan
+                    dfluxerr[w:z] = np.nan
+                    continue
+
+                ndx = np.where(np.isfinite(bflux[x:y]))[0]
+
+                m = np.nanmean(btime[w:z])
+                c = __polyfit(btime[x:y][ndx] - m, bflux[x:y][ndx],
+                    bfluxerr[x:y][ndx], detrend_order)
+
+                trend = poly.polyval(btime[w:z] - m, c)
+
+                dflux[w:z] = bflux[w:z] / trend
+                dflux[w:z] -= 1.
+                dfluxerr[w:z] = bfluxerr[w:z] / trend
+
+    return dflux, dfluxerr
+
+
+def main():
+    # Number of repetitions per configuration.
+    ntrials = 3
+
+    # Segment size (days) and number of bins per segment.
+    segsize = 2.
+    configs = [100, 500, 1000]
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(4)
+
+    # About four long-cadence years, with a few gaps and a slow trend.
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(3.3, 0.15, -0.001,
+        0.5, 1000., 70000, 1400.)
+    flux += 1. + 0.01 * np.sin(time / 30.)
+    for start in (9000, 30000, 52000):
+        flux[start:start+1500] = np.nan
+
+    print '{0: <7s} {1: <11s} {2: <11s} {3: <8s}'.format('nbins', 'Loop (s)',
+        'Batch (s)', 'Speedup')
+
+    for nbins in configs:
+        # Without detrending, the binned times are left zero-based, as in
+        # the detrending step.
+        btime, bflux, bfluxerr, _, _, _ = bin_and_detrend(time.copy(), flux,
+            fluxerr, nbins, segsize, detrend_order=0)
+
+        start = clock()
+        for i in xrange(ntrials):
+            dflux, dfluxerr = __detrend_loop(btime, bflux, bfluxerr, nbins,
+                segsize, 3)
+        tloop = (clock() - start) / ntrials
+
+        start = clock()
+        for i in xrange(ntrials):
+            _, dflux_batch, dfluxerr_batch, _, _, _ = bin_and_detrend(time,
+                flux, fluxerr, nbins, segsize, detrend_order=3)
+        tbatch = (clock() - start) / ntrials
+
+        # The batched fit is solved differently, so allow for rounding.
+        if not np.array_equal(np.isnan(dflux), np.isnan(dflux_batch)) or \
+        not np.allclose(dflux, dflux_batch, rtol=0., atol=1e-12,
+        equal_nan=True) or not np.allclose(dfluxerr, dfluxerr_batch,
+        rtol=1e-12, atol=0., equal_nan=True):
+            print 'Loop and batched detrending differ FAILED'
+            sys.exit(1)
+
+        print '{0: <7d} {1: <11.6f} {2: <11.6f} {3: <8.2f}'.format(nbins,
+            tloop, tbatch, tloop / tbatch)
+
+
+if __name__ == '__main__':
+    main()
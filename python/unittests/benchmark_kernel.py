@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from time import clock
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bls_pulse, bin_and_detrend
+
+np.seterr(all='ignore')
+
+
+def main():
+    # Number of repetitions per configuration.
+    ntrials = 3
+
+    # Segment size (days), and (nbins, minimum duration, maximum duration);
+    # the third is the configuration in condor/pulse.conf.
+    segsize = 2.
+    configs = [(100, 0.04, 0.5), (500, 0.01, 0.5), (1000, 0.01, 0.5),
+        (1000, 0.04, 1.), (2000, 0.01, 0.5)]
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(4)
+
+    # About one long-cadence quarter, with a shallow transit.
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(3.3, 0.15, -0.001,
+        0.5, 20., 4500, 90.)
+
+    print '{0: <7s} {1: <7s} {2: <7s} {3: <4s} {4: <11s} {5: <11s} ' \
+        '{6: <8s}'.format('nbins', 'mindur', 'maxdur', 'dir', 'Scan (s)',
+        'Prefix (s)', 'Speedup')
+
+    for nbins, mindur, maxdur in configs:
+        dtime, dflux, dfluxerr, samples, _, _ = bin_and_detrend(time, flux,
+            fluxerr, nbins, segsize, detrend_order=3)
+
+        for direction in (0, 2):
+            times = dict()
+            outs = dict()
+
+            for kernel in ('scan', 'prefix'):
+                start = clock()
+                for i in xrange(ntrials):
+                    outs[kernel] = bls_pulse(dtime, dflux, dfluxerr, samples,
+                        nbins, segsize, mindur, maxdur, direction=direction,
+                        kernel=kernel)
+                times[kernel] = (clock() - start) / ntrials
+
+            if not all(outs['scan'][k].tobytes() == outs['prefix'][k].tobytes()
+            for k in outs['scan']):
+                print 'Scan and prefix kernels differ FAILED'
+                sys.exit(1)
+
+            print '{0: <7d} {1: <7.3f} {2: <7.3f} {3: <4d} {4: <11.6f} ' \
+                '{5: <11.6f} {6: <8.2f}'.format(nbins, mindur, maxdur,
+                direction, times['scan'], times['prefix'], times['scan'] /
+                times['prefix'])
+
+
+if __name__ == '__main__':
+    main()
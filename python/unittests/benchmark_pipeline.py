@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from time import time
+
+
+SAMPLE_FITS = os.path.join(os.path.dirname(__file__), '..', '..',
+    'kplr011138155-2009350155506_llc.fits')
+
+# Copies of the sample light curve, as other quarters and another star.
+DATA_FILES = ['0111/011138155/kplr011138155-2009350155506_llc.fits',
+    '0111/011138155/kplr011138155-2009259160929_llc.fits',
+    '0022/002200000/kplr002200000-2009350155506_llc.fits']
+
+# The quarters of the first star are not adjacent, and the stars are not in
+# order; the piped chain sorts them before joining the quarters.
+TARGETS = '011138155\t3\tllc\n2200000\t3\tllc\n011138155\t2\tllc\n'
+
+CONFIG = '''[DEFAULT]
+segment = 2.
+min_duration = 0.01
+max_duration = 0.5
+n_bins = 1000
+direction = 2
+print_format = encoded
+clean_max = 5
+fits_output = yes
+fits_dir = %s
+'''
+
+
+def __time_command(cmd, targets, ntrials):
+    '''
+    Returns the mean wall-clock time of a shell command and its output.
+    '''
+    start = time()
+    for i in xrange(ntrials):
+        p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        out, _ = p.communicate(targets)
+
+        if p.returncode != 0:
+            print 'Command failed: ' + cmd
+            sys.exit(1)
+    end = time()
+
+    return (end - start) / ntrials, out
+
+
+def __read_dir(path):
+    '''
+    Returns the contents of each file in a directory, by name.
+    '''
+    contents = dict()
+    for fname in os.listdir(path):
+        with open(os.path.join(path, fname), 'rb') as f:
+            contents[fname] = f.read()
+    return contents
+
+
+def main():
+    # Number of repetitions of each pipeline.
+    ntrials = 3
+
+    tmpdir = tempfile.mkdtemp()
+    datapath = os.path.join(tmpdir, 'data')
+    fitsdir = os.path.join(tmpdir, 'fits')
+    config = os.path.join(tmpdir, 'pulse.conf')
+
+    for p in DATA_FILES:
+        if not os.path.isdir(os.path.dirname(os.path.join(datapath, p))):
+            os.makedirs(os.path.dirname(os.path.join(datapath, p)))
+        shutil.copy(SAMPLE_FITS, os.path.join(datapath, p))
+    os.makedirs(fitsdir)
+
+    with open(config, 'w') as f:
+        f.write(CONFIG % fitsdir)
+
+    # Hadoop sorts the mapper output bytewise, as does ``sort`` in the C
+    # locale.
+    piped = 'python get_data.py disk %s | LC_ALL=C sort | ' \
+        'python join_quarters.py | python drive_bls_pulse.py -c %s' % (
+        datapath, config)
+    fused = 'python run_pipeline.py disk %s -c %s' % (datapath, config)
+
+    try:
+        # Both write their FITS output to the same directory, as the path is
+        # part of the output, so keep the first before running the second.
+        tpiped, out_piped = __time_command(piped, TARGETS, ntrials)
+        fits_piped = __read_dir(fitsdir)
+        shutil.rmtree(fitsdir)
+        os.makedirs(fitsdir)
+        tfused, out_fused = __time_command(fused, TARGETS, ntrials)
+        fits_fused = __read_dir(fitsdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print '{0: <8s} {1: <12s}'.format('Mode', 'Time (s)')
+    print '{0: <8s} {1: <12.4f}'.format('piped', tpiped)
+    print '{0: <8s} {1: <12.4f}'.format('fused', tfused)
+    print 'Speedup: %.2fx' % (tpiped / tfused)
+
+    if out_piped != out_fused or out_piped == '':
+        print 'Piped and fused output differ.....FAIL'
+        sys.exit(1)
+    print 'Piped and fused output match.....PASS'
+
+    if fits_piped != fits_fused or len(fits_piped) != 2:
+        print 'Piped and fused FITS files differ.....FAIL'
+        sys.exit(1)
+    print 'Piped and fused FITS files match.....PASS'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bls_pulse, bls_pulse_batch, bin_and_detrend
+
+np.seterr(all='ignore')
+
+
+def __same(a, b):
+    '''
+    Returns True if the dictionaries of arrays are bit-identical, NaNs
+    included.
+    '''
+    return sorted(a.keys()) == sorted(b.keys()) and all(a[k].shape ==
+        b[k].shape and a[k].tobytes() == b[k].tobytes() for k in a)
+
+
+def __make_batch(stars, nbins, segsize, dtype='float64'):
+    '''
+    Bin and detrend each star, and concatenate the binned lightcurves.
+    '''
+    binned = [bin_and_detrend(time, flux, fluxerr, nbins, segsize,
+        dtype=dtype)[:4] for time, flux, fluxerr in stars]
+    offsets = np.concatenate(([0], np.cumsum([len(b[0]) for b in binned])))
+    arrays = [np.concatenate([b[i] for b in binned]) for i in xrange(4)]
+    return binned, arrays, offsets
+
+
+def main():
+    nbins, segsize, mindur, maxdur = (500, 2., 0.01, 0.5)
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(19)
+
+    # Stars with different lengths, periods, and depths, one of them with a
+    # gap so that it ends with empty segments.
+    stars = []
+    for period, depth, days in ((4.3, -0.01, 60.), (9.1, -0.003, 95.),
+    (2.2, 0.004, 33.), (6.7, -0.02, 71.)):
+        time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(period, 0.2,
+            depth, 0.3, 300., int(days * 48), days)
+        flux += 1. + 0.005 * np.sin(time / 5.)
+        stars.append((time + 100. * len(stars), flux, fluxerr))
+    stars[1][1][-400:] = np.nan
+
+    workspace = dict()
+    for direction in (0, 2):
+        for dtype in ('float64', 'float32'):
+            binned, arrays, offsets = __make_batch(stars, nbins, segsize, dtype)
+            out = bls_pulse_batch(*(arrays + [offsets, nbins, segsize, mindur,
+                maxdur]), direction=direction, workspace=workspace)
+
+            for i, (dtime, dflux, dfluxerr, samples) in enumerate(binned):
+                ref = bls_pulse(dtime, dflux, dfluxerr, samples, nbins, segsize,
+                    mindur, maxdur, direction=direction)
+                if not __same(ref, out[i]):
+                    print 'Batch, direction %d, %s, star %d.....FAIL' % \
+                        (direction, dtype, i)
+                    sys.exit(1)
+            print 'Batch, direction %d, %s.....PASS' % (direction, dtype)
+
+    # A smaller batch must reuse the buffers of the larger one.
+    buffers = workspace['buffers']
+    binned, arrays, offsets = __make_batch(stars[:2], nbins, segsize)
+    out = bls_pulse_batch(*(arrays + [offsets, nbins, segsize, mindur,
+        maxdur]), direction=2, workspace=workspace)
+    if workspace['buffers'] is not buffers or not __same(out[1],
+    bls_pulse(*(list(binned[1]) + [nbins, segsize, mindur, maxdur]),
+    direction=2)):
+        print 'Buffer reuse.....FAIL'
+        sys.exit(1)
+    print 'Buffer reuse.....PASS'
+
+
+if __name__ == '__main__':
+    main()
@@ -50,7 +50,7 @@ def main(err_on_fail=True, allow_straddling=True, ofile=None, mode='python'):
     # Other parameters.
     minutes_per_day = 24. * 60.
     signal_to_noise, baseline = (1.e5, 90.)
-    nsamples = np.ceil(baseline * minutes_per_day)
+    nsamples = int(np.ceil(baseline * minutes_per_day))
     segsize, mindur, maxdur, nbins = (2., 0.01, 0.5, 1000)
 
     # To make it deterministic, seed the PRNG.
@@ -77,6 +77,23 @@ def main(err_on_fail=True, allow_straddling=True, ofile=None, mode='python'):
         elif mode == 'vec':
             out = bls_pulse_vec(time, flux, fluxerr, nbins, segsize, mindur,
                 maxdur, detrend_order=0, direction=0)
+
+            # The vectorized search must give the same events as the Cython
+            # one.
+            dtime, dflux, dfluxerr, dsamples, segstart, segend = \
+                bin_and_detrend(time, flux, fluxerr, nbins, segsize,
+                    detrend_order=0)
+            ref = bls_pulse_cython(dtime, dflux, dfluxerr, dsamples, nbins,
+                segsize, mindur, maxdur, direction=0)
+
+            if sorted(out.keys()) != sorted(ref.keys()) or \
+            not all(np.allclose(out[k], ref[k], rtol=1e-12, equal_nan=True)
+            for k in ref):
+                print '    Cython comparison.....FAIL'
+                if err_on_fail:
+                    sys.exit(1)
+            else:
+                print '    Cython comparison.....PASS'
         elif mode == 'cython':
             dtime, dflux, dfluxerr, dsamples, segstart, segend = \
                 bin_and_detrend(time, flux, fluxerr, nbins, segsize,
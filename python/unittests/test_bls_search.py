@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from simulate import simulate_box_lightcurve
+from bls_search import bls_search, period_grid
+
+np.seterr(all='ignore')
+
+
+def __bls_search_period(time, flux, fluxerr, period, nbins, mindur, maxdur,
+direction):
+    '''
+    Reference periodic BLS for a single trial period, in NumPy.
+    '''
+    t = np.min(time)
+    w = fluxerr**-2. / np.sum(fluxerr**-2.)
+    x = flux - np.dot(w, flux)
+
+    phase = (time - t) / period
+    phase -= np.floor(phase)
+    j = np.minimum((phase * nbins).astype('int64'), nbins - 1)
+    s = np.bincount(j, weights=w * x, minlength=nbins)
+    r = np.bincount(j, weights=w, minlength=nbins)
+    filled = np.tile(r != 0., 2)
+    s = np.concatenate(([0.], np.cumsum(np.tile(s, 2))))
+    r = np.concatenate(([0.], np.cumsum(np.tile(r, 2))))
+
+    kmin = max(int(np.floor(mindur / period * nbins)), 1)
+    kmax = min(int(np.ceil(maxdur / period * nbins)), nbins - 1)
+    best = (0., -1, 0, 0., 0.)
+    for i in np.flatnonzero(filled[:nbins]):
+        k = np.arange(kmin, kmax + 1)
+        sk = s[i+k] - s[i]
+        rk = r[i+k] - r[i]
+        srsq = sk * sk / (rk * (1. - rk))
+        ok = filled[i+k-1] & (rk < 1.) & (direction * sk >= 0)
+        if np.any(ok & (srsq > best[0])):
+            m = np.argmax(np.where(ok, srsq, -1.))
+            best = (srsq[m], i, k[m], sk[m], rk[m])
+
+    srsq, i, k, sk, rk = best
+    if i < 0:
+        return srsq, np.nan, np.nan, np.nan
+    return srsq, k * period / nbins, sk / (rk * (1. - rk)), \
+        np.mod((i + 0.5 * k) * period / nbins, period) + t
+
+
+def main():
+    nbins, mindur, maxdur = (400, 0.05, 0.5)
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(20)
+
+    time, flux, fluxerr, duration, depth, midtime = simulate_box_lightcurve(
+        4.3, 0.2, -0.002, 0.3, 3., 12000, 250.)
+    flux += 1. + 0.0002 * np.random.normal(size=flux.shape)
+    fluxerr *= np.random.uniform(0.8, 1.2, size=fluxerr.shape)
+    flux[5000:5600] = np.nan
+    time += 54953.
+
+    # The C code must agree with the reference on a few trial periods.
+    periods = np.array([0.9, 2.15, 4.3, 7.77, 13.])
+    mask = np.isfinite(flux)
+    for direction in (-1, 0, 1):
+        out = bls_search(time, flux, fluxerr, nbins, mindur, maxdur,
+            periods=periods, direction=direction)
+        for n, period in enumerate(periods):
+            ref = __bls_search_period(time[mask], flux[mask], fluxerr[mask],
+                period, nbins, mindur, maxdur, direction)
+            got = [out[key][n] for key in ('srsq', 'duration', 'depth',
+                'midtime')]
+            if not np.allclose(got, ref, rtol=1e-9, atol=0., equal_nan=True):
+                print 'Reference, direction %d, period %g.....FAIL' % \
+                    (direction, period)
+                sys.exit(1)
+        print 'Reference, direction %d.....PASS' % direction
+
+    # The transit must be found on a grid that holds its period, and the
+    # results must not depend on the number of threads.
+    grid = period_grid(1., 10., 901)
+    outs = [bls_search(time, flux, fluxerr, nbins, mindur, maxdur, minper=1.,
+        maxper=10., nsearch=901, direction=-1, nthreads=n) for n in (1, 3)]
+
+    best = np.argmax(outs[0]['srsq'])
+    if not np.array_equal(outs[0]['period'], grid) or \
+    abs(outs[0]['period'][best] - 4.3) > 1e-9 or \
+    abs(outs[0]['duration'][best] - duration[0]) > 4.3 / nbins or \
+    abs(outs[0]['depth'][best] / depth[0] - 1.) > 0.1 or \
+    abs(np.mod(outs[0]['midtime'][best] - (midtime[0] + 54953.) + 2.15, 4.3) -
+    2.15) > 4.3 / nbins:
+        print 'Transit recovery.....FAIL'
+        sys.exit(1)
+    print 'Transit recovery.....PASS'
+
+    if not all(outs[0][key].tobytes() == outs[1][key].tobytes()
+    for key in outs[0]):
+        print 'Threads.....FAIL'
+        sys.exit(1)
+    print 'Threads.....PASS'
+
+
+if __name__ == '__main__':
+    main()
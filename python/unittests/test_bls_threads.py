@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+import bls_pulse_cython
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bls_pulse, bin_and_detrend
+
+np.seterr(all='ignore')
+
+
+def __serial(time, flux, fluxerr, samples, nbins, segsize, mindur, maxdur,
+direction):
+    '''
+    Reference result: call the per-segment functions one segment at a time,
+    and keep the best event in each segment, as ``bls_pulse`` does.
+    '''
+    t = np.nanmin(time)
+    time = time - t
+    nsegments = int(np.floor(np.nanmax(time) / segsize) + 1)
+
+    keys = ['srsq', 'duration', 'depth', 'midtime']
+    if direction == 2:
+        keys = [k + '_dip' for k in keys] + [k + '_blip' for k in keys]
+    out = dict((k, np.empty((nsegments,nbins))) for k in keys)
+
+    for i in xrange(nsegments):
+        j = i * nbins
+        args = [time[j:j+nbins], flux[j:j+nbins], fluxerr[j:j+nbins],
+            samples[j:j+nbins], segsize, mindur, maxdur]
+
+        if direction == 2:
+            bls_pulse_cython.__bls_pulse_binned_compound(*(args +
+                [out[k][i,:] for k in keys]))
+        else:
+            bls_pulse_cython.__bls_pulse_binned(*(args + [direction] +
+                [out[k][i,:] for k in keys]))
+
+    result = dict()
+    for prefix in ('_dip', '_blip') if direction == 2 else ('',):
+        ndx = np.nanargmax(out['srsq' + prefix], axis=1)
+        for k in ('srsq', 'duration', 'depth', 'midtime'):
+            result[k + prefix] = out[k + prefix][np.arange(nsegments),ndx]
+        result['midtime' + prefix] += t
+
+    return result
+
+
+def main():
+    nbins, segsize, mindur, maxdur = (500, 2., 0.01, 0.5)
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(5)
+
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(3.7, 0.1, -0.01,
+        0.5, 100., 20000, 60.)
+
+    # A gap several segments long; segments inside it are empty.
+    flux[12000:15000] = np.nan
+
+    dtime, dflux, dfluxerr, samples, _, _ = bin_and_detrend(time, flux,
+        fluxerr, nbins, segsize, detrend_order=3)
+
+    for direction in (-1, 0, 1, 2):
+        ref = __serial(dtime, dflux, dfluxerr, samples, nbins, segsize,
+            mindur, maxdur, direction)
+
+        for kernel in ('scan', 'prefix'):
+            for nthreads in (1, 2, 7):
+                out = bls_pulse(dtime, dflux, dfluxerr, samples, nbins,
+                    segsize, mindur, maxdur, direction=direction,
+                    nthreads=nthreads, kernel=kernel)
+
+                if sorted(out.keys()) != sorted(ref.keys()) or not all(
+                out[k].tobytes() == ref[k].tobytes() for k in ref):
+                    print 'Direction %d, %s kernel, %d threads.....FAIL' % (
+                        direction, kernel, nthreads)
+                    sys.exit(1)
+                print 'Direction %d, %s kernel, %d threads.....PASS' % (
+                    direction, kernel, nthreads)
+
+
+if __name__ == '__main__':
+    main()
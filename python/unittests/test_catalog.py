@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import pyfits
+import numpy as np
+from logging.handlers import BufferingHandler
+from fits_output import BLSFitsBundler
+from catalog import Catalog, logger
+from result_store import ResultStore
+
+COLUMNS = ['srsq_dip', 'duration_dip', 'depth_dip', 'midtime_dip',
+    'srsq_blip', 'duration_blip', 'depth_blip', 'midtime_blip']
+
+# Columns of the output of a search in a single direction.
+SINGLE_COLUMNS = ['srsq', 'duration', 'depth', 'midtime']
+
+
+def __write_star(fname, kic, npasses, direction=2, store=None):
+    '''
+    Write an output file (or, if a result store is given, add the star to
+    it) with random events, searched for dips and blips at once or (with
+    `direction` 0) for the stronger of the two, and return them with the pass
+    number, direction, and periodic signal of each.
+    '''
+    bundler = BLSFitsBundler()
+    bundler.make_header(kic + '_llc')
+    events = []
+
+    for n in xrange(1, npasses + 1):
+        # The last pass has no periodic signal. Header cards only hold about
+        # 16 digits, so the period is rounded.
+        clean_out = dict(period=round(np.random.uniform(1., 10.), 6),
+            phase=0.5, duration=0.2, depth=-0.01) if n < npasses else None
+        period = clean_out['period'] if clean_out is not None else None
+
+        bls = dict((k, np.random.uniform(-1., 1., size=45) * (1. if
+            k.startswith('srsq') else 0.1)) for k in (COLUMNS if direction ==
+            2 else SINGLE_COLUMNS))
+
+        if direction == 2:
+            bls['depth_dip'] = -np.abs(bls['depth_dip'])
+            bls['depth_blip'] = np.abs(bls['depth_blip'])
+            bls['srsq_dip'][3] = np.nan
+
+            for d, name in ((-1, 'dip'), (1, 'blip')):
+                for j in xrange(45):
+                    if bls['srsq_' + name][j] > 0.:
+                        events.append((kic, n, d, bls['srsq_' + name][j],
+                            bls['depth_' + name][j], period))
+        else:
+            # Dips and blips are told apart by the sign of their depth.
+            bls['srsq'][3] = np.nan
+            for j in xrange(45):
+                if bls['srsq'][j] > 0.:
+                    events.append((kic, n, int(np.sign(bls['depth'][j])),
+                        bls['srsq'][j], bls['depth'][j], period))
+
+        time = np.linspace(0., 90., 100)
+        bundler.push_detrended_lightcurve(time, np.zeros_like(time),
+            np.ones_like(time), clean_out=clean_out)
+        bundler.push_bls_output(bls, np.arange(45.) * 2., np.arange(45.) * 2.
+            + 2.)
+
+    bundler.push_config(dict(segment=2.))
+    if store is not None:
+        store.append(kic + '_llc', bundler)
+    else:
+        bundler.write_file(fname, clobber=True)
+
+    return events
+
+
+def __top(events, top):
+    '''
+    Keep the `top` strongest events per star, pass, and direction.
+    '''
+    events = sorted(events, key=lambda e: -e[3])
+    counts = dict()
+    kept = []
+    for e in events:
+        counts[e[:3]] = counts.get(e[:3], 0) + 1
+        if counts[e[:3]] <= top:
+            kept.append(e)
+    return kept
+
+
+def main():
+    nstars = 6
+    top = 4
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(25)
+
+    outdir = tempfile.mkdtemp()
+    catalogfile = os.path.join(outdir, 'candidates.db')
+    fitsdir = os.path.join(outdir, 'fits')
+    os.makedirs(fitsdir)
+
+    def fname(i):
+        return os.path.join(fitsdir, 'KIC%09d_llc.fits' % i)
+
+    try:
+        stars = dict((i, __write_star(fname(i), '%09d' % i, i % 3 + 1,
+            direction=0 if i % 2 else 2)) for i in xrange(nstars))
+
+        # A file that cannot be read is skipped, without stopping the scan.
+        hdu = pyfits.PrimaryHDU()
+        hdu.header['KIC_ID'] = '000000999'
+        hdu.header['N_EXTEN'] = 'none'
+        hdu.writeto(fname(999))
+
+        catalog = Catalog(catalogfile)
+        nread = catalog.refresh(fitsdir, top=top)
+
+        # Queries must match a brute-force search over the top events.
+        for kwargs, match in ((dict(), lambda e: True),
+        (dict(direction=-1, min_srsq=0.5), lambda e: e[2] == -1 and
+            e[3] >= 0.5),
+        (dict(max_depth=-0.05), lambda e: e[4] <= -0.05),
+        (dict(min_period=3., max_period=8.), lambda e: e[5] is not None and
+            3. <= e[5] <= 8.),
+        (dict(kic='000000004', direction=1), lambda e: e[0] == '000000004'
+            and e[2] == 1)):
+            got = [(r['kic'], r['pass'], r['direction'], r['srsq'],
+                r['depth'], r['period']) for r in catalog.query(**kwargs)]
+            expected = [e for e in __top(sum(stars.values(), []), top)
+                if match(e)]
+            if nread != nstars or got != expected or \
+            catalog.query(limit=3, **kwargs) != catalog.query(**kwargs)[:3]:
+                print 'Query %s.....FAIL' % kwargs
+                sys.exit(1)
+        print 'Queries.....PASS'
+
+        # The file that cannot be read is not tried again until it changes.
+        handler = BufferingHandler(100)
+        logger.addHandler(handler)
+        try:
+            nread = catalog.refresh(fitsdir, top=top)
+            nwarnings = len(handler.buffer)
+            os.utime(fname(999), (0., 0.))
+            catalog.refresh(fitsdir, top=top)
+        finally:
+            logger.removeHandler(handler)
+
+        if nread != 0 or nwarnings != 0 or len(handler.buffer) != 1:
+            print 'Unreadable files.....FAIL'
+            sys.exit(1)
+        print 'Unreadable files.....PASS'
+
+        # Only new and changed files are read again, and removed files are
+        # dropped.
+        stars[1] = __write_star(fname(1), '%09d' % 1, 3)
+        os.utime(fname(1), (0., 0.))
+        stars[nstars] = __write_star(fname(nstars), '%09d' % nstars, 2)
+        os.remove(fname(2))
+        del stars[2]
+
+        nread = catalog.refresh(fitsdir, top=top)
+        got = [(r['kic'], r['pass'], r['direction'], r['srsq'], r['depth'],
+            r['period']) for r in catalog.query()]
+        if nread != 2 or catalog.refresh(fitsdir, top=top) != 0 or \
+        got != __top(sum(stars.values(), []), top):
+            print 'Incremental refresh.....FAIL'
+            sys.exit(1)
+        print 'Incremental refresh.....PASS'
+
+        # Stars in result stores are read as well.
+        store = ResultStore(os.path.join(fitsdir, 'store'))
+        stars[nstars + 1] = __write_star(None, '%09d' % (nstars + 1), 2,
+            store=store)
+        store.close()
+
+        nread = catalog.refresh(fitsdir, top=top)
+        rows = catalog.query()
+        got = [(r['kic'], r['pass'], r['direction'], r['srsq'], r['depth'],
+            r['period']) for r in rows]
+        if nread != 1 or catalog.refresh(fitsdir, top=top) != 0 or \
+        got != __top(sum(stars.values(), []), top) or \
+        not any(r['path'].endswith('#%09d_llc' % (nstars + 1)) for r in rows):
+            print 'Result stores.....FAIL'
+            sys.exit(1)
+        print 'Result stores.....PASS'
+
+        catalog.close()
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
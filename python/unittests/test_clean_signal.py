@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+import scipy.optimize as opt
+from sklearn.cluster import DBSCAN
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bls_pulse, bin_and_detrend
+from clean_signal import __do_dbscan, __refine_period, __do_fit_box, \
+    __do_fit_trapezoid
+
+np.seterr(all='ignore')
+
+
+def __dbscan_callable(X, scale):
+    '''
+    Reference clustering with the Python metric that ``clean_signal`` used to
+    pass to DBSCAN.
+    '''
+    metric = lambda x, y: np.sqrt((x[0] - y[0])**2. / scale[0]**2. +
+        (x[1] - y[1])**2. / scale[1]**2.)
+    return DBSCAN(eps=1., min_samples=10, metric=metric).fit(X)
+
+
+def __chatter(time, flux, period):
+    '''
+    The objective that ``clean_signal`` used to minimize with
+    ``scipy.optimize.minimize``, one period at a time.
+    '''
+    ndx = np.argsort(np.mod(time, period))
+    return np.sum(np.diff(flux[ndx])**2. / np.diff(time[ndx])**2.)
+
+
+def __fit_box_full(p0, time, flux):
+    '''
+    Reference box fit, building the model over the full light curve on every
+    evaluation, as ``clean_signal`` used to.
+    '''
+    def f(x):
+        duration, depth, phase, period = x
+        pftime = np.mod(time - phase - period / 2., period) / period
+        model = np.zeros_like(time)
+        model[(pftime > 0.5 - 0.5 * duration / period) &
+            (pftime < 0.5 + 0.5 * duration / period)] = depth
+        return np.sum((flux - model)**2.)
+
+    return opt.fmin(f, p0, disp=0)
+
+
+def __fit_trapezoid_full(p0, time, flux, frac=0.25):
+    '''
+    Reference trapezoid fit, building the model over the full light curve on
+    every evaluation, as ``clean_signal`` used to.
+    '''
+    def f(x):
+        delta, T, tau, phase, period = x
+        if not (delta < 0. and T >= tau and T > 0. and tau > 0. and phase > 0.):
+            return np.inf
+
+        dist = np.absolute(np.mod(time - phase - period / 2., period) -
+            period / 2.)
+        model = np.zeros_like(time)
+        model[dist <= T / 2. - tau / 2.] = delta
+        mask = (T / 2. - tau / 2. < dist) & (dist < T / 2. + tau / 2.)
+        model[mask] = delta - (delta / tau) * (dist[mask] - T / 2. + tau / 2.)
+        return np.sum((flux - model)**2.)
+
+    q0 = np.array([p0[1], p0[0], frac * p0[0], p0[2], p0[3]], dtype='float64')
+    qbest = opt.fmin(f, q0, disp=0)
+    return np.array([qbest[1] + qbest[2], qbest[0], qbest[3], qbest[4]])
+
+
+def __check(name, X, scale):
+    ref = __dbscan_callable(X, scale)
+    out = __do_dbscan(X, scale)
+
+    if not np.array_equal(ref.labels_, out.labels_) or \
+    not np.array_equal(ref.core_sample_indices_, out.core_sample_indices_):
+        print '%s.....FAIL' % name
+        sys.exit(1)
+    print '%s.....PASS' % name
+
+
+def main():
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(14)
+
+    # The depths found by BLS pulse in the segments of a simulated eclipsing
+    # binary, as clustered by `clean_signal`.
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(4.3, 0.2, -0.3,
+        0.3, 300., 9600, 200.)
+    flux += 1.
+    dtime, dflux, dfluxerr, samples, _, _ = bin_and_detrend(time, flux,
+        fluxerr, 1000, 2.)
+    out = bls_pulse(dtime, dflux, dfluxerr, samples, 1000, 2., 0.01, 0.5,
+        direction=2)
+
+    ndx = np.where((out['srsq_dip'] > 0.) & (out['srsq_blip'] > 0.))
+    X = np.column_stack((out['depth_dip'][ndx], out['depth_blip'][ndx]))
+    size = max(np.nanmax(np.absolute(out['depth_dip'])),
+        np.nanmax(out['depth_blip']))
+    __check('Depth clusters', X, [0.05 * size, 0.05 * size])
+
+    # Refining a rough period must lower the chatter and bring the period
+    # closer to the true one.
+    mask = np.isfinite(dflux)
+    best, nsaved = __refine_period(dtime[mask], dflux[mask], 4.2991, 3e-4)
+    if not __chatter(dtime[mask], dflux[mask], best) < \
+    __chatter(dtime[mask], dflux[mask], 4.2991) or \
+    not abs(best - 4.3) < abs(4.2991 - 4.3):
+        print 'Period refinement.....FAIL'
+        sys.exit(1)
+    print 'Period refinement.....PASS'
+
+    # The model fits must agree with fits that build the model over the full
+    # light curve.
+    p0 = np.array([0.22, -0.27, 0.31, 4.30013])
+    for name, fit, ref in (('Box fit', __do_fit_box, __fit_box_full),
+    ('Trapezoid fit', __do_fit_trapezoid, __fit_trapezoid_full)):
+        if not np.allclose(fit(p0, dtime[mask], dflux[mask]),
+        ref(p0, dtime[mask], dflux[mask]), rtol=1e-6):
+            print '%s.....FAIL' % name
+            sys.exit(1)
+        print '%s.....PASS' % name
+
+    # Clusters of periods at integer multiples, with different scales on
+    # each axis, as in the period search.
+    n = 2000
+    Y = np.column_stack((np.random.normal(-0.3, 0.005, n),
+        4.3 * np.random.randint(1, 4, n) + np.random.normal(0., 0.02, n)))
+    Y[::7,1] = np.random.uniform(0., 15., len(Y[::7]))
+    __check('Period clusters', Y, [0.01, 0.1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from numpy.polynomial import polynomial as poly
+from detrend import polyfit, polyfit_windows
+
+np.seterr(all='ignore')
+
+
+def __polyfit_numpy(x, y, yerr, order, threshold=3., niter=3):
+    '''
+    Reference sigma-clipped fit with ``numpy.polynomial``, as ``polyfit`` was
+    originally written.
+    '''
+    i = 0
+    while i < niter and len(x) > order + 1:
+        coeffs = poly.polyfit(x, y, order, w=yerr)
+        resid = y - poly.polyval(x, coeffs)
+        sigma = np.sqrt(np.sum(resid**2.) / len(x))
+        ndx = np.where(np.absolute(resid) < threshold * sigma)[0]
+        x = x[ndx]
+        y = y[ndx]
+        yerr = yerr[ndx]
+        i += 1
+
+    return coeffs
+
+
+def main():
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(8)
+
+    # A slow trend over six days, as in a detrending window, with noise and a
+    # few outliers.
+    n = 3000
+    time = np.sort(np.random.uniform(-3., 3., n))
+    flux = 1. + 0.01 * np.sin(time) + np.random.normal(0., 1e-4, n)
+    flux[np.random.randint(0, n, 30)] -= 0.01
+    fluxerr = np.random.uniform(1e-4, 2e-4, n)
+
+    for order in xrange(6):
+        ref = __polyfit_numpy(time, flux, fluxerr, order)
+        out = polyfit(time, flux, fluxerr, order)
+
+        if not np.allclose(out, ref, rtol=1e-8, atol=1e-12):
+            print 'Order %d fit.....FAIL' % order
+            sys.exit(1)
+        print 'Order %d fit.....PASS' % order
+
+    # Overlapping windows with their own centers must give the same fit as
+    # each window on its own.
+    starts = np.array([0, 500, 1000, 2990, 1200], dtype='int64')
+    ends = np.array([1500, 2500, 3000, 3000, 1200], dtype='int64')
+    centers = np.array([-2., 0., 2., 3., 0.])
+    out = polyfit_windows(time, flux, fluxerr, starts, ends, centers, 3)
+
+    for k in xrange(len(starts)):
+        if ends[k] - starts[k] <= 4:
+            ok = np.all(np.isnan(out[k]))
+        else:
+            ref = polyfit(time[starts[k]:ends[k]] - centers[k],
+                flux[starts[k]:ends[k]], fluxerr[starts[k]:ends[k]], 3)
+            ok = np.array_equal(out[k], ref)
+
+        if not ok:
+            print 'Window %d.....FAIL' % k
+            sys.exit(1)
+        print 'Window %d.....PASS' % k
+
+
+if __name__ == '__main__':
+    main()
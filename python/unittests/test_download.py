@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+from cStringIO import StringIO
+from download import FITSCache, Downloader
+from get_data import main as get_data
+
+
+SAMPLE_FITS = os.path.join(os.path.dirname(__file__), '..', '..',
+    'kplr011138155-2009350155506_llc.fits')
+
+
+class ArchiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Local stand-in for the MAST archive. Serves files from `root` in the
+    <nnnn>/<nnnnnnnnn>/ layout, supports keep-alive and byte ranges, and
+    records every request it answers and the start of every range requested.
+    While `truncate` is set, it closes the connection halfway through the
+    body.
+    '''
+    protocol_version = 'HTTP/1.1'
+    root = None
+    requests = []
+    ranges = []
+    truncate = False
+
+    def do_GET(self):
+        ArchiveHandler.requests.append(self.path)
+        path = os.path.join(self.root, self.path.lstrip('/'))
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        m = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            ArchiveHandler.ranges.append(start)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start,
+                len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        if self.truncate:
+            self.wfile.write(data[0:len(data)/2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ArchiveServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def __split(out):
+    '''
+    Strip the URI from each line of `get_data` output so that output from
+    different sources can be compared.
+    '''
+    lines = out.getvalue().splitlines()
+    return [l.split('\t')[0:2] + l.split('\t')[3:] for l in lines]
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    archive = os.path.join(tmpdir, 'archive')
+    cachedir = os.path.join(tmpdir, 'cache')
+    fname = os.path.basename(SAMPLE_FITS)
+    relpath = '0111/011138155/' + fname
+
+    os.makedirs(os.path.join(archive, '0111', '011138155'))
+    shutil.copy(SAMPLE_FITS, os.path.join(archive, relpath))
+
+    ArchiveHandler.root = archive
+    server = ArchiveServer(('127.0.0.1', 0), ArchiveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    baseurl = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    # Quarter 4 is not in the archive; it should be logged and skipped.
+    targets = '011138155\t3\tllc\n011138155\t4\tllc\n'
+
+    try:
+        disk = StringIO()
+        get_data('disk', archive, instream=StringIO(targets), outstream=disk)
+
+        # First run: everything comes from the server.
+        mast1 = StringIO()
+        get_data('mast', None, instream=StringIO(targets), outstream=mast1,
+            cachedir=cachedir, workers=4, baseurl=baseurl)
+
+        if __split(mast1) != __split(disk) or len(__split(disk)) != 1:
+            print 'Download from local archive.....FAIL'
+            sys.exit(1)
+        print 'Download from local archive.....PASS'
+
+        # Second run: the quarter that exists should be served from the cache.
+        ArchiveHandler.requests = []
+        mast2 = StringIO()
+        get_data('mast', None, instream=StringIO(targets), outstream=mast2,
+            cachedir=cachedir, workers=4, baseurl=baseurl)
+
+        if '/' + relpath in ArchiveHandler.requests or \
+        __split(mast2) != __split(disk):
+            print 'Second run served from cache.....FAIL'
+            sys.exit(1)
+        print 'Second run served from cache.....PASS'
+
+        # Interrupted transfer: leave the first half of the file as a partial
+        # download and check that it is completed with a range request.
+        shutil.rmtree(cachedir)
+        cache = FITSCache(cachedir)
+        with open(SAMPLE_FITS, 'rb') as f:
+            data = f.read()
+        with open(cache.partial_path(relpath), 'wb') as f:
+            f.write(data[0:len(data)/2])
+
+        ArchiveHandler.ranges = []
+        mast3 = StringIO()
+        get_data('mast', None, instream=StringIO(targets), outstream=mast3,
+            cachedir=cachedir, workers=1, baseurl=baseurl)
+
+        if cache.get(relpath) != data or __split(mast3) != __split(disk) or \
+        ArchiveHandler.ranges != [len(data)/2]:
+            print 'Resume partial download.....FAIL'
+            sys.exit(1)
+        print 'Resume partial download.....PASS'
+
+        # Truncated transfers: the server closes the connection early every
+        # time. The download fails, but what was received is kept for the
+        # next attempt rather than cached as a complete file.
+        shutil.rmtree(cachedir)
+        cache = FITSCache(cachedir)
+        downloader = Downloader(baseurl, cache=cache, workers=1, retries=1,
+            backoff=0.)
+        ArchiveHandler.truncate = True
+        try:
+            result = list(downloader.fetch_all([(None, relpath)]))
+        finally:
+            ArchiveHandler.truncate = False
+        partial = cache.partial_path(relpath)
+        received = os.path.getsize(partial)
+
+        if result[0][2] is not None or cache.get(relpath) is not None or \
+        not len(data)/2 <= received < len(data) or \
+        os.path.exists(partial + '.lock'):
+            print 'Truncated download not cached.....FAIL'
+            sys.exit(1)
+        print 'Truncated download not cached.....PASS'
+
+        ArchiveHandler.ranges = []
+        result = list(downloader.fetch_all([(None, relpath)]))
+        downloader.close()
+
+        if result[0][2] != data or cache.get(relpath) != data or \
+        ArchiveHandler.ranges != [received] or os.path.exists(partial):
+            print 'Resume truncated download.....FAIL'
+            sys.exit(1)
+        print 'Resume truncated download.....PASS'
+
+        # Shared cache: only one download of a key at a time, in any process,
+        # writes to its resumable partial file.
+        other = FITSCache(cachedir)
+        first = cache.acquire('a')
+        second = other.acquire('a')
+        other.release('a', second)
+        cache.release('a', first)
+        third = other.acquire('a')
+        other.release('a', third)
+
+        if first != cache.partial_path('a') or second == first or \
+        third != first or os.path.exists(first + '.lock') or \
+        os.path.exists(second):
+            print 'One writer per partial file.....FAIL'
+            sys.exit(1)
+        print 'One writer per partial file.....PASS'
+
+        # Eviction: with room for two files, adding a third evicts the least
+        # recently used one.
+        shutil.rmtree(cachedir)
+        cache = FITSCache(cachedir, max_bytes=2*len(data))
+        for key in ('a', 'b', 'c'):
+            if key == 'c':
+                # Touch `a` so that `b` is the least recently used.
+                cache.get('a')
+            with open(cache.partial_path(key), 'wb') as f:
+                f.write(data)
+            cache.commit(key, cache.partial_path(key))
+
+        if cache.get('a') is None or cache.get('b') is not None or \
+        cache.get('c') is None or cache.total != 2*len(data):
+            print 'LRU eviction.....FAIL'
+            sys.exit(1)
+        print 'LRU eviction.....PASS'
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
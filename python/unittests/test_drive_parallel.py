@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+from simulate import simulate_box_lightcurve
+from utils import encode_array
+
+CONFIG = '''[DEFAULT]
+segment = 2.
+min_duration = 0.01
+max_duration = 0.5
+n_bins = 500
+direction = 2
+print_format = encoded
+clean_max = 3
+fits_output = yes
+fits_dir = %s
+'''
+
+
+def __run(config, stars, *args):
+    '''
+    Run ``drive_bls_pulse.py`` on the encoded stars and return its output.
+    '''
+    p = subprocess.Popen([sys.executable, 'drive_bls_pulse.py', '-c',
+        config] + list(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=open(os.devnull, 'w'))
+    out, _ = p.communicate(stars)
+
+    if p.returncode != 0:
+        print 'drive_bls_pulse.py ' + ' '.join(args) + '.....FAIL'
+        sys.exit(1)
+
+    return out
+
+
+def main():
+    # Number of simulated stars; more than twice the number of workers, so
+    # that the reader has to wait for workers to free up.
+    nstars = 8
+    workers = 3
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(11)
+
+    lines = []
+    for i in xrange(nstars):
+        period = np.random.uniform(2., 10.)
+        duration = np.random.uniform(1. / 24., 5. / 24.)
+        depth = np.random.uniform(-0.01, -0.5)
+        time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(period,
+            duration, depth, 0.5, 1000., 10000, 20.)
+        lines.append('\t'.join(['%09d_llc' % i, str(['01']),
+            encode_array(time), encode_array(flux), encode_array(fluxerr)]))
+    stars = '\n'.join(lines) + '\n'
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        outs = dict()
+        for mode, args in (('serial', []), ('input', ['--workers',
+        str(workers)]), ('completion', ['--workers', str(workers), '--order',
+        'completion'])):
+            fitsdir = os.path.join(tmpdir, mode)
+            os.makedirs(fitsdir)
+            config = os.path.join(tmpdir, mode + '.conf')
+            with open(config, 'w') as f:
+                f.write(CONFIG % fitsdir)
+
+            outs[mode] = __run(config, stars, *args)
+
+            if len(os.listdir(fitsdir)) != nstars:
+                print 'FITS output (' + mode + ').....FAIL'
+                sys.exit(1)
+
+        if outs['input'] != outs['serial'] or \
+        len(outs['serial'].splitlines()) != nstars:
+            print 'Parallel output in input order.....FAIL'
+            sys.exit(1)
+        print 'Parallel output in input order.....PASS'
+
+        if sorted(outs['completion'].splitlines()) != \
+        sorted(outs['serial'].splitlines()):
+            print 'Parallel output in completion order.....FAIL'
+            sys.exit(1)
+        print 'Parallel output in completion order.....PASS'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from cStringIO import StringIO
+from fits_index import FITSIndex
+from get_data import main as get_data
+
+
+SAMPLE_FITS = os.path.join(os.path.dirname(__file__), '..', '..',
+    'kplr011138155-2009350155506_llc.fits')
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    datapath = os.path.join(tmpdir, 'lightcurves')
+    indexfile = os.path.join(tmpdir, 'lightcurves.idx')
+    stardir = os.path.join(datapath, '0111', '011138155')
+    q3 = os.path.join(stardir, os.path.basename(SAMPLE_FITS))
+    q5 = os.path.join(stardir, 'kplr011138155-2010174085026_llc.fits')
+
+    os.makedirs(stardir)
+    shutil.copy(SAMPLE_FITS, q3)
+
+    # Stray files where the index expects directories are ignored.
+    open(os.path.join(datapath, '0000'), 'w').close()
+    open(os.path.join(datapath, '0111', 'README'), 'w').close()
+
+    try:
+        index = FITSIndex(indexfile)
+        index.refresh(datapath)
+
+        if index.get_paths(datapath, '011138155', '3', 'llc') != [q3] or \
+        index.get_paths(datapath, '011138155', '4', 'llc') != [] or \
+        index.get_paths(datapath, '011138155', '3', 'slc') != []:
+            print 'Lookup after build.....FAIL'
+            sys.exit(1)
+        print 'Lookup after build.....PASS'
+
+        # Output through the index must match probing every file name.
+        targets = '011138155\t*\tllc\n'
+        probed = StringIO()
+        indexed = StringIO()
+        get_data('disk', datapath, instream=StringIO(targets),
+            outstream=probed)
+        get_data('disk', datapath, instream=StringIO(targets),
+            outstream=indexed, index=indexfile)
+
+        if probed.getvalue() != indexed.getvalue():
+            print 'Indexed get_data output.....FAIL'
+            sys.exit(1)
+        print 'Indexed get_data output.....PASS'
+
+        # A file added after the index was built should be found by a lookup
+        # without refreshing, and by an incremental refresh that only lists
+        # the changed directory.
+        time.sleep(1.)
+        shutil.copy(SAMPLE_FITS, q5)
+        index = FITSIndex(indexfile)
+
+        if index.get_paths(datapath, '011138155', '5', 'llc') != [q5]:
+            print 'Lookup of new file.....FAIL'
+            sys.exit(1)
+        print 'Lookup of new file.....PASS'
+
+        if index.refresh(datapath) != 1 or index.refresh(datapath) != 0:
+            print 'Incremental refresh.....FAIL'
+            sys.exit(1)
+        print 'Incremental refresh.....PASS'
+
+        size = index.db.execute('SELECT size FROM files WHERE quarter = ?',
+            ('5',)).fetchone()[0]
+        if size != os.path.getsize(q5):
+            print 'Indexed file size.....FAIL'
+            sys.exit(1)
+        print 'Indexed file size.....PASS'
+
+        # A file rewritten in place leaves its directory's modification time
+        # alone; a refresh should still update its size.
+        dirtime = os.path.getmtime(stardir)
+        with open(q5, 'ab') as f:
+            f.write('\0' * 2880)
+        os.utime(stardir, (dirtime, dirtime))
+
+        size = index.db.execute('SELECT size FROM files WHERE quarter = ?',
+            ('5',)).fetchone()[0]
+        if index.refresh(datapath) != 1 or size == os.path.getsize(q5) or \
+        index.db.execute('SELECT size FROM files WHERE quarter = ?',
+        ('5',)).fetchone()[0] != os.path.getsize(q5):
+            print 'Refresh of rewritten file.....FAIL'
+            sys.exit(1)
+        print 'Refresh of rewritten file.....PASS'
+        index.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
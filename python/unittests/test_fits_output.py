@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from fits_output import BLSFitsBundler
+from postprocessing.read_bls_fits import BLSOutput
+
+np.seterr(all='ignore')
+
+
+def main():
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(21)
+
+    outdir = tempfile.mkdtemp()
+    fname = os.path.join(outdir, 'KIC011138155.fits')
+
+    try:
+        # Push the output of several cleaning passes, as `analyze_star` does.
+        bundler = BLSFitsBundler()
+        bundler.make_header('011138155_llc')
+
+        curves = []
+        for i in xrange(4):
+            time = np.sort(np.random.uniform(0., 90., 5000))
+            flux = np.random.normal(size=time.shape)
+            curves.append((time, flux))
+
+            bundler.push_detrended_lightcurve(time, flux,
+                0.1 * np.ones_like(flux),
+                clean_out=dict(period=4.3 + i) if i < 3 else None)
+            bundler.push_bls_output(dict(srsq=np.arange(45.) * i),
+                np.arange(45.), np.arange(45.) + 2.)
+        bundler.push_config(dict(segment=2., nbins=1000))
+        bundler.write_file(fname)
+
+        # The passes must be in the file last first, numbered as before.
+        with BLSOutput(fname) as out:
+            names = [hdu.name for hdu in out.hdulist]
+            expected = ['PRIMARY'] + sum([['BLIP-DIP_Pass_%02d' % j,
+                'TIME-FLUX_Pass_%02d' % j] for j in xrange(4, 0, -1)], []) + \
+                ['INPUT_PARAMS']
+
+            if names != expected or out.num_passes != 4 or \
+            not all(np.array_equal(lc['Time'], time) and
+            np.array_equal(lc['Flux'], flux) for lc, (time, flux) in
+            zip(out.lightcurves, curves[::-1])) or \
+            not all(np.array_equal(db['srsq'], np.arange(45.) * i) for db, i in
+            zip(out.dipblips, xrange(3, -1, -1))):
+                print 'Pass order.....FAIL'
+                sys.exit(1)
+            print 'Pass order.....PASS'
+
+            # Each table is read once, and stays usable after closing.
+            lc = out.lightcurves[-1]
+            if out.lightcurves[-1] is not lc or len(out.dipblips) != 4 or \
+            out.params['segment'] != '2.0':
+                print 'Cached tables.....FAIL'
+                sys.exit(1)
+        if not np.array_equal(lc['Flux'], curves[0][1]):
+            print 'Cached tables.....FAIL'
+            sys.exit(1)
+        print 'Cached tables.....PASS'
+
+        out = BLSOutput(fname, header_only=True)
+        if out.kic != '011138155' or out.num_passes != 4:
+            print 'Primary header only.....FAIL'
+            sys.exit(1)
+        print 'Primary header only.....PASS'
+
+        # Only the finished file may be left in the output directory, and an
+        # existing file is only replaced with `clobber`.
+        try:
+            bundler.write_file(fname)
+            print 'Clobber.....FAIL'
+            sys.exit(1)
+        except IOError:
+            pass
+        bundler.write_file(fname, clobber=True)
+        print 'Clobber.....PASS'
+
+        if os.listdir(outdir) != [os.path.basename(fname)]:
+            print 'Partial files.....FAIL'
+            sys.exit(1)
+        print 'Partial files.....PASS'
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
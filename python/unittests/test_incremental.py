@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bls_pulse, bin_and_detrend
+from drive_bls_pulse import analyze_star
+
+np.seterr(all='ignore')
+
+
+def __same(a, b):
+    '''
+    Returns True if the arrays (or dictionaries of arrays) are bit-identical,
+    NaNs included.
+    '''
+    if isinstance(a, dict):
+        return sorted(a.keys()) == sorted(b.keys()) and all(__same(a[k], b[k])
+            for k in a)
+
+    return a.shape == b.shape and a.tobytes() == b.tobytes()
+
+
+def main():
+    nbins, segsize, mindur, maxdur = (1000, 2., 0.01, 0.5)
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(6)
+
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(9.3, 0.04, -0.01,
+        0.5, 100., 20000, 120.)
+    flux += 1. + 0.01 * np.sin(time / 7.)
+
+    state = dict()
+    bin_and_detrend(time, flux, fluxerr, nbins, segsize, state=state)
+    prev = None
+
+    # Mask a few short stretches at a time, as `clean_signal` does.
+    for i in xrange(3):
+        for start in np.random.randint(0, len(time) - 10, 4):
+            flux[start:start+10] = np.nan
+
+        full = bin_and_detrend(time, flux, fluxerr, nbins, segsize)
+        inc = bin_and_detrend(time, flux, fluxerr, nbins, segsize, state=state)
+
+        if not all(__same(a, b) for a, b in zip(full, inc)):
+            print 'Incremental detrending, pass %d.....FAIL' % i
+            sys.exit(1)
+        print 'Incremental detrending, pass %d.....PASS' % i
+
+        if len(state['changed']) == 0 or len(state['changed']) > 24:
+            print 'Changed segments, pass %d.....FAIL' % i
+            sys.exit(1)
+        print 'Changed segments, pass %d.....PASS' % i
+
+        dtime, dflux, dfluxerr, samples, _, _ = full
+        out = bls_pulse(dtime, dflux, dfluxerr, samples, nbins, segsize,
+            mindur, maxdur, direction=2)
+        if prev is not None:
+            part = bls_pulse(dtime, dflux, dfluxerr, samples, nbins, segsize,
+                mindur, maxdur, direction=2, segments=state['changed'],
+                previous=prev)
+
+            if not __same(out, part):
+                print 'Searching changed segments, pass %d.....FAIL' % i
+                sys.exit(1)
+            print 'Searching changed segments, pass %d.....PASS' % i
+        prev = out
+
+    # A light curve that ends just past a segment boundary. Once the points
+    # of its last segment are masked, that segment holds no binned points,
+    # but ``bin_and_detrend`` still counts it.
+    time = np.linspace(0., 40.01, 4002)
+    flux = 1. + 1e-3 * np.random.normal(size=time.shape)
+    fluxerr = 1e-3 * np.ones_like(time)
+    state = dict()
+    dtime, dflux, dfluxerr, samples, segstart, _ = bin_and_detrend(time, flux,
+        fluxerr, 200, segsize, state=state)
+    prev = bls_pulse(dtime, dflux, dfluxerr, samples, 200, segsize, mindur,
+        maxdur, direction=2, nsegments=len(segstart))
+
+    flux[time >= 40.] = np.nan
+    dtime, dflux, dfluxerr, samples, segstart, _ = bin_and_detrend(time, flux,
+        fluxerr, 200, segsize, state=state)
+    out = bls_pulse(dtime, dflux, dfluxerr, samples, 200, segsize, mindur,
+        maxdur, direction=2, nsegments=len(segstart))
+    part = bls_pulse(dtime, dflux, dfluxerr, samples, 200, segsize, mindur,
+        maxdur, direction=2, segments=state['changed'], previous=prev,
+        nsegments=len(segstart))
+
+    if len(segstart) != 21 or 20 not in state['changed'] or \
+    not __same(out, part) or len(out['srsq_dip']) != len(segstart):
+        print 'Empty last segment.....FAIL'
+        sys.exit(1)
+    print 'Empty last segment.....PASS'
+
+    # The previous output must hold every segment.
+    try:
+        bls_pulse(dtime, dflux, dfluxerr, samples, 200, segsize, mindur,
+            maxdur, direction=2, segments=[0], previous=dict((k, v[:-1])
+            for k, v in prev.iteritems()), nsegments=len(segstart))
+    except ValueError:
+        print 'Mismatched previous output.....PASS'
+    else:
+        print 'Mismatched previous output.....FAIL'
+        sys.exit(1)
+
+    # A simulated eclipsing binary, which goes through several cleaning
+    # iterations.
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(4.3, 0.2, -0.3,
+        0.3, 300., 9600, 200.)
+    flux += 1. + simulate_box_lightcurve(4.3, 0.15, -0.1, 0.8, 1e9, 9600,
+        200.)[1]
+
+    cfg = dict(segment=segsize, mindur=mindur, maxdur=maxdur, nbins=nbins,
+        direction=2, profile=False, clean_max=5, fitsout=False, model='box')
+    outs = []
+    for incremental in (False, True):
+        cfg['incremental'] = incremental
+        outs.append(analyze_star('test', time, flux.copy(), fluxerr, cfg))
+
+    if outs[0][0] is None or not __same(outs[0][0], outs[1][0]) or \
+    not __same(outs[0][1], outs[1][1]):
+        print 'Incremental cleaning.....FAIL'
+        sys.exit(1)
+    print 'Incremental cleaning.....PASS'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from fits_output import BLSFitsBundler
+from make_report import make_reports
+from result_store import ResultStore
+
+COLUMNS = ['srsq_dip', 'duration_dip', 'depth_dip', 'midtime_dip',
+    'srsq_blip', 'duration_blip', 'depth_blip', 'midtime_blip']
+
+
+def main():
+    nstars = 4
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(24)
+
+    outdir = tempfile.mkdtemp()
+
+    try:
+        # Stars with a folded pass and a last pass without a signal, with
+        # more points than are drawn.
+        infiles = []
+        bundlers = []
+        for i in xrange(nstars):
+            bundler = BLSFitsBundler()
+            bundler.make_header('%09d_llc' % i)
+            for clean_out in (dict(period=4.3, phase=1.1, duration=0.2,
+            depth=-0.01), None):
+                time = np.linspace(0., 90., 20000)
+                flux = 1e-3 * np.random.normal(size=time.shape)
+                bundler.push_detrended_lightcurve(time, flux,
+                    1e-3 * np.ones_like(flux), clean_out=clean_out)
+                bundler.push_bls_output(dict((k, np.random.uniform(size=45))
+                    for k in COLUMNS), np.arange(45.), np.arange(45.) + 2.)
+            bundler.push_config(dict(segment=2.))
+            infiles.append(os.path.join(outdir, 'KIC%09d_llc.fits' % i))
+            bundler.write_file(infiles[-1])
+            bundlers.append(bundler)
+
+        pdfdir = os.path.join(outdir, 'pdfs')
+        expected = sorted('KIC%09d_llc.pdf' % i for i in xrange(nstars))
+
+        out = dict(make_reports(infiles, workers=2, max_points=1000))
+        if sorted(os.listdir(pdfdir)) != expected or None in out.values():
+            print 'Parallel reports.....FAIL'
+            sys.exit(1)
+        print 'Parallel reports.....PASS'
+
+        # Only reports older than their FITS file are rendered again.
+        os.utime(infiles[1], (os.path.getmtime(out[infiles[1]]) + 10.,) * 2)
+        out = dict(make_reports(infiles))
+        if [k for k in infiles if out[k] is not None] != [infiles[1]]:
+            print 'Up to date reports.....FAIL'
+            sys.exit(1)
+        print 'Up to date reports.....PASS'
+
+        # Stars in a result store are named as <store>#<key>, and their
+        # reports are saved in the store.
+        store = ResultStore(os.path.join(outdir, 'store'))
+        locations = [store.append('%09d_llc' % i, bundlers[i]) for i in
+            xrange(nstars)]
+        store.close()
+
+        out = dict(make_reports(locations, workers=2, max_points=1000))
+        if sorted(os.listdir(os.path.join(outdir, 'store', 'pdfs'))) != \
+        expected or None in out.values() or \
+        any(v is not None for _, v in make_reports(locations)):
+            print 'Result store reports.....FAIL'
+            sys.exit(1)
+        print 'Result store reports.....PASS'
+    finally:
+        shutil.rmtree(outdir)
+
+
+if __name__ == '__main__':
+    main()
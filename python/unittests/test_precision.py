@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+from simulate import simulate_box_lightcurve
+from bls_pulse_cython import bls_pulse, bin_and_detrend
+
+np.seterr(all='ignore')
+
+
+def __deviation(a, b):
+    '''
+    Returns the largest relative deviation of `a` from `b` over the finite
+    values of `b`, and the fraction of those values that are identical.
+    '''
+    ndx = np.isfinite(b) & (b != 0.)
+    return np.nanmax(np.absolute(a[ndx] / b[ndx] - 1.)), \
+        np.mean(a[ndx] == b[ndx])
+
+
+def main():
+    nbins, segsize, mindur, maxdur = (1000, 2., 0.01, 0.5)
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(18)
+
+    # A simulated eclipsing binary with a slow trend, as in the Kepler
+    # light curves.
+    time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(4.3, 0.2, -0.01,
+        0.3, 300., 9600, 200.)
+    flux += 1. + 0.01 * np.sin(time / 7.)
+
+    out = dict()
+    for dtype in ('float64', 'float32'):
+        dtime, dflux, dfluxerr, samples, _, _ = bin_and_detrend(time, flux,
+            fluxerr, nbins, segsize, dtype=dtype)
+
+        if dtime.dtype != np.float64 or dflux.dtype != dtype or \
+        dfluxerr.dtype != dtype or samples.dtype != dtype:
+            print 'Binned data types (%s).....FAIL' % dtype
+            sys.exit(1)
+        print 'Binned data types (%s).....PASS' % dtype
+
+        out[dtype] = bls_pulse(dtime, dflux, dfluxerr, samples, nbins, segsize,
+            mindur, maxdur, direction=2)
+
+    # The events found must nearly always be the same; SR^2 and depth may
+    # only differ by the rounding of the binned fluxes.
+    for name in ('srsq', 'depth', 'midtime'):
+        for kind in ('_dip', '_blip'):
+            key = name + kind
+            dev, same = __deviation(out['float32'][key], out['float64'][key])
+            print '%s: max. relative deviation %.3g, %.1f%% identical' % \
+                (key, dev, 100. * same)
+
+            if (name == 'midtime' and same < 0.95) or \
+            (name != 'midtime' and dev > 1e-5):
+                print 'Single precision %s.....FAIL' % key
+                sys.exit(1)
+            print 'Single precision %s.....PASS' % key
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import glob
+import shutil
+import pyfits
+import tempfile
+import subprocess
+import numpy as np
+from simulate import simulate_box_lightcurve
+from utils import encode_array
+from fits_output import BLSFitsBundler
+from result_store import ResultStore, open_store
+from postprocessing.read_bls_fits import BLSOutput
+
+CONFIG = '''[DEFAULT]
+segment = 2.
+min_duration = 0.01
+max_duration = 0.5
+n_bins = 500
+direction = 2
+print_format = outfile
+clean_max = 3
+fits_output = yes
+fits_dir = %s
+fits_store = %s
+'''
+
+
+def __passes(f):
+    '''
+    Returns the bytes of a FITS file up to its configuration HDU, which holds
+    the output settings.
+    '''
+    data = f.read()
+    f.seek(0)
+    hdulist = pyfits.open(f)
+    end = hdulist.fileinfo(len(hdulist) - 1)['hdrLoc']
+    hdulist.close()
+    return data[:end]
+
+
+def __run(config, stars, *args):
+    '''
+    Run ``drive_bls_pulse.py`` on the encoded stars and return its output.
+    '''
+    p = subprocess.Popen([sys.executable, 'drive_bls_pulse.py', '-c',
+        config] + list(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=open(os.devnull, 'w'))
+    out, _ = p.communicate(stars)
+
+    if p.returncode != 0:
+        print 'drive_bls_pulse.py ' + ' '.join(args) + '.....FAIL'
+        sys.exit(1)
+
+    return out
+
+
+def main():
+    nstars = 8
+    workers = 3
+
+    # To make it deterministic, seed the PRNG.
+    np.random.seed(22)
+
+    lines = []
+    for i in xrange(nstars):
+        period = np.random.uniform(2., 10.)
+        duration = np.random.uniform(1. / 24., 5. / 24.)
+        depth = np.random.uniform(-0.01, -0.5)
+        time, flux, fluxerr, _, _, _ = simulate_box_lightcurve(period,
+            duration, depth, 0.5, 1000., 10000, 20.)
+        lines.append('\t'.join(['%09d_llc' % i, str(['01']),
+            encode_array(time), encode_array(flux), encode_array(fluxerr)]))
+    stars = '\n'.join(lines) + '\n'
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        # One file per star, serially, and a store written by several
+        # workers at once.
+        fitsdir = os.path.join(tmpdir, 'files')
+        storedir = os.path.join(tmpdir, 'store')
+        os.makedirs(fitsdir)
+        for name, store, args in (('files', '', []), ('store', storedir,
+        ['--workers', str(workers)])):
+            config = os.path.join(tmpdir, name + '.conf')
+            with open(config, 'w') as f:
+                f.write(CONFIG % (fitsdir, store))
+            out = __run(config, stars, *args)
+
+        store = ResultStore(storedir)
+        keys = ['%09d_llc' % i for i in xrange(nstars)]
+        shards = glob.glob(os.path.join(storedir, '*.dat'))
+
+        if store.keys() != keys or len(shards) > workers or \
+        sorted(out.split()) != sorted('%s#%s' % (store.path, k) for k in keys):
+            print 'Store contents.....FAIL'
+            sys.exit(1)
+        print 'Store contents.....PASS'
+
+        for k in keys:
+            with open(os.path.join(fitsdir, 'KIC' + k + '.fits'), 'rb') as f:
+                if __passes(f) != __passes(store.open(k)):
+                    print 'Stored FITS file %s.....FAIL' % k
+                    sys.exit(1)
+        print 'Stored FITS files.....PASS'
+
+        # A star written again replaces the old copy; data and index lines
+        # left by a process that died while writing are ignored.
+        with open(shards[0], 'ab') as f:
+            f.write('SIMPLE  = ' + ' ' * 100)
+        with open(shards[0][:-len('.dat')] + '.idx', 'a') as f:
+            f.write(keys[1] + '\t0\t')
+
+        bundler = BLSFitsBundler()
+        bundler.make_header(keys[0])
+        bundler.push_config(dict(segment=2.))
+        writer = ResultStore(storedir)
+        writer.append(keys[0], bundler)
+        writer.close()
+
+        store.refresh()
+        if store.keys() != keys or BLSOutput(store.open(keys[0])).num_passes \
+        != 0 or BLSOutput(store.open(keys[1])).num_passes < 1:
+            print 'Rewrites and partial writes.....FAIL'
+            sys.exit(1)
+        print 'Rewrites and partial writes.....PASS'
+
+        # Within a shard, the later copy of a star is used even if the clock
+        # was set back between the two writes.
+        writer = open_store(storedir)
+        writer.append('999999999_llc', bundler)
+        writer.append('999999999_llc', bundler)
+        index = writer.index.name
+        writer.close()
+
+        with open(index, 'r') as f:
+            lines = f.readlines()
+        lines[-1] = '\t'.join(lines[-1].split('\t')[0:3] + ['0.000000\n'])
+        with open(index, 'w') as f:
+            f.writelines(lines)
+
+        store.refresh()
+        if open_store(storedir + os.sep) is not writer or \
+        store.stat('999999999_llc')[1] != 0.:
+            print 'Latest copy in a shard.....FAIL'
+            sys.exit(1)
+        print 'Latest copy in a shard.....PASS'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
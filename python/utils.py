@@ -10,6 +10,7 @@ import sys
 import json
 import zlib
 import base64
+import struct
 import logging
 import traceback
 import numpy as np
@@ -147,11 +148,12 @@ def bin_single_segment_slow(time, flux, fluxerr, nbins, segstart, segend):
         np.array(binned_errors, dtype='float64')
 
 
-def read_mapper_output(f, separator='\t', uri=False):
+def read_mapper_output(f, separator='\t', uri=False, offsets=False):
     '''
     Reads data from the input file, assuming the given separator, in base64 format;
     yields the decoded and split line. The format is KIC ID, quarter, [uri], time,
-    flux, error for each line.
+    flux, error for each line, optionally followed by the index at which each
+    quarter begins (see ``join_quarters``).
 
     :param f: File to read; usually ``sys.stdin``
     :type f: file
@@ -159,19 +161,32 @@ def read_mapper_output(f, separator='\t', uri=False):
     :type separator: str
     :param uri: Whether the URI is included on the line
     :type uri: bool
+    :param offsets: Whether to also yield the quarter offsets; None is yielded
+        for lines that do not include them
+    :type offsets: bool
 
     :rtype: tuple
     '''
     for line in f:
+        fields = line.rstrip().split(separator)
+
         if uri:
-            kic, q, uri, t, f, e = line.rstrip().split(separator)
+            kic, q, uri_, t, f_, e = fields[0:6]
+            extra = fields[6:]
         else:
-            kic, q, t, f, e = line.rstrip().split(separator)
+            kic, q, t, f_, e = fields[0:5]
+            extra = fields[5:]
 
         time = decode_array(t)
-        flux = decode_array(f)
+        flux = decode_array(f_)
         fluxerr = decode_array(e)
-        yield kic, q, time, flux, fluxerr
+
+        if offsets:
+            qoffsets = decode_array(extra[0]).astype('int64') if extra \
+                else None
+            yield kic, q, time, flux, fluxerr, qoffsets
+        else:
+            yield kic, q, time, flux, fluxerr
 
 
 def read_pipeline_output(f, separator='\t'):
@@ -206,38 +221,132 @@ def read_pipeline_output(f, separator='\t'):
             srsq_blip, duration_blip, depth_blip, midtime_blip
 
 
-def encode_array(arr):
+################################################################################
+# Binary wire format for arrays passed between pipeline stages. Each encoded
+# array is a small fixed-size header followed by the raw little-endian buffer,
+# optionally zlib-compressed, and the whole thing is base64-encoded so that it
+# can still be written as one tab-separated field on a line of text. The magic
+# string can never be the first bytes of a zlib stream, so payloads written in
+# the legacy JSON format are detected automatically by `decode_array`.
+################################################################################
+WIRE_MAGIC = 'CKAR'
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct('<4sBBBxQ')
+
+WIRE_FLAG_ZLIB = 0x01
+
+WIRE_DTYPES = {'d': np.dtype('<f8'), 'f': np.dtype('<f4')}
+WIRE_DTYPE_CODES = {'float64': 'd', 'float32': 'f'}
+################################################################################
+
+
+def encode_array(arr, dtype=None, compress=False):
     '''
-    base64-encodes the given numpy array.
+    base64-encodes the given numpy array in the binary wire format. Raises
+    ValueError if the array has more than one dimension or is not of a
+    floating-point type, rather than flattening it or converting its values;
+    convert other arrays explicitly first.
+
+    :param arr: One-dimensional floating-point array to encode
+    :type arr: numpy.ndarray
+    :param dtype: Floating-point type to store, either "float64" or "float32";
+        defaults to the type of `arr` if it is one of those, else "float64"
+    :type dtype: str
+    :param compress: Whether to zlib-compress the raw buffer
+    :type compress: bool
+
+    :rtype: str
+    '''
+    arr = np.asarray(arr)
+
+    if arr.ndim > 1:
+        raise ValueError('Cannot encode a %d-dimensional array.' % arr.ndim)
+    if arr.dtype.kind != 'f':
+        raise ValueError('Cannot encode an array of type %s.' %
+            arr.dtype.name)
+
+    if dtype is None:
+        dtype = arr.dtype.name if arr.dtype.name in WIRE_DTYPE_CODES \
+            else 'float64'
+
+    try:
+        code = WIRE_DTYPE_CODES[np.dtype(dtype).name]
+    except KeyError:
+        raise ValueError('Unsupported wire dtype: %s' % dtype)
+
+    payload = np.ascontiguousarray(arr, dtype=WIRE_DTYPES[code]).tostring()
+    flags = 0
+
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= WIRE_FLAG_ZLIB
+
+    header = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, ord(code), flags,
+        arr.size)
+
+    return base64.b64encode(header + payload)
+
+
+def encode_array_legacy(arr):
+    '''
+    base64-encodes the given numpy array in the legacy JSON format. Only
+    useful for feeding consumers that predate the binary wire format.
 
     :param arr: Array to encode
     :type arr: numpy.ndarray
 
     :rtype: str
     '''
-    return base64.b64encode(zlib.compress(json.dumps(arr.tolist())))
+    return base64.b64encode(zlib.compress(json.dumps(np.asarray(arr).tolist())))
 
 
 def encode_list(lst):
     '''
-    base64-encodes the given Python list.
+    base64-encodes the given Python list in the binary wire format, as an
+    array of 64-bit floats.
 
     :param lst: List to encode
     :type lst: list
 
     :rtype: str
     '''
-    return base64.b64encode(zlib.compress(json.dumps(lst)))
+    return encode_array(np.asarray(lst, dtype='float64'))
 
 
 def decode_array(s):
     '''
-    base64-decode the given string.
+    base64-decode the given string. Both the binary wire format and the legacy
+    JSON format are accepted. The result is always a writable array in native
+    byte order; binary payloads keep the floating-point type they were
+    encoded with and legacy payloads are returned as 64-bit floats.
 
     :param s: String to decode
     :type s: str
 
-    :rtype: list
+    :rtype: numpy.ndarray
     '''
-    return json.loads(zlib.decompress(base64.b64decode(s)))
+    raw = base64.b64decode(s)
+
+    if raw[:len(WIRE_MAGIC)] != WIRE_MAGIC:
+        return np.array(json.loads(zlib.decompress(raw)), dtype='float64')
+
+    magic, version, code, flags, count = WIRE_HEADER.unpack_from(raw)
+
+    if version > WIRE_VERSION:
+        raise ValueError('Unsupported wire format version: %d' % version)
+
+    try:
+        dtype = WIRE_DTYPES[chr(code)]
+    except KeyError:
+        raise ValueError('Unsupported wire dtype code: %r' % chr(code))
+
+    if flags & WIRE_FLAG_ZLIB:
+        arr = np.frombuffer(zlib.decompress(raw[WIRE_HEADER.size:]),
+            dtype=dtype, count=count)
+    else:
+        arr = np.frombuffer(raw, dtype=dtype, count=count,
+            offset=WIRE_HEADER.size)
 
+    # Copy into a writable array in native byte order; downstream code
+    # modifies some of these arrays in place.
+    return arr.astype(dtype.newbyteorder('='))